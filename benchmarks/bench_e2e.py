@@ -0,0 +1,195 @@
+import argparse, datetime, json, os, subprocess, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pandas as pd
+from astrapy.db import AstraDB
+
+from embeddings import embed_text, model_id
+from ingest_pipeline import run_pipeline
+from metrics import LatencyRecorder
+from benchmarks.mock_services import MockCollection, fake_embedding, start_mock_server
+
+# End-to-end benchmark of the ingest and query workloads against local OpenAI and Astra stand-ins.
+# The entry point scripts run as soon as they are imported, so this drives the same building blocks
+# they use (embeddings, ingest_pipeline, vector_find, completions, DataFrame rendering).
+#
+#   python -m benchmarks.bench_e2e --catalog-sizes 500,5000 --concurrency 1,8 --k 5,20 --output bench.json
+#   python -m benchmarks.bench_e2e --compare bench.json          # compare a new run against an older one
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bikes.json')
+COLLECTION = 'bench_bikes'
+FIELDS = ["type", "brand", "model", "price", "description"]
+QUESTIONS = [
+    "a light bike for my daughter", "commuting to work in the rain", "cheap mountain bike for trails",
+    "electric bike with long range", "folding bike for the train", "gravel bike for long weekends",
+]
+
+def synthetic_catalog(size):
+    with open(DATA_FILE) as f:
+        bikes = json.load(f)
+    # Repeat the sample catalog, making every description unique so nothing is deduplicated
+    return [dict(bikes[i % len(bikes)], model=f"{bikes[i % len(bikes)]['model']} {i}",
+                 description=f"{bikes[i % len(bikes)]['description']} #{i}") for i in range(size)]
+
+class TimedEmbeddings:
+    # Wraps client.embeddings so every request is recorded as the "embed" stage
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def create(self, input, model):
+        with self.recorder.timed('embed', items=1 if isinstance(input, str) else len(input)):
+            return self.client.embeddings.create(input=input, model=model)
+
+class TimedClient:
+    def __init__(self, client, recorder):
+        self.embeddings = TimedEmbeddings(client, recorder)
+
+class TimedCollection:
+    # Records insert_many calls as the "insert" stage
+    def __init__(self, collection, recorder):
+        self.collection = collection
+        self.recorder = recorder
+
+    def insert_many(self, documents, **kwargs):
+        with self.recorder.timed('insert', items=len(documents)):
+            return self.collection.insert_many(documents, **kwargs)
+
+def run_ingest(server, client, size, concurrency, recorder):
+    astra_db = AstraDB(token="mock", api_endpoint=server.astra_endpoint)
+    astra_db.delete_collection(COLLECTION)
+    collection = astra_db.create_collection(COLLECTION, dimension=server.dimension)
+    os.environ['EMBED_CONCURRENCY'] = str(concurrency)
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        rows = run_pipeline(
+            synthetic_catalog(size), model=model_id,
+            output_path=os.path.join(tmp, 'bikes_withVector.jsonl'),
+            collection=TimedCollection(collection, recorder),
+            client=TimedClient(client, recorder),
+        )
+        elapsed = time.perf_counter() - start
+    return {'wall_seconds': elapsed, 'rows': rows, 'rows_per_second': rows / elapsed}
+
+def preload_collection(server, size):
+    # Fill the mock collection directly; the query workload does not measure loading
+    collection = MockCollection({'vector': {'dimension': server.dimension}})
+    for i, bike in enumerate(synthetic_catalog(size)):
+        collection.documents[i] = dict(bike, _id=i, **{'$vector': fake_embedding(bike['description'], server.dimension)})
+    with server.lock:
+        server.collections[COLLECTION] = collection
+
+def run_queries(server, client, queries, concurrency, k, recorder):
+    astra_db = AstraDB(token="mock", api_endpoint=server.astra_endpoint)
+    collection = astra_db.collection(COLLECTION)
+
+    def one_query(i):
+        question = f"{QUESTIONS[i % len(QUESTIONS)]} ({i})"
+        try:
+            with recorder.timed('embed'):
+                embedding = embed_text(question, client=client)
+            with recorder.timed('ann'):
+                results = collection.vector_find(embedding, limit=k, fields=FIELDS)
+            with recorder.timed('render'):
+                bikes_results = pd.DataFrame(results)
+                bikes_results.to_html()
+            prompts = [f"For a {question}, why would you suggest {row['model']} {row['brand']}, described as {row['description']}?"
+                       for _, row in bikes_results.iterrows()]
+            with recorder.timed('llm', items=len(prompts)):
+                client.completions.create(model="gpt-3.5-turbo-instruct", prompt=prompts, max_tokens=64)
+        except Exception:
+            recorder.record('errors', 0.0)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_query, range(queries)))
+    elapsed = time.perf_counter() - start
+    return {'wall_seconds': elapsed, 'queries': queries, 'queries_per_second': queries / elapsed}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def scenario_key(scenario):
+    return (scenario['workload'], scenario['catalog_size'], scenario['concurrency'], scenario.get('k'))
+
+def compare(previous_path, report):
+    # Print the p50/p95 change of every stage that both runs measured
+    with open(previous_path) as f:
+        previous = {scenario_key(scenario): scenario for scenario in json.load(f)['scenarios']}
+    print(f"\nCompared with {previous_path}:")
+    for scenario in report['scenarios']:
+        old = previous.get(scenario_key(scenario))
+        if old is None:
+            continue
+        for stage, stats in scenario['stages'].items():
+            if stage not in old['stages']:
+                continue
+            before = old['stages'][stage]
+            print(f"  {scenario['workload']:<6} n={scenario['catalog_size']:<6} c={scenario['concurrency']:<3} k={scenario.get('k') or '-':<3} "
+                  f"{stage:<7} p50 {before['p50_ms']:8.1f} -> {stats['p50_ms']:8.1f} ms   p95 {before['p95_ms']:8.1f} -> {stats['p95_ms']:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against local mock services")
+    parser.add_argument('--catalog-sizes', default="500,2000")
+    parser.add_argument('--concurrency', default="1,8")
+    parser.add_argument('--k', default="5,20")
+    parser.add_argument('--queries', type=int, default=100, help="Queries per query scenario")
+    parser.add_argument('--workloads', default="ingest,query")
+    parser.add_argument('--openai-latency', type=float, default=0.05)
+    parser.add_argument('--astra-latency', type=float, default=0.02)
+    parser.add_argument('--token-latency', type=float, default=0.0, help="Seconds per generated completion token")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Latency standard deviation as a fraction of the mean")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--dimension', type=int, default=1536)
+    parser.add_argument('--output', default="bench_results.json")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(
+        latency=args.openai_latency, astra_latency=args.astra_latency, token_latency=args.token_latency,
+        error_rate=args.error_rate, jitter=args.jitter, dimension=args.dimension,
+    )
+    client = openai.OpenAI(api_key="mock", base_url=base_url, max_retries=args.max_retries)
+    workloads = args.workloads.split(',')
+    report = {
+        'commit': git_commit(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': vars(args),
+        'scenarios': [],
+    }
+
+    try:
+        for size in [int(value) for value in args.catalog_sizes.split(',')]:
+            for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                if 'ingest' in workloads:
+                    recorder = LatencyRecorder()
+                    result = run_ingest(server, client, size, concurrency, recorder)
+                    report['scenarios'].append({'workload': 'ingest', 'catalog_size': size, 'concurrency': concurrency,
+                                                **result, 'stages': recorder.summary()})
+                    print(f"\ningest n={size} concurrency={concurrency}: {result['rows_per_second']:.1f} rows/s")
+                    print(recorder.format_summary())
+                if 'query' in workloads:
+                    preload_collection(server, size)
+                    for k in [int(value) for value in args.k.split(',')]:
+                        recorder = LatencyRecorder()
+                        result = run_queries(server, client, args.queries, concurrency, k, recorder)
+                        report['scenarios'].append({'workload': 'query', 'catalog_size': size, 'concurrency': concurrency,
+                                                    'k': k, **result, 'stages': recorder.summary()})
+                        print(f"\nquery n={size} concurrency={concurrency} k={k}: {result['queries_per_second']:.1f} queries/s")
+                        print(recorder.format_summary())
+    finally:
+        server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(args.compare, report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse, json, os, time
+
+import openai
+
+from embeddings import embed_texts, model_id
+from benchmarks.mock_services import start_mock_server
+
+# Measure batched embedding throughput against a local mock embeddings endpoint.
+#
+#   python -m benchmarks.bench_embeddings --rows 2000 --latency 0.2
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bikes.json')
+
+def load_descriptions(rows):
+    with open(DATA_FILE) as f:
+        bikes = json.load(f)
+    descriptions = [bike['description'] for bike in bikes]
+    # Repeat the sample catalog until it reaches the requested size
+    return [f"{descriptions[i % len(descriptions)]} #{i}" for i in range(rows)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding throughput benchmark")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.1, help="Injected seconds per request")
+    parser.add_argument('--batch-sizes', default="1,16,64,256")
+    parser.add_argument('--concurrency', default="1,4,16")
+    parser.add_argument('--dimension', type=int, default=1536)
+    args = parser.parse_args()
+
+    texts = load_descriptions(args.rows)
+    server, base_url = start_mock_server(latency=args.latency, dimension=args.dimension)
+    client = openai.OpenAI(api_key="mock", base_url=base_url, max_retries=0)
+
+    print(f"rows={args.rows} latency={args.latency}s dimension={args.dimension}")
+    print(f"{'batch':>6} {'conc':>5} {'requests':>9} {'seconds':>8} {'rows/s':>9}")
+    try:
+        for batch_size in [int(value) for value in args.batch_sizes.split(',')]:
+            for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                start_requests = server.request_count
+                start = time.perf_counter()
+                vectors = embed_texts(texts, client=client, model=model_id, batch_size=batch_size, concurrency=concurrency)
+                elapsed = time.perf_counter() - start
+                assert len(vectors) == len(texts)
+                requests = server.request_count - start_requests
+                print(f"{batch_size:>6} {concurrency:>5} {requests:>9} {elapsed:>8.2f} {len(texts) / elapsed:>9.1f}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
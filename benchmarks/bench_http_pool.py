@@ -0,0 +1,71 @@
+import argparse, time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+from astrapy.db import AstraDBCollection
+
+import http_clients
+from embeddings import embed_text
+from metrics import LatencyRecorder, REGISTRY
+from benchmarks.bench_e2e import COLLECTION, FIELDS, QUESTIONS, preload_collection
+from benchmarks.mock_services import start_mock_server
+
+# Query latency with a new client per query (each one opens new connections) versus the shared pooled clients.
+# The mock server delays the first request on every connection by --connect-latency, which stands in
+# for the TCP and TLS handshake of the real endpoints.
+#
+#   python -m benchmarks.bench_http_pool --concurrency 8 --queries 200 --connect-latency 0.05
+
+def run(mode, server, base_url, queries, concurrency, recorder):
+    def one_query(i):
+        question = f"{QUESTIONS[i % len(QUESTIONS)]} ({i})"
+        if mode == 'fresh':
+            http_client = httpx.Client()
+            client = openai.OpenAI(api_key="mock", base_url=base_url, http_client=http_client)
+            collection = AstraDBCollection(COLLECTION, token="mock", api_endpoint=server.astra_endpoint)
+            collection.client = http_client
+        else:
+            client = openai.OpenAI(api_key="mock", base_url=base_url, http_client=http_clients.get_http_client('openai'))
+            collection = http_clients.astra_collection(COLLECTION, "mock", server.astra_endpoint)
+        with recorder.timed('query'):
+            with recorder.timed('embed'):
+                embedding = embed_text(question, client=client)
+            with recorder.timed('ann'):
+                collection.vector_find(embedding, limit=5, fields=FIELDS)
+        if mode == 'fresh':
+            http_client.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_query, range(queries)))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Fresh clients versus the shared connection pools")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--connect-latency', type=float, default=0.05, help="Seconds added to the first request of each connection")
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--dimension', type=int, default=256, help="Small vectors keep the mock's JSON work out of the measurement")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(latency=args.latency, connect_latency=args.connect_latency, dimension=args.dimension)
+    try:
+        preload_collection(server, 500)
+        for mode in ('fresh', 'pooled'):
+            if mode == 'pooled':
+                http_clients.prewarm('openai', base_url, args.concurrency)
+                http_clients.prewarm('astra', server.astra_endpoint, args.concurrency)
+            recorder = LatencyRecorder()
+            elapsed = run(mode, server, base_url, args.queries, args.concurrency, recorder)
+            print(f"\n{mode}: {args.queries / elapsed:.1f} queries/s")
+            print(recorder.format_summary())
+        pools = REGISTRY.dump()['collectors']
+        for name in ('http_pool_openai', 'http_pool_astra'):
+            print(f"{name}: {pools[name]}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse, json, statistics, time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from bike_summaries import add_compact_fields
+from embeddings import count_tokens, get_encoding
+from prompt_builder import build_bike_contexts
+from benchmarks.bench_e2e import QUESTIONS
+from benchmarks.mock_services import start_mock_server
+
+# Prompt tokens and answer latency of the recommendation prompts, with full descriptions (before)
+# and with the compact forms filling PROMPT_CONTEXT_TOKENS (after), for several k:
+#
+#   ui     demo-ui.py: one completion per bike, sent concurrently
+#   chat   demo-ui-chat.py: one chat completion with every bike as an assistant message
+#
+# Tokens are counted with the model tokenizer (tiktoken) when it is installed, otherwise estimated.
+# The mock server spends --prompt-latency seconds per prompt word before answering, standing in for
+# the time the model takes to read the prompt.
+#
+#   python -m benchmarks.bench_prompts --k 3,5,10,20 --budget 600
+
+UI_MODEL = 'gpt-3.5-turbo-instruct'
+CHAT_MODEL = 'gpt-3.5-turbo'
+SYSTEM = "You are an assistant working at a bike retail shop Bike Mart and your job is to provide Bike Recommendations to customers."
+
+def ui_prompts(bikes, question, contexts=None):
+    contexts = contexts or [bike['description'] for bike in bikes]
+    return [
+        f"You are an experienced bike rider who is working at a bike retail shop Bike Mart and your job is to provide Bike Recommendations to customers. For a {question}, why would you suggest {bike['model']} {bike['brand']}, described as {context}?"
+        for bike, context in zip(bikes, contexts)
+    ]
+
+def chat_messages(question, contexts):
+    return ([{"role": "system", "content": SYSTEM}, {"role": "user", "content": question}]
+            + [{"role": "assistant", "content": context} for context in contexts if context is not None]
+            + [{"role": "assistant", "content": "Here's my answer to your question."}])
+
+def build(bikes, question, mode, budget):
+    # (ui prompts, chat messages) for one answer
+    if mode == 'before':
+        descriptions = [bike['description'] for bike in bikes]
+        return ui_prompts(bikes, question), chat_messages(question, descriptions)
+    ui_contexts, _, _ = build_bike_contexts(bikes, budget, UI_MODEL, keep_all=True)
+    chat_contexts, _, _ = build_bike_contexts(bikes, budget, CHAT_MODEL)
+    return ui_prompts(bikes, question, ui_contexts), chat_messages(question, chat_contexts)
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommendation prompt size and latency with full descriptions versus compact summaries")
+    parser.add_argument('--data', default='data/bikes.json')
+    parser.add_argument('--k', default='3,5,10,20')
+    parser.add_argument('--budget', type=int, default=600, help="PROMPT_CONTEXT_TOKENS for the compact prompts")
+    parser.add_argument('--answers', type=int, default=10, help="Questions per k")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--prompt-latency', type=float, default=0.0005, help="Mock seconds per prompt word")
+    args = parser.parse_args()
+
+    with open(args.data) as f:
+        bikes = json.load(f)
+    start = time.perf_counter()
+    for bike in bikes:
+        add_compact_fields(bike)
+    print(f"Summarized {len(bikes)} bikes in {(time.perf_counter() - start) * 1000:.0f} ms (ingest stage)")
+    print(f"Tokenizer: {'tiktoken' if get_encoding(CHAT_MODEL) is not None else 'estimate, tiktoken not installed'}")
+
+    server, base_url = start_mock_server(latency=args.latency, prompt_token_latency=args.prompt_latency)
+    client = openai.OpenAI(api_key="mock", base_url=base_url, max_retries=0)
+    print(f"\n{'k':>3} {'prompts':<7} {'ui tokens':>10} {'chat tokens':>12} {'build ms':>9} {'ui p50 ms':>10} {'chat p50 ms':>12}")
+    try:
+        for k in [int(value) for value in args.k.split(',')]:
+            for mode in ('before', 'after'):
+                ui_tokens, chat_tokens, build_ms, ui_ms, chat_ms = [], [], [], [], []
+                for i in range(args.answers):
+                    # A different run of k bikes for each question
+                    answer = [bikes[(i * k + j) % len(bikes)] for j in range(k)]
+                    question = QUESTIONS[i % len(QUESTIONS)]
+                    start = time.perf_counter()
+                    prompts, messages = build(answer, question, mode, args.budget)
+                    build_ms.append((time.perf_counter() - start) * 1000)
+                    ui_tokens.append(sum(count_tokens(prompt, UI_MODEL) for prompt in prompts))
+                    chat_tokens.append(sum(count_tokens(message['content'], CHAT_MODEL) for message in messages))
+                    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+                        ui_ms.append(timed(lambda: list(executor.map(
+                            lambda prompt: client.completions.create(model=UI_MODEL, prompt=prompt, max_tokens=64), prompts))) * 1000)
+                    chat_ms.append(timed(lambda: client.chat.completions.create(model=CHAT_MODEL, messages=messages)) * 1000)
+                print(f"{k:>3} {mode:<7} {statistics.mean(ui_tokens):>10.0f} {statistics.mean(chat_tokens):>12.0f}"
+                      f" {statistics.median(build_ms):>9.1f} {statistics.median(ui_ms):>10.0f} {statistics.median(chat_ms):>12.0f}")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse, os, threading, time
+
+import openai
+
+from embeddings import embed_text, embed_texts
+from metrics import LatencyRecorder, REGISTRY
+from request_scheduler import get_scheduler
+from benchmarks.bench_embeddings import load_descriptions
+from benchmarks.mock_services import start_mock_server
+
+# Bulk ingest and interactive queries against a mock OpenAI endpoint that answers 429 over its rate
+# limit (with retry-after-ms) and at random, and 500 at random.
+#
+#   unscheduled        requests go straight to the API: the ingest dies on the first 429 or 500
+#   scheduled          shared scheduler: the ingest completes, throttled requests are retried
+#   no lanes           queries run in the ingest's lane and queue behind it
+#   lanes              queries run in the interactive lane and go before the ingest
+#
+#   python -m benchmarks.bench_rate_limits --rows 3000 --rate-limit 40 --rpm 4800
+
+def ingest(texts, client, model, batch_size, concurrency):
+    start = time.perf_counter()
+    try:
+        embed_texts(texts, client=client, model=model, batch_size=batch_size, concurrency=concurrency, lane='background')
+        return time.perf_counter() - start, None
+    except Exception as error:
+        return time.perf_counter() - start, f"{type(error).__name__}: {error}"
+
+def ingest_with_queries(texts, client, model, args, query_lane):
+    # The ingest runs while a query is embedded every --query-interval seconds
+    recorder = LatencyRecorder()
+    done = threading.Event()
+
+    def queries():
+        i = 0
+        while not done.is_set():
+            with recorder.timed('query'):
+                embed_batch_text(f"Which bike is best for a {i} km commute?", client, model, query_lane)
+            i += 1
+            time.sleep(args.query_interval)
+
+    thread = threading.Thread(target=queries)
+    thread.start()
+    elapsed, error = ingest(texts, client, model, args.batch_size, args.concurrency)
+    done.set()
+    thread.join()
+    return elapsed, error, recorder.summary().get('query', {})
+
+def embed_batch_text(text, client, model, lane):
+    # embed_text always uses the interactive lane; the "no lanes" run needs the background one
+    if lane == 'interactive':
+        return embed_text(text, client=client, model=model)
+    return embed_texts([text], client=client, model=model, lane=lane)[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI request scheduler under injected rate limits")
+    parser.add_argument('--rows', type=int, default=3000)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=16, help="Ingest worker threads")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--rate-limit', type=float, default=40, help="Mock requests per second before 429s")
+    parser.add_argument('--throttle-rate', type=float, default=0.02, help="Share of requests answered 429 at random")
+    parser.add_argument('--error-rate', type=float, default=0.01, help="Share of requests answered 500 at random")
+    parser.add_argument('--rpm', type=float, default=4800, help="OPENAI_RPM for the scheduler; above the mock limit to exercise the backoff")
+    parser.add_argument('--query-interval', type=float, default=0.1)
+    parser.add_argument('--dimension', type=int, default=256)
+    args = parser.parse_args()
+
+    texts = load_descriptions(args.rows)
+    server, base_url = start_mock_server(latency=args.latency, dimension=args.dimension, rate_limit=args.rate_limit,
+                                         throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+    client = openai.OpenAI(api_key="mock", base_url=base_url, max_retries=0)
+    os.environ['OPENAI_RPM'] = str(args.rpm)
+    try:
+        # Each run gets its own scheduler, named after the run (the mock ignores the model)
+        os.environ['OPENAI_SCHEDULER'] = 'off'
+        elapsed, error = ingest(texts, client, 'unscheduled', args.batch_size, args.concurrency)
+        print(f"unscheduled: {'failed after' if error else 'done in'} {elapsed:.2f}s" + (f" ({error[:80]})" if error else ""))
+
+        os.environ['OPENAI_SCHEDULER'] = 'on'
+        elapsed, error = ingest(texts, client, 'scheduled', args.batch_size, args.concurrency)
+        print(f"scheduled:   {'failed after' if error else 'done in'} {elapsed:.2f}s, {args.rows / elapsed:.0f} rows/s"
+              + (f" ({error[:80]})" if error else ""))
+        print(f"  {get_scheduler('scheduled').stats()}")
+
+        print(f"\n{'queries':<12} {'ingest s':>9} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name, lane in (('no lanes', 'background'), ('lanes', 'interactive')):
+            elapsed, error, stats = ingest_with_queries(texts, client, name, args, lane)
+            print(f"{name:<12} {elapsed:>9.2f} {stats.get('count', 0):>6} {stats.get('p50_ms', 0):>8.0f}"
+                  f" {stats.get('p95_ms', 0):>8.0f} {stats.get('p99_ms', 0):>8.0f}" + (f"  {error[:60]}" if error else ""))
+        waits = REGISTRY.dump()['latency_seconds']
+        for lane in ('interactive', 'background'):
+            snapshot = waits.get(f"openai lanes {lane} queue wait")
+            if snapshot and snapshot['count']:
+                print(f"lanes: {lane} mean queue wait {snapshot['sum'] / snapshot['count'] * 1000:.0f} ms over {snapshot['count']} requests")
+        print(f"\nmock: {server.request_count} requests, {server.throttled_count} throttled, {server.error_count} errors")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
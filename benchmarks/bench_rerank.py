@@ -0,0 +1,69 @@
+import argparse, os, statistics, time
+
+import numpy as np
+
+from reranking import VECTOR_FIELD, duplicate_threshold, rerank
+from vector_backends import create_backend
+
+# Re-ranking cost and effect on the local NumPy backend, for several over-fetch factors:
+#
+#   before  vector_find(k) and a pandas DataFrame per query, as the demos did
+#   after   vector_find(k * overfetch) with the vectors, exact re-ranking with MMR, and records
+#
+# Queries are catalog vectors with some noise added, so each has a cluster of close models.
+# For every setting it prints the latency per query, the mean similarity between the bikes in the
+# top k (lower is more varied), the near-duplicate pairs in the top k and the overlap with the plain top k.
+#
+#   python -m benchmarks.bench_rerank --k 5,10 --overfetch 1,2,4,8
+
+VECTOR_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bikes_withVector.json')
+FIELDS = ["type", "brand", "model", "price", "description"]
+
+def top_k_stats(backend, row_of, results, threshold):
+    rows = backend.unit_rows([row_of[result['_id']] for result in results])
+    similarities = rows @ rows.T
+    pairs = similarities[np.triu_indices(len(rows), 1)]
+    return float(pairs.mean()) if len(pairs) else 0.0, int((pairs >= threshold).sum())
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact re-ranking of over-fetched vector results")
+    parser.add_argument('--vector-file', default=VECTOR_FILE)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', default='5,10')
+    parser.add_argument('--overfetch', default='1,2,4,8')
+    parser.add_argument('--mmr-lambda', type=float, default=0.7)
+    parser.add_argument('--noise', type=float, default=0.02)
+    args = parser.parse_args()
+
+    import pandas as pd
+    backend = create_backend('numpy', args.vector_file)
+    row_of = {document['_id']: row for row, document in enumerate(backend.documents)}
+    threshold = duplicate_threshold()
+    random = np.random.default_rng(0)
+    picked = random.choice(len(backend.documents), size=min(args.queries, len(backend.documents)), replace=False)
+    queries = backend.unit_rows(picked.tolist())
+    queries = queries + random.normal(0, args.noise, queries.shape).astype(np.float32)
+
+    print(f"catalog={len(backend.documents)} queries={len(queries)} mmr_lambda={args.mmr_lambda} duplicate_threshold={threshold}")
+    print(f"{'k':>4} {'overfetch':>9} {'us/query':>9} {'mean sim':>9} {'dup pairs':>10} {'overlap':>8}")
+    for k in [int(value) for value in args.k.split(',')]:
+        plain = [backend.vector_find(query, limit=k, fields=FIELDS) for query in queries]
+        start = time.perf_counter()
+        for query in queries:
+            pd.DataFrame(backend.vector_find(query, limit=k, fields=FIELDS))
+        before = (time.perf_counter() - start) / len(queries) * 1e6
+        stats = [top_k_stats(backend, row_of, results, threshold) for results in plain]
+        print(f"{k:>4} {'before':>9} {before:>9.0f} {statistics.mean(s[0] for s in stats):>9.4f} {sum(s[1] for s in stats):>10} {1.0:>8.2f}")
+        for overfetch in [int(value) for value in args.overfetch.split(',')]:
+            start = time.perf_counter()
+            reranked = []
+            for query in queries:
+                candidates = backend.vector_find(query, limit=k * overfetch, fields=FIELDS + [VECTOR_FIELD])
+                reranked.append(rerank(candidates, query, k, weight=args.mmr_lambda, threshold=threshold).records())
+            after = (time.perf_counter() - start) / len(queries) * 1e6
+            stats = [top_k_stats(backend, row_of, results, threshold) for results in reranked]
+            overlap = statistics.mean(len({r['_id'] for r in a} & {r['_id'] for r in b}) / k for a, b in zip(reranked, plain))
+            print(f"{k:>4} {overfetch:>9} {after:>9.0f} {statistics.mean(s[0] for s in stats):>9.4f} {sum(s[1] for s in stats):>10} {overlap:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse, hashlib, json, os, shutil, tempfile, time
+
+from sharded_ingest import run_sharded_pipeline
+from embeddings import model_id
+from benchmarks.mock_services import start_mock_server
+
+# Full-load throughput with 1, 2, 4, ... worker processes against the mock OpenAI endpoint.
+# Throughput grows with the shards while cores are free, and levels off at the mock's rate limit
+# (--rate-limit requests per second; each request carries up to EMBED_BATCH_SIZE rows).
+# The merged output file must be identical for every shard count.
+#
+#   python -m benchmarks.bench_sharded_ingest --rows 20000 --shards 1,2,4,8 --rate-limit 60
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bikes.json')
+
+def write_catalog(path, rows):
+    # The sample catalog repeated to `rows` bikes, each with a distinct description
+    with open(DATA_FILE) as f:
+        bikes = json.load(f)
+    with open(path, 'w') as f:
+        for i in range(rows):
+            bike = dict(bikes[i % len(bikes)])
+            bike['model'] = f"{bike['model']} {i}"
+            bike['description'] = f"{bike['description']} #{i}"
+            f.write(json.dumps(bike) + '\n')
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded multi-process ingest throughput")
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--shards', default='1,2,4,8')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--dimension', type=int, default=1536)
+    parser.add_argument('--rate-limit', type=float, default=0, help="Mock requests per second (0 for none)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_shards_')
+    catalog = os.path.join(directory, 'catalog.jsonl')
+    write_catalog(catalog, args.rows)
+    server, base_url = start_mock_server(latency=args.latency, dimension=args.dimension, rate_limit=args.rate_limit)
+    # The workers build their own clients from the environment; every vector is embedded, not cached
+    os.environ.update({'OPENAI_BASE_URL': base_url, 'OPENAI_API_KEY': 'mock', 'EMBED_CACHE_PATH': '',
+                       'OPENAI_RPM': str(args.rate_limit * 60 if args.rate_limit else 1000000)})
+    print(f"rows={args.rows} cores={os.cpu_count()} latency={args.latency}s dimension={args.dimension} rate_limit={args.rate_limit or 'none'}")
+    print(f"{'shards':>6} {'seconds':>8} {'rows/s':>8} {'speedup':>8} {'cpu s/shard':>12} {'throttled':>10}  output")
+    baseline, reference = None, None
+    try:
+        for shards in [int(value) for value in args.shards.split(',')]:
+            output = os.path.join(directory, f'out-{shards}.json')
+            throttled = server.throttled_count
+            start = time.perf_counter()
+            stats = run_sharded_pipeline(catalog, model_id, shards, output_path=output, chunk_size=args.chunk_size)
+            elapsed = time.perf_counter() - start
+            rate = args.rows / elapsed
+            baseline = baseline or rate
+            digest = file_digest(output)
+            reference = reference or digest
+            cpu = sum(shard['cpu_seconds'] for shard in stats['shards']) / shards
+            print(f"{shards:>6} {elapsed:>8.2f} {rate:>8.0f} {rate / baseline:>7.2f}x {cpu:>12.2f} {server.throttled_count - throttled:>10}"
+                  f"  {'identical' if digest == reference else 'DIFFERENT'}")
+            os.remove(output)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse, os, shutil, statistics, subprocess, sys, tempfile
+
+# Cold start cost of each entry point: the time to run the whole module in a fresh interpreter (imports,
+# load_dotenv, init_telemetry, the @task/@workflow decorators and the rest of the module-level code, but
+# not the __main__ block), with the heaviest modules taken from `python -X importtime`. It is measured once
+# per TELEMETRY_MODE, since the tracing modes load Traceloop at startup.
+#
+# Each entry point runs from a copy in a temporary directory, next to a stub .env that sets the mode and
+# placeholder credentials, so the developer's own .env is never read and nothing connects anywhere.
+# The Streamlit apps run their page code in bare mode, without a server.
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --runs 10 --top 15 --entry-points demo.py --modes off
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Target cold start in seconds. The Streamlit apps have to import streamlit itself, which dominates their budget.
+BUDGETS = {
+    'load_embeddings.py': 0.15,
+    'demo.py': 0.15,
+    'demo-ui.py': 1.0,
+    'demo-ui-chat.py': 1.0,
+}
+
+# Placeholders for the settings the entry points read at startup; port 9 (discard) refuses connections
+STUB_ENV = {
+    'ASTRA_DB_APPLICATION_TOKEN': 'stub', 'ASTRA_DB_API_ENDPOINT': 'http://127.0.0.1:9', 'ASTRA_COLLECTION': 'bikes',
+    'ASTRA_DB_TOKEN': 'stub', 'ASTRA_KEYSPACE': 'stub', 'OPENAI_API_KEY': 'stub', 'OPENAI_BASE_URL': 'http://127.0.0.1:9/v1',
+    'EMBED_CACHE_PATH': '', 'METRICS_PORT': '', 'METRICS_DUMP_FILE': '',
+}
+
+RUNNER = """import runpy, sys, time
+sys.argv = [sys.argv[1]]
+start = time.perf_counter()
+runpy.run_path(sys.argv[0], run_name='__bench__')
+print(time.perf_counter() - start)
+"""
+
+def stub_entry_point(directory, entry_point, mode):
+    # A copy of the entry point with a stub .env for TELEMETRY_MODE=mode; returns the copy's path
+    path = os.path.join(directory, entry_point)
+    shutil.copy(os.path.join(ROOT, entry_point), path)
+    with open(os.path.join(directory, '.env'), 'w') as f:
+        f.writelines(f"{name}={value}\n" for name, value in dict(STUB_ENV, TELEMETRY_MODE=mode).items())
+    return path
+
+def run_entry_point(path):
+    # Returns (seconds, importtime log) for one fresh interpreter
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUNNER, path], cwd=os.path.dirname(path),
+                            env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+def baseline_modules():
+    # Modules the bare interpreter imports at startup (site, encodings, ...), which no script can avoid
+    log = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import runpy, sys, time'], capture_output=True, text=True).stderr
+    return {name for _, name in parse_importtime(log)}
+
+def parse_importtime(log):
+    # (cumulative seconds, module) for every module imported directly by the code being run
+    entries = []
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two more spaces per level
+        if not name.startswith('  '):
+            entries.append((int(cumulative) / 1e6, name.strip()))
+    return entries
+
+def heaviest_modules(log, top, baseline):
+    entries = [(seconds, name) for seconds, name in parse_importtime(log) if name not in baseline]
+    return sorted(entries, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the entry points")
+    parser.add_argument('--entry-points', default=",".join(BUDGETS))
+    parser.add_argument('--modes', default='off,debug', help="TELEMETRY_MODE values to measure")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per entry point and mode; the median is reported")
+    parser.add_argument('--top', type=int, default=8, help="Heaviest modules to list per entry point")
+    args = parser.parse_args()
+
+    baseline = baseline_modules()
+    failed = False
+    for entry_point in args.entry_points.split(','):
+        for mode in args.modes.split(','):
+            label = f"{entry_point} ({mode})"
+            with tempfile.TemporaryDirectory(prefix='bench_startup_') as directory:
+                path = stub_entry_point(directory, entry_point, mode)
+                try:
+                    runs = [run_entry_point(path) for _ in range(args.runs)]
+                except ImportError as e:
+                    print(f"{label:<28} skipped: {e}")
+                    continue
+            seconds = statistics.median(run[0] for run in runs)
+            budget = BUDGETS.get(entry_point)
+            ok = budget is None or seconds <= budget
+            failed = failed or not ok
+            print(f"{label:<28} {seconds * 1000:8.1f} ms  budget {budget * 1000 if budget else float('nan'):6.0f} ms  {'PASS' if ok else 'FAIL'}")
+            for module_seconds, module in heaviest_modules(runs[-1][1], args.top, baseline):
+                print(f"    {module:<24} {module_seconds * 1000:8.1f} ms")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
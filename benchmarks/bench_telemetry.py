@@ -0,0 +1,58 @@
+import argparse, os, sys, timeit
+
+import telemetry
+
+# Per-call overhead of the @task decorator in each telemetry mode, compared with an undecorated call.
+#
+#   python -m benchmarks.bench_telemetry --calls 1000000
+#   python -m benchmarks.bench_telemetry --with-tracing     # also measure Traceloop (needs traceloop-sdk)
+
+def work(x):
+    return x + 1
+
+def decorate(mode):
+    os.environ['TELEMETRY_MODE'] = mode
+    return telemetry.task(name=f"bench {mode}")(work)
+
+def per_call_ns(fn, calls, repeat):
+    # Best of `repeat` runs, to keep scheduler noise out of the number
+    return min(timeit.repeat(lambda: fn(1), number=calls, repeat=repeat)) / calls * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Telemetry decorator overhead microbenchmark")
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--with-tracing', action='store_true', help="Also measure the production (Traceloop) mode")
+    parser.add_argument('--off-budget', type=float, default=0.1, help="Max overhead allowed for the off mode, as a fraction of an undecorated call")
+    args = parser.parse_args()
+
+    modes = ['off', 'metrics']
+    if args.with_tracing:
+        os.environ['TELEMETRY_MODE'] = 'production'
+        telemetry.init_telemetry(app_name="Telemetry Benchmark")
+        modes.append('production')
+
+    # Interleave the measurements and keep the best of each, so drift in CPU speed affects all of them alike
+    best = {mode: float('inf') for mode in ['undecorated'] + modes}
+    functions = {'undecorated': work, **{mode: decorate(mode) for mode in modes}}
+    for _ in range(args.repeat):
+        for mode, fn in functions.items():
+            best[mode] = min(best[mode], per_call_ns(fn, args.calls, 1))
+    baseline = best['undecorated']
+    costs = best
+    print(f"{'mode':<12} {'ns/call':>10} {'overhead ns':>12}")
+    print(f"{'undecorated':<12} {baseline:>10.1f} {0.0:>12.1f}")
+    overheads = {}
+    for mode in modes:
+        cost = costs[mode]
+        overheads[mode] = cost - baseline
+        print(f"{mode:<12} {cost:>10.1f} {overheads[mode]:>12.1f}")
+
+    # The off mode must hand back the original function, so there is nothing left to pay for
+    budget = baseline * args.off_budget
+    off_ok = decorate('off') is work and overheads['off'] <= budget
+    print(f"\noff mode {'PASS' if off_ok else 'FAIL'}: overhead {overheads['off']:.1f} ns (budget {budget:.1f} ns)")
+    sys.exit(0 if off_ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse, json, os, tempfile, time
+
+import numpy as np
+
+from vector_backends import NumpyBackend
+from vector_store import VECTOR_DTYPES, export_vector_store, iter_vector_file
+
+# JSON export versus the binary vector store: size on disk, time to a searchable backend,
+# query latency and how often the quantized stores return the same top k as float32.
+#
+#   python -m benchmarks.bench_vector_store --rows 20000 --dimension 1536
+
+def synthetic_records(rows, dimension, seed=0):
+    # Clustered unit vectors, so neighbours are not all at the same distance
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, rows // 50), dimension)).astype(np.float32)
+    for i in range(rows):
+        vector = centers[i % len(centers)] + 0.3 * rng.standard_normal(dimension).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        yield {'_id': i, 'model': f"Model {i}", 'brand': f"Brand {i % 40}", 'price': 500 + i % 3000,
+               'type': ['Road Bike', 'Mountain Bike', 'eBikes', 'Kids Bike'][i % 4],
+               'description': f"Synthetic bike number {i} for the vector store benchmark.",
+               'embedding': vector.tolist()}
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def query_latency(backend, queries, k):
+    start = time.perf_counter()
+    results = [[row['_id'] for row in backend.vector_find(query, limit=k, fields=['_id'])] for query in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON export versus binary vector store")
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--dimension', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'bikes_withVector.jsonl')
+        with open(json_path, 'w') as f:
+            for record in synthetic_records(args.rows, args.dimension):
+                f.write(json.dumps(record) + '\n')
+        rng = np.random.default_rng(1)
+        queries = [np.asarray(vector, dtype=np.float32) + 0.05 * rng.standard_normal(args.dimension).astype(np.float32)
+                   for vector in (record['embedding'] for record in synthetic_records(args.queries, args.dimension, seed=2))]
+
+        print(f"{'format':<10} {'size MB':>9} {'open ms':>9} {'query ms':>9} {'same top k':>11}")
+        start = time.perf_counter()
+        backend = NumpyBackend.from_file(json_path)
+        open_seconds = time.perf_counter() - start
+        seconds, reference = query_latency(backend, queries, args.k)
+        print(f"{'json':<10} {directory_size(json_path) / 1e6:9.1f} {open_seconds * 1000:9.1f} {seconds * 1000:9.2f} {'':>11}")
+
+        for dtype in VECTOR_DTYPES:
+            store_path = os.path.join(tmp, dtype)
+            export_vector_store(iter_vector_file(json_path), store_path, dtype)
+            start = time.perf_counter()
+            backend = NumpyBackend.from_file(store_path)
+            open_seconds = time.perf_counter() - start
+            seconds, results = query_latency(backend, queries, args.k)
+            overlap = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(reference, results)])
+            print(f"{dtype:<10} {directory_size(store_path) / 1e6:9.1f} {open_seconds * 1000:9.1f} {seconds * 1000:9.2f} {overlap:11.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import json, random, threading, time, uuid, zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Local stand-ins for the remote services so the scripts can be measured offline.
+# One server answers both:
+#   - the OpenAI embeddings, completions (optionally streamed) and chat completions APIs under /v1
+#   - the Astra Data API (findCollections, createCollection, find with $vector sort, insertMany, ...)
+#     under /api/json/v1/<namespace>[/<collection>]
+# Latency, error rates and OpenAI rate limits (429 responses) are injected per request, so retries,
+# backoff and tail latency can be exercised. Completions can also take time per prompt word, so
+# longer prompts answer more slowly.
+
+@lru_cache(maxsize=100000)
+def fake_embedding(text, dimension):
+    # Deterministic pseudo-random unit vector for a text
+    rng = random.Random(zlib.crc32(text.encode('utf-8')))
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimension)]
+    norm = sum(value * value for value in vector) ** 0.5
+    return [value / norm for value in vector]
+
+def prompt_words(prompt):
+    return len(prompt.split())
+
+def fake_completion(prompt, max_tokens):
+    # A short deterministic answer, one "token" per word
+    words = ["This", "bike", "is", "a", "great", "fit", "because", "it", "is", "light,", "sturdy",
+             "and", "comfortable", "for", "the", "kind", "of", "riding", "you", "described."]
+    rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+    count = min(max_tokens or 16, 8 + rng.randrange(len(words)))
+    return [words[i % len(words)] + " " for i in range(count)]
+
+class MockCollection:
+    def __init__(self, options=None):
+        self.options = options or {}
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def matching(self, filter):
+        def matches(document):
+            for field, condition in (filter or {}).items():
+                value = document.get(field)
+                if isinstance(condition, dict):
+                    if '$in' in condition and value not in condition['$in']:
+                        return False
+                    if '$eq' in condition and value != condition['$eq']:
+                        return False
+                elif value != condition:
+                    return False
+            return True
+        return [document for document in self.documents.values() if matches(document)]
+
+    @staticmethod
+    def project(document, projection, similarity=None):
+        if projection:
+            result = {'_id': document['_id']}
+            result.update({field: document[field] for field, include in projection.items() if include and field in document})
+        else:
+            result = dict(document)
+        if similarity is not None:
+            result['$similarity'] = similarity
+        return result
+
+    def find(self, body):
+        options = body.get('options') or {}
+        projection = body.get('projection')
+        sort = body.get('sort') or {}
+        with self.lock:
+            documents = self.matching(body.get('filter'))
+        if '$vector' in sort:
+            limit = int(options.get('limit') or 20)
+            documents = [document for document in documents if '$vector' in document]
+            if not documents:
+                return {'data': {'documents': [], 'nextPageState': None}}
+            query = np.asarray(sort['$vector'], dtype=np.float32)
+            matrix = np.asarray([document['$vector'] for document in documents], dtype=np.float32)
+            scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+            best = np.argsort(-scores)[:limit]
+            include = options.get('includeSimilarity')
+            return {'data': {'documents': [
+                self.project(documents[i], projection, float((1 + scores[i]) / 2) if include else None) for i in best
+            ], 'nextPageState': None}}
+        # Plain find: pages of 20 documents, paging state is the offset
+        start = int(options.get('pagingState') or 0)
+        page = documents[start:start + 20]
+        next_state = str(start + 20) if start + 20 < len(documents) else None
+        return {'data': {'documents': [self.project(document, projection) for document in page], 'nextPageState': next_state}}
+
+    def find_one(self, body):
+        with self.lock:
+            documents = self.matching(body.get('filter'))
+        return {'data': {'document': self.project(documents[0], body.get('projection')) if documents else None}}
+
+    def insert_many(self, body):
+        inserted = []
+        errors = []
+        with self.lock:
+            for document in body['documents']:
+                document = dict(document)
+                document.setdefault('_id', str(uuid.uuid4()))
+                if document['_id'] in self.documents:
+                    errors.append({'message': "Document already exists with the given _id", 'errorCode': 'DOCUMENT_ALREADY_EXISTS'})
+                    continue
+                self.documents[document['_id']] = document
+                inserted.append(document['_id'])
+        response = {'status': {'insertedIds': inserted}}
+        if errors:
+            response['errors'] = errors
+        return response
+
+    def delete_many(self, body):
+        with self.lock:
+            documents = self.matching(body.get('filter'))
+            for document in documents:
+                del self.documents[document['_id']]
+        return {'status': {'deletedCount': len(documents)}}
+
+    def find_one_and_replace(self, body):
+        with self.lock:
+            documents = self.matching(body.get('filter'))
+            replacement = dict(body['replacement'])
+            if documents:
+                replacement['_id'] = documents[0]['_id']
+            elif not (body.get('options') or {}).get('upsert'):
+                return {'data': {'document': None}, 'status': {'matchedCount': 0, 'modifiedCount': 0}}
+            replacement.setdefault('_id', str(uuid.uuid4()))
+            self.documents[replacement['_id']] = replacement
+        return {'data': {'document': replacement}, 'status': {'matchedCount': len(documents[:1]), 'modifiedCount': 1}}
+
+    def update_one(self, body):
+        # Only $set is used here
+        with self.lock:
+            documents = self.matching(body.get('filter'))
+            if documents:
+                documents[0].update(body['update'].get('$set', {}))
+        return {'status': {'matchedCount': len(documents[:1]), 'modifiedCount': len(documents[:1])}}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        # Once per connection: stands in for the TCP and TLS handshake of a real endpoint
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+        super().setup()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def inject(self, latency):
+        # Sleep for the configured latency (with jitter) and maybe fail the request.
+        # Returns True when an error response was sent.
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        if latency:
+            time.sleep(max(0.0, random.gauss(latency, latency * server.jitter)))
+        if server.error_rate and random.random() < server.error_rate:
+            with server.lock:
+                server.error_count += 1
+            self.send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return True
+        return False
+
+    def throttle(self):
+        # OpenAI-style rate limiting: over rate_limit requests per second, or at random with
+        # throttle_rate, the request gets a 429. Returns True when it did.
+        server = self.server
+        if server.quota_exhausted:
+            with server.lock:
+                server.request_count += 1
+            self.send_json(429, {"error": {"message": "You exceeded your current quota", "type": "insufficient_quota",
+                                           "code": "insufficient_quota"}})
+            return True
+        with server.lock:
+            now = time.monotonic()
+            limited = False
+            if server.rate_limit:
+                server.rate_tokens = min(server.rate_limit, server.rate_tokens + (now - server.rate_updated) * server.rate_limit)
+                server.rate_updated = now
+                if server.rate_tokens >= 1:
+                    server.rate_tokens -= 1
+                else:
+                    limited = True
+                    retry_ms = int((1 - server.rate_tokens) / server.rate_limit * 1000) + 1
+            if not limited and server.throttle_rate and random.random() < server.throttle_rate:
+                limited = True
+                retry_ms = None
+            if limited:
+                server.throttled_count += 1
+        if not limited:
+            return False
+        headers = {'retry-after-ms': str(retry_ms)} if retry_ms else {}
+        self.send_json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests",
+                                       "code": "rate_limit_exceeded"}}, headers)
+        return True
+
+    def do_GET(self):
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_HEAD(self):
+        # Used to pre-warm connections; like the real endpoints, the connection is kept open
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.path.startswith('/v1/'):
+            if self.throttle() or self.inject(self.server.openai_latency):
+                return
+            self.handle_openai(self.path[len('/v1/'):].rstrip('/'), body)
+        elif self.path.startswith('/api/json/v1/'):
+            if self.inject(self.server.astra_latency):
+                return
+            self.handle_astra(self.path[len('/api/json/v1/'):].strip('/').split('/'), body)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def handle_openai(self, endpoint, body):
+        server = self.server
+        if endpoint == 'embeddings':
+            inputs = body['input']
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            data = [
+                {"object": "embedding", "index": index, "embedding": fake_embedding(text, server.dimension)}
+                for index, text in enumerate(inputs)
+            ]
+            tokens = sum(len(text.split()) for text in inputs)
+            self.send_json(200, {
+                "object": "list",
+                "data": data,
+                "model": body.get('model'),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+        elif endpoint == 'completions':
+            prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+            if body.get('stream'):
+                self.stream_completion(body, prompts[0])
+                return
+            choices = []
+            for index, prompt in enumerate(prompts):
+                tokens = fake_completion(prompt, body.get('max_tokens'))
+                time.sleep(server.prompt_token_latency * prompt_words(prompt) + server.token_latency * len(tokens))
+                choices.append({"index": index, "text": ''.join(tokens), "finish_reason": "stop", "logprobs": None})
+            words = sum(prompt_words(prompt) for prompt in prompts)
+            self.send_json(200, {
+                "id": "cmpl-mock", "object": "text_completion", "created": int(time.time()), "model": body.get('model'),
+                "choices": choices,
+                "usage": {"prompt_tokens": words, "completion_tokens": 1, "total_tokens": words + 1},
+            })
+        elif endpoint == 'chat/completions':
+            prompt = ' '.join(str(message.get('content')) for message in body['messages'])
+            tokens = fake_completion(prompt, body.get('max_tokens'))
+            time.sleep(server.prompt_token_latency * prompt_words(prompt) + server.token_latency * len(tokens))
+            self.send_json(200, {
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": body.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ''.join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_words(prompt), "completion_tokens": 1, "total_tokens": prompt_words(prompt) + 1},
+            })
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {endpoint}", "type": "invalid_request_error"}})
+
+    def stream_completion(self, body, prompt):
+        # Server-sent events, one token per event, sent with chunked encoding so the connection stays open
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # The prompt is read before the first token
+        time.sleep(self.server.prompt_token_latency * prompt_words(prompt))
+
+        def send_chunk(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        for token in fake_completion(prompt, body.get('max_tokens')):
+            time.sleep(self.server.token_latency)
+            event = {"id": "cmpl-mock", "object": "text_completion", "created": int(time.time()), "model": body.get('model'),
+                     "choices": [{"index": 0, "text": token, "finish_reason": None, "logprobs": None}]}
+            send_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+        send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def handle_astra(self, parts, body):
+        server = self.server
+        command, payload = next(iter(body.items()))
+        if len(parts) == 1:
+            # Namespace level commands
+            if command == 'findCollections':
+                explain = ((payload or {}).get('options') or {}).get('explain')
+                with server.lock:
+                    names = list(server.collections)
+                    collections = [{'name': name, 'options': server.collections[name].options} for name in names] if explain else names
+                self.send_json(200, {'status': {'collections': collections}})
+            elif command == 'createCollection':
+                with server.lock:
+                    server.collections.setdefault(payload['name'], MockCollection(payload.get('options')))
+                self.send_json(200, {'status': {'ok': 1}})
+            elif command == 'deleteCollection':
+                with server.lock:
+                    server.collections.pop(payload['name'], None)
+                self.send_json(200, {'status': {'ok': 1}})
+            else:
+                self.send_json(200, {'errors': [{'message': f"Unsupported command {command}"}]})
+            return
+
+        with server.lock:
+            collection = server.collections.get(parts[1])
+        if collection is None:
+            self.send_json(200, {'errors': [{'message': f"Collection {parts[1]} does not exist", 'errorCode': 'COLLECTION_NOT_EXIST'}]})
+            return
+        handlers = {
+            'find': collection.find,
+            'findOne': collection.find_one,
+            'insertMany': collection.insert_many,
+            'deleteMany': collection.delete_many,
+            'findOneAndReplace': collection.find_one_and_replace,
+            'updateOne': collection.update_one,
+        }
+        if command not in handlers:
+            self.send_json(200, {'errors': [{'message': f"Unsupported command {command}"}]})
+            return
+        self.send_json(200, handlers[command](payload or {}))
+
+def start_mock_server(handler=MockHandler, latency=0.0, dimension=1536, astra_latency=None,
+                      token_latency=0.0, error_rate=0.0, jitter=0.0, connect_latency=0.0, rate_limit=0.0, throttle_rate=0.0,
+                      prompt_token_latency=0.0, quota_exhausted=False):
+    # Start a server on a free local port in a background thread.
+    # Returns the server and the OpenAI base URL; the Astra API endpoint is server.astra_endpoint.
+    # Call server.shutdown() when done.
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.openai_latency = latency
+    server.astra_latency = latency if astra_latency is None else astra_latency
+    server.token_latency = token_latency
+    # Seconds per word of a completion prompt, spent before the first token
+    server.prompt_token_latency = prompt_token_latency
+    server.connect_latency = connect_latency
+    server.error_rate = error_rate
+    server.jitter = jitter
+    server.dimension = dimension
+    server.request_count = 0
+    server.error_count = 0
+    # OpenAI rate limit in requests per second (0 for none), as a token bucket holding one second of requests
+    server.rate_limit = rate_limit
+    server.rate_tokens = rate_limit
+    server.rate_updated = time.monotonic()
+    server.throttle_rate = throttle_rate
+    # Every OpenAI request gets the 429 of an account out of credit, which a retry cannot fix
+    server.quota_exhausted = quota_exhausted
+    server.throttled_count = 0
+    server.collections = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    server.astra_endpoint = f"http://{host}:{port}"
+    return server, f"http://{host}:{port}/v1"
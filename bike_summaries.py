@@ -0,0 +1,117 @@
+import re
+
+from embeddings import count_tokens
+
+# Compact forms of a bike for LLM prompts, computed once at ingest and stored with the vector:
+#
+#   summary      the most informative sentences of the description, at most SUMMARY_TOKENS tokens
+#   attributes   the key facts as a flat record: type, price, wheel size, frame, gears, brakes, ...
+#
+# The summary is extractive (sentences of the description, picked by what they say about the bike),
+# so it costs no completion at ingest and never states anything the description does not.
+
+SUMMARY_TOKENS = 40
+# Model whose tokenizer bounds the summaries: the completion model that reads them
+SUMMARY_MODEL = 'gpt-3.5-turbo-instruct'
+SUMMARY_FIELD = 'summary'
+ATTRIBUTES_FIELD = 'attributes'
+
+# (attribute, pattern). Where a pattern has a `value` group, that part of the match is the value.
+# A frame material only counts next to the word "frame", so a carbon fork does not make a carbon frame.
+FRAME_MATERIALS = r'(?:aluminium|aluminum)(?: alloy)?|alloy|carbon(?: fiber| fibre)?|chromoly|steel|titanium'
+ATTRIBUTE_PATTERNS = [
+    ('wheel_size', r'\b\d{2}(?:\.\d)?(?:\s?-?\s?inch\b|")'),
+    ('frame', rf'\b(?P<value>{FRAME_MATERIALS})\s+(?:[\w-]+\s+){{0,2}}?frame\b'
+              rf'|\bframe\b(?:(?!fork)[^.;!?]){{0,60}}?\b(?P<after>{FRAME_MATERIALS})\b'),
+    ('gears', r'\b(?:single[- ]speed|\d{1,2}[- ]speed)\b'),
+    ('brakes', r'\b(?:hydraulic disc brakes?|disc brakes?|coaster brakes?|rim brakes?|v-brakes?)\b'),
+    ('suspension', r'\b(?:full suspension|front suspension|suspension fork|hardtail|rigid fork)\b'),
+    ('motor', r'\b\d{3,4}\s?(?:w|watts?)\b'),
+    ('range', r'\b\d{1,3}\s?(?:miles|km)\b'),
+    ('weight', r'\b\d{1,2}(?:\.\d)?\s?(?:kg|lbs?|pounds)\b'),
+]
+ATTRIBUTE_REGEXES = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in ATTRIBUTE_PATTERNS]
+# Sentences that say what a bike is not ("Don't ride the trail on a hardtail!") state no facts about it
+NEGATION = re.compile(r"\b(?:not|no|never|without|instead of|rather than|unlike|don[’']?t|doesn[’']?t|isn[’']?t|won[’']?t)\b", re.IGNORECASE)
+
+def attribute_value(match):
+    value = match.group('value') or match.group('after') if 'value' in match.re.groupindex else match.group(0)
+    value = re.sub(r'[\s-]+', ' ', value.lower().replace('"', ' inch')).strip()
+    return value.replace('aluminium', 'aluminum').replace('fibre', 'fiber')
+
+def agreed_value(values):
+    # The one value all mentions agree on, the most specific wording of it ("hydraulic disc brakes"
+    # over "disc brake"), or None when the description names different ones (27.5 and 24 inch)
+    values = sorted(set(values), key=len, reverse=True)
+    stems = [value.rstrip('s') for value in values]
+    if all(stem in stems[0] for stem in stems[1:]):
+        return values[0]
+    return None
+
+def extract_attributes(bike):
+    # {'type': ..., 'price': ..., 'wheel_size': '12 inch', 'frame': 'aluminum', ...}; missing facts are left out,
+    # and so are facts that only appear in negated sentences or that the description contradicts
+    attributes = {field: bike[field] for field in ('type', 'price') if bike.get(field) not in (None, '')}
+    sentences = [sentence for sentence in split_sentences(bike.get('description') or '') if not NEGATION.search(sentence)]
+    for name, regex in ATTRIBUTE_REGEXES:
+        values = [attribute_value(match) for sentence in sentences for match in regex.finditer(sentence)]
+        value = agreed_value(values) if values else None
+        if value:
+            attributes[name] = value
+    return attributes
+
+def format_attributes(bike, attributes=None):
+    # "Coaster Ripper: Kids bikes, $320, 20 inch, aluminum frame"
+    attributes = dict(attributes if attributes is not None else extract_attributes(bike))
+    facts = [str(attributes.pop('type'))] if 'type' in attributes else []
+    if 'price' in attributes:
+        facts.append(f"${attributes.pop('price')}")
+    facts.extend(f"{value} frame" if name == 'frame' else str(value) for name, value in attributes.items())
+    return f"{bike.get('brand', '')} {bike.get('model', '')}".strip() + (': ' + ', '.join(facts) if facts else '')
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in re.split(r'(?<=[.!?])\s+', text.strip()) if sentence.strip()]
+
+def truncate_tokens(text, max_tokens, model=SUMMARY_MODEL):
+    # Cut text at a word boundary so it fits in max_tokens
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(' '.join(words[:middle]) + '...', model) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return ' '.join(words[:low]).rstrip(',;:') + '...' if low else ''
+
+def summarize(bike, max_tokens=SUMMARY_TOKENS, model=SUMMARY_MODEL):
+    # The sentences that carry the most facts about the bike, in their original order, within max_tokens.
+    # The first sentence usually says what the bike is for, so it is preferred on a tie.
+    sentences = split_sentences(bike.get('description') or '')
+    if not sentences:
+        return ''
+    names = {word.lower() for field in ('brand', 'model') for word in str(bike.get(field, '')).split()}
+
+    def score(position, sentence):
+        facts = sum(1 for _, regex in ATTRIBUTE_REGEXES if regex.search(sentence))
+        mentions = sum(1 for word in re.findall(r'\w+', sentence.lower()) if word in names)
+        return (facts + min(mentions, 1) + (1.5 if position == 0 else 0.0), -position)
+
+    ranked = sorted(enumerate(sentences), key=lambda item: score(*item), reverse=True)
+    chosen, used = [], 0
+    for position, sentence in ranked:
+        tokens = count_tokens(sentence, model)
+        if used + tokens <= max_tokens:
+            chosen.append(position)
+            used += tokens
+    if not chosen:
+        return truncate_tokens(ranked[0][1], max_tokens, model)
+    return ' '.join(sentences[position] for position in sorted(chosen))
+
+def add_compact_fields(record, max_tokens=SUMMARY_TOKENS, model=SUMMARY_MODEL):
+    # Ingest stage: store the summary and attribute record next to the description
+    record[SUMMARY_FIELD] = summarize(record, max_tokens, model)
+    record[ATTRIBUTES_FIELD] = extract_attributes(record)
+    return record
@@ -0,0 +1,145 @@
+import glob, hashlib, json, os, time
+
+# Where the loader reads the bike catalog from, as a stream of records.
+#
+#   DATA_SOURCE=data/bikes.json        a local file (the copy in this repository by default)
+#   DATA_SOURCE=catalog/*.jsonl        a glob; matching files are read in name order
+#   DATA_SOURCE=https://.../bikes.json a URL, downloaded once into DATA_CACHE_DIR and afterwards only
+#                                      revalidated (ETag / Last-Modified), so an unchanged file is
+#                                      never fetched again; the cached copy is used when offline
+#
+# Several sources can be given, separated by commas. Files are parsed incrementally, whether they
+# hold a JSON array or one record per line (JSONL), so memory use does not depend on their size.
+
+DEFAULT_DATA_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bikes.json')
+DEFAULT_CACHE_DIR = '.data_cache'
+READ_SIZE = 1 << 16
+
+def iter_json_records(f, read_size=READ_SIZE):
+    # Records of a text stream holding a JSON array or JSONL, decoded one at a time.
+    # Only the record being decoded and one read ahead are held in memory.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def skip(chars):
+        nonlocal position
+        while position < len(buffer) and buffer[position] in chars:
+            position += 1
+
+    # The first character tells an array from JSONL
+    while position == len(buffer) and not eof:
+        more = f.read(read_size)
+        buffer, position, eof = more, 0, not more
+        skip(' \t\r\n')
+    array = position < len(buffer) and buffer[position] == '['
+    if array:
+        position += 1
+    while True:
+        skip(' \t\r\n,' if array else ' \t\r\n')
+        if position == len(buffer) and not eof:
+            # Out of buffered text: drop what was consumed and read on
+            buffer, position = buffer[position:] + f.read(read_size), 0
+            eof = position == len(buffer)
+            continue
+        if position == len(buffer):
+            if array:
+                raise ValueError("JSON array is not closed")
+            return
+        if array and buffer[position] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            record, end = None, None
+        # A record that reaches the end of the buffer may be incomplete (a number cut short), so read on
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError(f"Invalid JSON record at character {position} of the buffered text")
+            # Read at least as much again as is buffered, so a large record is decoded a bounded number of times
+            more = f.read(max(read_size, len(buffer) - position))
+            buffer, position = buffer[position:] + more, 0
+            eof = not more
+            continue
+        yield record
+        position = end
+
+def iter_file_records(path):
+    # utf-8-sig also accepts files written with a byte order mark
+    with open(path, encoding='utf-8-sig') as f:
+        yield from iter_json_records(f)
+
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+def fetch_cached(url, cache_dir=None, timeout=60):
+    # Local path of an up-to-date copy of url. A cached copy is revalidated with If-None-Match /
+    # If-Modified-Since and only downloaded again when the server has a newer one.
+    import requests
+    cache_dir = cache_dir or os.getenv('DATA_CACHE_DIR', DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '-' + (os.path.basename(url.split('?')[0]) or 'data')
+    path = os.path.join(cache_dir, name)
+    meta_path = path + '.meta.json'
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    except requests.RequestException as error:
+        if meta:
+            print(f"Could not reach {url} ({error}); using the cached copy from {time.ctime(meta['fetched'])}")
+            return path
+        raise
+    with response:
+        if response.status_code == 304 and meta:
+            return path
+        response.raise_for_status()
+        # Streamed to a temporary file and renamed, so an interrupted download never replaces a good copy
+        with open(path + '.tmp', 'wb') as f:
+            for block in response.iter_content(READ_SIZE):
+                f.write(block)
+        os.replace(path + '.tmp', path)
+    with open(meta_path, 'w') as f:
+        json.dump({'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                   'fetched': time.time()}, f)
+    return path
+
+class DataSource:
+    # Records of one or more sources. Iterating again reads the files again, so the loader can make
+    # several passes (records, then the facet catalog) without keeping the catalog in memory.
+    def __init__(self, spec=None, cache_dir=None):
+        spec = spec or os.getenv('DATA_SOURCE') or DEFAULT_DATA_SOURCE
+        self.sources = [source.strip() for source in spec.split(',') if source.strip()]
+        self.cache_dir = cache_dir
+        self._paths = None
+
+    def paths(self):
+        # Local files to read, in order; remote sources are fetched (or revalidated) once per DataSource
+        if self._paths is None:
+            paths = []
+            for source in self.sources:
+                if is_url(source):
+                    paths.append(fetch_cached(source, self.cache_dir))
+                    continue
+                matches = sorted(glob.glob(source)) if glob.has_magic(source) else [source]
+                matches = [match for match in matches if os.path.isfile(match)]
+                if not matches:
+                    raise FileNotFoundError(f"No data file matches {source}")
+                paths.extend(matches)
+            self._paths = paths
+        return self._paths
+
+    def __iter__(self):
+        for path in self.paths():
+            yield from iter_file_records(path)
+
+    def __repr__(self):
+        return f"DataSource({', '.join(self.sources)})"
@@ -1,40 +1,39 @@
-from cassandra.cluster import Cluster
-from cassandra.auth import PlainTextAuthProvider
-from cassandra.query import dict_factory, SimpleStatement
-import openai, os, uuid, time, requests, traceback
-from traceloop.sdk import Traceloop
-from traceloop.sdk.tracing import tracing as Tracer
-from traceloop.sdk.decorators import workflow, task, agent
+import openai, os, time, traceback, asyncio
+from telemetry import init_telemetry, workflow, task
 from dotenv import load_dotenv, find_dotenv
-import pandas as pd
 import streamlit as st
-from langchain.llms import OpenAI
+
+from query_pipeline import BackgroundRun, connect_and_embed, in_script_thread, merge_by_score
+from filters import split_types
+from facet_catalog import get_facet_catalog, normalize_type_filter
+
+# The Cassandra cluster driver, pandas and numpy are imported on first use, to keep the cold start fast
 
 # Load the .env file
 if not load_dotenv(find_dotenv(),override=True):
     raise Exception("Couldn't load .env file")
 
 #Add Telemetry
-TRACELOOP_API_KEY=os.getenv('TRACELOOP_API_KEY')
-Traceloop.init(app_name="Bike Recommendation App", disable_batch=True)
-# Generate a UUID
-uuid_obj = str(uuid.uuid4())
-Tracer.set_correlation_id(uuid_obj)
+init_telemetry(app_name="Bike Recommendation App")
 
 #declare constant
 ASTRA_DB_SECURE_BUNDLE_PATH=os.getenv('ASTRA_SECUREBUNDLE_PATH')
 ASTRA_DB_APPLICATION_TOKEN=os.getenv('ASTRA_DB_TOKEN')
 ASTRA_DB_KEYSPACE=os.getenv('ASTRA_KEYSPACE')
 k=os.getenv('LIMIT_TOP_K')
+# Rows per page for the ANN queries; later pages are fetched while the rows are read
+CQL_FETCH_SIZE=int(os.getenv('CQL_FETCH_SIZE', '100'))
 openai.api_key = os.getenv('OPENAI_API_KEY')
 model_id = "text-embedding-ada-002"
-llm = OpenAI(openai_api_key=os.environ['OPENAI_API_KEY'], temperature=0.1)
 
 @st.cache_resource()
 @task(name="Create Cassandra Connection")
 def create_connection():
     #Establish Connectivity
     st.write(":hourglass: Establishing AstraDB Connection...")
+    from cassandra.cluster import Cluster
+    from cassandra.auth import PlainTextAuthProvider
+    from cassandra.query import dict_factory
     cluster = Cluster(
     cloud={
         "secure_connect_bundle": ASTRA_DB_SECURE_BUNDLE_PATH,
@@ -45,6 +44,8 @@ def create_connection():
     ),
     )
     session = cluster.connect()
+    # Rows as dicts, for the DataFrame and the per-type merge
+    session.row_factory = dict_factory
     keyspace = ASTRA_DB_KEYSPACE
     return session, keyspace
 
@@ -58,6 +59,10 @@ def embed_query(customer_input):
 
 @task(name="Ask ChatGPT to Generate a Professional Recommendation")
 def create_display_cgpt_response(bikes_results, customer_input):
+    st.write("Generating Bike recommendations Using ChatGPT...")
+    st.write(request_cgpt_response(bikes_results, customer_input))
+
+def request_cgpt_response(bikes_results, customer_input):
     bike_desc_prompts=[]
 
     # With the role as 'system',  we tell the model how we want it to behave and tell it how its personality and type of response should be.
@@ -68,57 +73,105 @@ def create_display_cgpt_response(bikes_results, customer_input):
     answers_list = []
     
     # With the role as 'assistant',  load the results from Astra with Vector Search.  That helps the model to provide answer to the question asked by user.
-    
-    for index, row in bikes_results.iterrows():
-        answers_list.append({'role': "assistant", "content": f"{row['description']}"})
+    # The bikes are given as attribute lines and summaries filling PROMPT_CONTEXT_TOKENS, best matches first,
+    # instead of every full description; bikes that no longer fit are left out.
+    from prompt_builder import build_bike_contexts
+    contexts, _, _ = build_bike_contexts([row for _, row in bikes_results.iterrows()], model="gpt-3.5-turbo")
+    for context in contexts:
+        if context is not None:
+            answers_list.append({'role': "assistant", "content": context})
     
     bike_desc_prompts.extend(answers_list)
     bike_desc_prompts.append({"role": "assistant", "content":"Here's my answer to your question."})
     
-    st.write("Generating Bike recommendations Using ChatGPT...")
-    
     completion = openai.ChatCompletion.create(
         model="gpt-3.5-turbo",
         messages=bike_desc_prompts
         )
     
-    st.write(completion.choices[0].message['content'])
+    return completion.choices[0].message['content']
+
 
+@st.cache_resource()
+def prepare_statements(_session, keyspace):
+    # Prepared once per keyspace and reused by every query; the vector, type and limit are bound
+    # as typed parameters, so the server does not re-parse the query and the type cannot inject CQL
+    statements = {
+        'simple': _session.prepare(
+            f"SELECT * FROM {keyspace}.bikes ORDER BY description_embedding ANN OF ? LIMIT ?"
+        ),
+        'hybrid': _session.prepare(
+            f"SELECT * FROM {keyspace}.bikes WHERE type : ? ORDER BY description_embedding ANN OF ? LIMIT ?"
+        ),
+    }
+    for statement in statements.values():
+        statement.fetch_size = CQL_FETCH_SIZE
+    return statements
+
+@st.cache_resource()
+def primary_key(_session, keyspace):
+    # The primary-key columns of the bikes table, from the driver's schema metadata.
+    # A bike found by several per-type queries has the same key in each.
+    table = _session.cluster.metadata.keyspaces[keyspace].tables['bikes']
+    return tuple(column.name for column in table.primary_key)
 
 @task(name="Build top k simple query")
-def build_simple_query(customer_input, keyspace, k):
+def build_simple_query(customer_input, session, keyspace, k, embedding=None):
     st.write(":hourglass: Building Simple Database Query...")
-    embedding = embed_query(customer_input)
-    query = SimpleStatement(
-    f"""
-    SELECT *
-    FROM {keyspace}.bikes
-    ORDER BY description_embedding ANN OF {embedding} LIMIT {k};
-    """
-    )
+    # The embedding may already have been computed alongside the connection warm-up
+    if embedding is None:
+        embedding = embed_query(customer_input)
+    query = prepare_statements(session, keyspace)['simple'].bind([embedding, int(k)])
     return query
 
 @task(name="Build top k hybrid query")
-def build_hybrid_query(customer_input, keyspace, filter, k):
+def build_hybrid_query(customer_input, session, keyspace, filter, k, embedding=None):
     st.write(":hourglass: Building Hybrid Search Query...")
-    embedding = embed_query(customer_input)
-    hybrid_query = SimpleStatement(
-    f"""
-    SELECT *
-    FROM {keyspace}.bikes
-    WHERE type : '{filter}'
-    ORDER BY description_embedding ANN OF {embedding} LIMIT {k};
-    """
-    )
+    # The embedding may already have been computed alongside the connection warm-up
+    if embedding is None:
+        embedding = embed_query(customer_input)
+    hybrid_query = prepare_statements(session, keyspace)['hybrid'].bind([filter, embedding, int(k)])
     return hybrid_query
 
+def fetch_rows(future):
+    # Iterating the result set pages through the rows; the driver fetches the next page when the current one is used up
+    return list(future.result())
+
 @task(name="Perform ANN search on Astra DB")
-def query_astra_db(session, query):
+def query_astra_db(session, queries):
     st.write(":hourglass: Retrieving results from Astra DB...")
-    results = session.execute(query)
-    top_results = results._current_rows
-    bikes_results = pd.DataFrame(top_results)
-    return bikes_results
+    # Send every statement before reading any result, so the ANN queries are in flight at the same time
+    futures = [session.execute_async(query) for query in queries]
+    return [fetch_rows(future) for future in futures]
+
+@task(name="Retrieve results for each Bike Type")
+def retrieve_results(session, keyspace, customer_input, filter, k, embedding):
+    # With several comma-separated bike types, run one hybrid query per type concurrently
+    # and keep the k rows closest to the query embedding
+    import pandas as pd
+    types = split_types(filter)
+    if types:
+        queries = [build_hybrid_query(customer_input, session, keyspace, value, k, embedding) for value in types]
+    else:
+        queries = [build_simple_query(customer_input, session, keyspace, k, embedding)]
+    result_lists = query_astra_db(session, queries)
+    if len(result_lists) == 1:
+        return pd.DataFrame(result_lists[0])
+
+    import numpy as np
+    query_vector = np.asarray(embedding, dtype=np.float32)
+    def score(row):
+        row_vector = np.asarray(row['description_embedding'], dtype=np.float32)
+        return float(row_vector @ query_vector / (np.linalg.norm(row_vector) * np.linalg.norm(query_vector)))
+    return pd.DataFrame(merge_by_score(result_lists, k, score, key=primary_key(session, keyspace)))
+
+@task(name="Display Results and Recommendation")
+def display_results(bikes_results, customer_input):
+    # Send the chat completion first, then render the table while it is generated
+    generation = BackgroundRun(lambda emit: asyncio.to_thread(request_cgpt_response, bikes_results, customer_input))
+    create_display_table(bikes_results)
+    st.write("Generating Bike recommendations Using ChatGPT...")
+    st.write(generation.drain())
 
 @task(name="Build table with Bike Reco Results")
 def create_display_table(bikes_results):
@@ -138,6 +191,19 @@ def create_display_table(bikes_results):
         hide_index=True,
         )
 
+@task(name="Check type filter")
+def check_type_filter(filter):
+    # Map the typed bike types onto the stored ones before the question is embedded; None when no bike can match
+    normalized, unknown = normalize_type_filter(filter)
+    if normalized is None:
+        st.error(f"No bikes of type {filter}. Known types: {', '.join(get_facet_catalog().values())}")
+        return None
+    if unknown:
+        st.warning("No bike type matches: " + ', '.join(unknown))
+    if normalized != filter:
+        st.caption("Searching bike types: " + normalized)
+    return normalized
+
 @workflow(name="Bike Recommendation Demo UI")
 def execute_demo_ui():
     ##################################
@@ -161,23 +227,18 @@ def execute_demo_ui():
     if st.button('Ask Me! :bicyclist:'):
         if query:
             if filter:
-                session, keyspace = create_connection()
-                db_query = build_hybrid_query(query, keyspace, filter, k)
-                bikes_results = query_astra_db(session, db_query)
-                if bikes_results.empty:
-                    st.error("No Response received")                    
-                else:
-                    create_display_table(bikes_results)
-                    create_display_cgpt_response(bikes_results, query)
+                filter = check_type_filter(filter)
+                if filter is None:
+                    return
+            # Warm up the connection while the query is embedded
+            (session, keyspace), embedding = asyncio.run(
+                connect_and_embed(in_script_thread(create_connection), in_script_thread(embed_query), query)
+            )
+            bikes_results = retrieve_results(session, keyspace, query, filter, k, embedding)
+            if bikes_results.empty:
+                st.error("No Response received")                    
             else:
-                session, keyspace = create_connection()
-                db_query = build_simple_query(query, keyspace, k)
-                bikes_results = query_astra_db(session, db_query)
-                if bikes_results.empty:
-                    st.error("No Response received")                    
-                else:
-                    create_display_table(bikes_results)
-                    create_display_cgpt_response(bikes_results, query)
+                display_results(bikes_results, query)
         else:
             st.error("Please provide a question to start!")
 
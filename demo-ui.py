@@ -1,49 +1,93 @@
-from cassandra.cluster import Cluster
-from cassandra.auth import PlainTextAuthProvider
-from astrapy.db import AstraDBCollection
+import os, asyncio, threading
 
-import openai, os, uuid, requests
-import pandas as pd
-
-from traceloop.sdk import Traceloop
-from traceloop.sdk.tracing import tracing as Tracer
-from traceloop.sdk.decorators import workflow, task, agent
+from telemetry import init_telemetry, workflow, task
 from dotenv import load_dotenv, find_dotenv
 
+from embeddings import embed_text
+from embedding_cache import get_default_cache
+from llm_recommendations import CompletionCache, generate_recommendations
+from metrics import REGISTRY
+from query_pipeline import BackgroundRun, connect_and_embed, in_script_thread
+from filters import constraints_from, constraints_key, has_constraints, satisfies, split_types, type_filter
+from facet_catalog import get_facet_catalog, normalize_type_filter
+from lexical_index import get_lexical_index, lexical_weight, reciprocal_rank_fusion, resolve_documents
+
 import streamlit as st
-from langchain.llms import OpenAI
+
+# astrapy, pandas, numpy (semantic_cache, reranking), openai and langchain are imported on first use rather than here,
+# so a cold start of the app only pays for what the first query needs
 
 # Load the .env file
 if not load_dotenv(find_dotenv(),override=True):
     raise Exception("Couldn't load .env file")
 
 #Add Telemetry
-TRACELOOP_API_KEY=os.getenv('TRACELOOP_API_KEY')
-Traceloop.init(app_name="Bike Recommendation App", disable_batch=True)
-# Generate a UUID
-uuid_obj = str(uuid.uuid4())
-Tracer.set_correlation_id(uuid_obj)
+init_telemetry(app_name="Bike Recommendation App")
 
 #declare constant
 ASTRA_DB_APPLICATION_TOKEN=os.getenv('ASTRA_DB_APPLICATION_TOKEN')
 ASTRA_DB_API_ENDPOINT=os.getenv('ASTRA_DB_API_ENDPOINT')
 ASTRA_COLLECTION=os.getenv('ASTRA_COLLECTION')
+# "astra" queries the Astra collection; "numpy" (exact) or "ivf" (approximate) search VECTOR_FILE in-process
+VECTOR_BACKEND=os.getenv('VECTOR_BACKEND', 'astra')
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
 model_id = "text-embedding-ada-002"
 
 k=os.getenv('LIMIT_TOP_K')
+RESULT_FIELDS=["type", "brand", "model", "price", "description", "image"]
+# Compact forms of each bike stored at ingest, used to keep the recommendation prompts within PROMPT_CONTEXT_TOKENS
+PROMPT_FIELDS=["summary", "attributes"]
+# Similar bikes shown under each result, from the precomputed neighbor table; 0 to hide them
+SIMILAR_BIKES=int(os.getenv('SIMILAR_BIKES', '5'))
+
+# "stream" generates the recommendations concurrently and shows tokens as they arrive, "batch" waits for all of them
+LLM_MODE=os.getenv('LLM_MODE', 'batch')
+LLM_CONCURRENCY=int(os.getenv('LLM_CONCURRENCY', '5'))
+
+@st.cache_resource()
+def get_llm():
+    from langchain.llms import OpenAI
+    from http_clients import get_http_client
+    # Retries are left to the request scheduler
+    return OpenAI(openai_api_key=os.environ['OPENAI_API_KEY'], temperature=0.1, http_client=get_http_client('openai'), max_retries=0)
+
+def start_prewarm():
+    # Open pooled Astra and OpenAI connections in the background; only the first run of the process does anything
+    def prewarm():
+        from http_clients import prewarm_clients
+        prewarm_clients(ASTRA_DB_API_ENDPOINT if VECTOR_BACKEND == 'astra' else None, openai_async=LLM_MODE == 'stream')
+    threading.Thread(target=prewarm, daemon=True).start()
 
-llm = OpenAI(openai_api_key=os.environ['OPENAI_API_KEY'], temperature=0.1)
+@st.cache_resource()
+def get_completion_cache():
+    # Explanations per (bike, normalized question), shared by all sessions
+    cache = CompletionCache(max_entries=int(os.getenv('COMPLETION_CACHE_SIZE', '5000')))
+    REGISTRY.register_collector('completion_cache', cache.stats)
+    return cache
+
+@st.cache_resource()
+def get_semantic_cache():
+    # One cache shared by all Streamlit sessions of this process
+    from semantic_cache import SemanticCache
+    cache = SemanticCache(
+        threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.97')),
+        max_entries=int(os.getenv('SEMANTIC_CACHE_SIZE', '1000')),
+        ttl=float(os.getenv('SEMANTIC_CACHE_TTL', '3600')),
+    )
+    REGISTRY.register_collector('semantic_cache', cache.stats)
+    return cache
 
 @st.cache_resource()
 @task(name="Establish Astra DB Connection and get Collection")
 def create_connection():
     #Establish Connectivity and get the collection
+    if VECTOR_BACKEND != 'astra':
+        st.write(":hourglass: Loading local vector index...")
+        from vector_backends import create_backend
+        return create_backend(VECTOR_BACKEND)
     st.write(":hourglass: Establishing AstraDB Connection...")
-    collection = AstraDBCollection(
-        collection_name=ASTRA_COLLECTION, token=ASTRA_DB_APPLICATION_TOKEN, api_endpoint=ASTRA_DB_API_ENDPOINT
-    )
+    from http_clients import astra_collection
+    collection = astra_collection(ASTRA_COLLECTION, ASTRA_DB_APPLICATION_TOKEN, ASTRA_DB_API_ENDPOINT)
     return collection
 
 @task(name="Embed Input Query")
@@ -51,46 +95,100 @@ def embed_query(customer_input):
     # Create embedding based on same model
     st.write(":hourglass: Using OpenAI to Create Embeddings for Input Query...")
     prompt = f"Suggest a response to the customer inquiry: {customer_input}? Respond in format that would be suitable for searching a database of professional bike reviews."
-    embedding = openai.embeddings.create(input=prompt, model=model_id).data[0].embedding
+    embedding = embed_text(prompt, model=model_id, cache=get_default_cache())
     return embedding
 
 @task(name="Build top k simple query")
-def build_simple_query(customer_input, k):
+def build_simple_query(customer_input, k, embedding=None):
     st.write(":hourglass: Building Simple Database Query...")
     params = {}
-    params['embedding'] = embed_query(customer_input)
+    # The embedding may already have been computed alongside the connection warm-up
+    params['embedding'] = embedding if embedding is not None else embed_query(customer_input)
     params['k'] = k
-    
+    params['text'] = customer_input
     return params
 
 @task(name="Build top k hybrid query")
-def build_hybrid_query(customer_input, filter, k):
+def build_hybrid_query(customer_input, filter, k, embedding=None):
     st.write(":hourglass: Building Hybrid Search Query...")
     params = {}
-    params['embedding'] = embed_query(customer_input)
+    # The embedding may already have been computed alongside the connection warm-up
+    params['embedding'] = embedding if embedding is not None else embed_query(customer_input)
     params['k'] = k
     params['filter'] = filter
+    params['text'] = customer_input
     return params
 
 @task(name="Perform ANN search on Astra DB")
 def query_astra_db(collection, params):
+    # Over-fetch candidates together with their vectors and re-rank them locally: exact cosine,
+    # price and brand constraints, MMR against near-duplicates (see reranking.py). Still one request.
+    # Returns the results as a list of dicts, best first.
     st.write(":hourglass: Retrieving results from Astra DB...")
+    from reranking import VECTOR_FIELD, candidate_limit, overfetch, rerank
+    k = int(params['k'])
+    constraints = params.get('constraints')
+    reranked = overfetch() > 1 or has_constraints(constraints)
+    fields = RESULT_FIELDS + PROMPT_FIELDS + ["neighbors"] + ([VECTOR_FIELD] if reranked else [])
     if 'filter' in params:
         results = collection.vector_find(
             vector=params['embedding'],
-            limit=params['k'],
-            filter={"type": params['filter']},
-            fields=["type", "brand", "model", "price", "description", "image"],
+            limit=candidate_limit(k) if reranked else k,
+            filter=type_filter(split_types(params['filter'])),
+            fields=fields,
         )
     else:
         results = collection.vector_find(
             vector=params['embedding'],
-            limit=params['k'],
-            fields=["type", "brand", "model", "price", "description", "image"],
+            limit=candidate_limit(k) if reranked else k,
+            fields=fields,
         )
-    
-    bikes_results = pd.DataFrame(results)
-    return bikes_results
+    if reranked:
+        results = rerank(results, params['embedding'], k, constraints).records()
+    return results
+
+@task(name="Retrieve results")
+def retrieve_results(collection, params):
+    # Several bike types are searched at once with an $in filter.
+    # The results stay dicts until here and become a DataFrame once, for display.
+    return to_dataframe(fuse_lexical_results(collection, params, query_astra_db(collection, params)))
+
+def to_dataframe(records):
+    # pandas is only loaded once there are results to show
+    import pandas as pd
+    return pd.DataFrame(records)
+
+@task(name="Fuse lexical and vector results")
+def fuse_lexical_results(collection, params, results):
+    # Bikes named in the question are found by the BM25 index and merged into the vector results by rank.
+    # Hits the vector search missed are read from the collection, so every result has its _id and $similarity.
+    weight = lexical_weight()
+    if weight <= 0 or not params.get('text'):
+        return results
+    lexical = get_lexical_index().search(params['text'], int(params['k']), type_filter(split_types(params.get('filter'))), RESULT_FIELDS, named=True)
+    lexical = resolve_documents(collection, lexical, RESULT_FIELDS + PROMPT_FIELDS + ["neighbors"], params['embedding'], known=results)
+    if params.get('constraints'):
+        lexical = [document for document in lexical if satisfies(document, params['constraints'])]
+    return reciprocal_rank_fusion(results, lexical, int(params['k']), weight)
+
+@task(name="Look up exact bike names")
+def find_exact_names(customer_input, filter, k, constraints=None):
+    # A question that is only a brand or model name is answered from the lexical index,
+    # without an embedding or a vector search
+    if lexical_weight() <= 0:
+        return None
+    results = get_lexical_index().exact_matches(customer_input, int(k), type_filter(split_types(filter)), RESULT_FIELDS)
+    if results is None:
+        return None
+    if constraints:
+        results = [document for document in results if satisfies(document, constraints)]
+    return to_dataframe(results)
+
+def read_constraints(price_min, price_max, brands):
+    # The optional price range (0 for no bound) and brands entered with the question, or None
+    if not (price_min or price_max or brands.strip()):
+        return None
+    return constraints_from({'price_min': price_min or None, 'price_max': price_max or None, 'brands': brands})
 
 @task(name="Build table with Bike Reco Results")
 def create_display_table(bikes_results):
@@ -111,17 +209,33 @@ def create_display_table(bikes_results):
         )
 
 @task(name="Ask ChatGPT to Generate a Professional Recommendation")
-def create_display_cgpt_response(bikes_results, customer_input):
-    bike_desc_prompts=[]
-
-    for index, row in bikes_results.iterrows():
-        reco_prompt = f"You are an experienced bike rider who is working at a bike retail shop Bike Mart and your job is to provide Bike Recommendations to customers. For a {customer_input}, why would you suggest {row['model']} {row['brand']}, described as {row['description']}?"
-        bike_desc_prompts.append(reco_prompt)
-
+def create_display_cgpt_response(generation, cached_recommendations=None):
+    # Shows the recommendations of a generation started by start_cgpt_generation(), or cached ones
+    if cached_recommendations is not None:
+        st.write(":bicyclist: Here are some Bike recommendations:")
+        st.write(cached_recommendations)
+        return cached_recommendations
     st.write(":bicyclist: Generating Bike recommendations Using ChatGPT :bicyclist:")
+    return show_cgpt_stream(generation) if LLM_MODE == 'stream' else show_cgpt_batch(generation)
+
+def start_cgpt_generation(bikes_results, customer_input):
+    # Both modes run in the background, so the caller can render the results table in the meantime
+    if LLM_MODE == 'stream':
+        return start_cgpt_stream(bikes_results, customer_input)
+    return start_cgpt_batch(bikes_results, customer_input)
 
-    recommendations = llm.generate(bike_desc_prompts)
+def start_cgpt_batch(bikes_results, customer_input):
+    # Start llm.generate for all the bikes in a worker thread; the result is collected by show_cgpt_batch()
+    from embeddings import count_tokens
+    from request_scheduler import get_scheduler
+    bike_desc_prompts = build_reco_prompts(bikes_results, customer_input)
+    llm = get_llm()
+    tokens = sum(count_tokens(prompt, llm.model_name) + llm.max_tokens for prompt in bike_desc_prompts)
+    generate = lambda: get_scheduler(llm.model_name).call(lambda: llm.generate(bike_desc_prompts), tokens, 'interactive')
+    return BackgroundRun(lambda emit: asyncio.to_thread(generate))
 
+def show_cgpt_batch(run):
+    recommendations = run.drain()
     st.write(":bicyclist: Here are some Bike recommendations:")
 
     desc_list=''
@@ -130,6 +244,119 @@ def create_display_cgpt_response(bikes_results, customer_input):
         desc_list += f"- {description}\n"
     
     st.write(desc_list)
+    return desc_list
+
+def build_reco_prompts(bikes_results, customer_input):
+    # Each bike is described by its attributes, summary or full description, whichever the shared token budget allows
+    from prompt_builder import build_bike_contexts
+    rows = [row for _, row in bikes_results.iterrows()]
+    contexts, _, _ = build_bike_contexts(rows, model=get_llm().model_name, keep_all=True)
+    return [
+        f"You are an experienced bike rider who is working at a bike retail shop Bike Mart and your job is to provide Bike Recommendations to customers. For a {customer_input}, why would you suggest {row['model']} {row['brand']}, described as {context}?"
+        for row, context in zip(rows, contexts)
+    ]
+
+def start_cgpt_stream(bikes_results, customer_input, bike_desc_prompts=None):
+    # Start the concurrent completions in the background; tokens are queued until show_cgpt_stream()
+    bike_desc_prompts = bike_desc_prompts or build_reco_prompts(bikes_results, customer_input)
+    bike_keys = [f"{row['brand']}:{row['model']}" for _, row in bikes_results.iterrows()]
+    completion_cache = get_completion_cache()
+    llm = get_llm()
+
+    async def generate(emit):
+        # The completions run on the shared client loop, whose pooled connections outlive this query
+        from http_clients import get_async_openai_client, run_on_client_loop
+        return await run_on_client_loop(generate_recommendations(
+            get_async_openai_client(), bike_desc_prompts, bike_keys, customer_input, emit,
+            model=llm.model_name, cache=completion_cache, concurrency=LLM_CONCURRENCY,
+            temperature=llm.temperature, max_tokens=llm.max_tokens,
+        ))
+
+    return BackgroundRun(generate), len(bike_desc_prompts)
+
+def show_cgpt_stream(generation):
+    # One placeholder per bike, filled in as tokens arrive from concurrent completions
+    run, count = generation
+    st.write(":bicyclist: Here are some Bike recommendations:")
+    placeholders = [st.empty() for _ in range(count)]
+
+    def on_update(i, text, done):
+        placeholders[i].markdown(f"- {text.strip()}" + ("" if done else " ▌"))
+
+    texts, first_output = run.drain(on_update)
+    if first_output is not None:
+        st.caption(f"First recommendation ready after {first_output:.2f}s")
+    return ''.join(f"- {text.strip()}\n" for text in texts)
+
+@task(name="Check type filter")
+def check_type_filter(filter):
+    # Map the typed bike types onto the stored ones before the question is embedded; None when no bike can match
+    normalized, unknown = normalize_type_filter(filter)
+    if normalized is None:
+        st.error(f"No bikes of type {filter}. Known types: {', '.join(get_facet_catalog().values())}")
+        return None
+    if unknown:
+        st.warning("No bike type matches: " + ', '.join(unknown))
+    if normalized != filter:
+        st.caption("Searching bike types: " + normalized)
+    return normalized
+
+@task(name="Answer Query")
+def answer_query(collection, db_query, query, filter):
+    # Near-duplicate questions with the same filter, constraints and k are answered from the semantic cache,
+    # skipping both the ANN search and the LLM generation
+    cache = get_semantic_cache()
+    if db_query.get('constraints'):
+        filter = f"{filter or ''}|{constraints_key(db_query['constraints'])}"
+    cached = cache.lookup(db_query['embedding'], filter, db_query['k'])
+    if cached is not None:
+        st.write(":zap: Serving a cached answer to a similar question")
+        bikes_results, recommendations = cached
+    else:
+        bikes_results = retrieve_results(collection, db_query)
+        recommendations = None
+    recommendations = show_answer(bikes_results, query, recommendations)
+    if cached is None and recommendations is not None:
+        cache.store(db_query['embedding'], (bikes_results, recommendations), filter, db_query['k'])
+    if recommendations is not None:
+        show_similar_bikes(collection, bikes_results)
+
+@task(name="Show similar bikes")
+def show_similar_bikes(collection, bikes_results):
+    # "More like this" for every result from the precomputed neighbor table, or from the neighbors field
+    # of the documents when the table is not available locally. The similar bikes of all results are
+    # read with one lookup by _id: no embedding and no vector search.
+    if SIMILAR_BIKES <= 0:
+        return
+    from neighbor_table import get_neighbor_table
+    table = get_neighbor_table()
+    similar = []
+    for result in bikes_results.to_dict('records'):
+        # The table only knows the _ids of the load it was built from; otherwise the document field is used
+        if table is not None and result.get('_id') in table.rows:
+            ids = [_id for _id, _ in table.neighbors(result.get('_id'), limit=SIMILAR_BIKES)]
+        else:
+            ids = result.get('neighbors')
+            ids = ids[:SIMILAR_BIKES] if isinstance(ids, list) else []
+        if ids:
+            similar.append((result, ids))
+    if not similar:
+        return
+    wanted = list({_id for _, ids in similar for _id in ids})
+    documents = {document['_id']: document for document in collection.paginated_find(
+        filter={'_id': {'$in': wanted}}, projection={field: 1 for field in RESULT_FIELDS})}
+    for result, ids in similar:
+        with st.expander(f"Bikes similar to {result['brand']} {result['model']}"):
+            create_display_table(to_dataframe([documents[_id] for _id in ids if _id in documents]))
+
+def show_answer(bikes_results, query, recommendations=None):
+    if bikes_results.empty:
+        st.error("No Response received")
+        return None
+    # Send the completions first, then render the table while they are generated
+    generation = start_cgpt_generation(bikes_results, query) if recommendations is None else None
+    create_display_table(bikes_results)
+    return create_display_cgpt_response(generation, recommendations)
 
 @workflow(name="Bike Recommendation Demo UI")
 def execute_demo_ui():
@@ -151,29 +378,38 @@ def execute_demo_ui():
 
     query = st.text_input('Please Enter your Bike Question:')
     filter = st.text_input("Please Enter Bike Type: (e.g. Kids Bike or eBikes) ***Optional***")
+    price_column, brand_column = st.columns(2)
+    with price_column:
+        price_min = st.number_input("Minimum price ($, 0 for any) ***Optional***", min_value=0, step=100)
+        price_max = st.number_input("Maximum price ($, 0 for any) ***Optional***", min_value=0, step=100)
+    with brand_column:
+        brands = st.text_input("Brands, separated by commas ***Optional***")
 
     if st.button('Ask Me! :bicyclist:'):
         if query:
             if filter:
-                collection = create_connection()
-                db_query = build_hybrid_query(query, filter, k)
-                bikes_results = query_astra_db(collection, db_query)
-                if bikes_results.empty:
-                    st.error("No Response received")                    
-                else:
-                    create_display_table(bikes_results)
-                    create_display_cgpt_response(bikes_results, query)
+                filter = check_type_filter(filter)
+                if filter is None:
+                    return
+            constraints = read_constraints(price_min, price_max, brands)
+            exact = find_exact_names(query, filter or None, k, constraints)
+            if exact is not None:
+                st.write(":zap: Found the bike by name")
+                show_answer(exact, query)
+                return
+            # Warm up the connection while the query is embedded
+            collection, embedding = asyncio.run(
+                connect_and_embed(in_script_thread(create_connection), in_script_thread(embed_query), query)
+            )
+            if filter:
+                db_query = build_hybrid_query(query, filter, k, embedding)
             else:
-                collection = create_connection()
-                db_query = build_simple_query(query, k)
-                bikes_results = query_astra_db(collection, db_query)
-                if bikes_results.empty:
-                    st.error("No Response received")                    
-                else:
-                    create_display_table(bikes_results)
-                    create_display_cgpt_response(bikes_results, query)
+                db_query = build_simple_query(query, k, embedding)
+            db_query['constraints'] = constraints
+            answer_query(collection, db_query, query, filter or None)
         else:
             st.error("Please provide a question to start!")
 
+start_prewarm()
 #call main method
 execute_demo_ui()
\ No newline at end of file
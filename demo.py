@@ -1,44 +1,58 @@
-from astrapy.db import AstraDBCollection
+import os, argparse, csv, json, threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-import openai, os, uuid, requests
-import pandas as pd
-
-from traceloop.sdk import Traceloop
-from traceloop.sdk.tracing import tracing as Tracer
-from traceloop.sdk.decorators import workflow, task, agent
+from telemetry import init_telemetry, workflow, task
 from dotenv import load_dotenv, find_dotenv
 
+from embeddings import embed_text, embed_texts
+from embedding_cache import get_default_cache
+from metrics import LatencyRecorder
+from lexical_index import get_lexical_index, lexical_weight, reciprocal_rank_fusion, resolve_documents
+from facet_catalog import get_facet_catalog, normalize_type_filter
+from filters import constraints_from, has_constraints, satisfies, split_types, type_filter
+
+# astrapy, pandas and numpy (vector_backends, reranking) are imported by the functions that need them,
+# so the command line starts without loading libraries the chosen mode does not use
+
 # Load the .env file
 if not load_dotenv(find_dotenv(),override=True):
     raise Exception("Couldn't load .env file")
 
 #Add Telemetry
-TRACELOOP_API_KEY=os.getenv('TRACELOOP_API_KEY')
-Traceloop.init(app_name="Bike Recommendation App", disable_batch=True)
-# Generate a UUID
-uuid_obj = str(uuid.uuid4())
-Tracer.set_correlation_id(uuid_obj)
+init_telemetry(app_name="Bike Recommendation App")
 
 #declare constant
 ASTRA_DB_APPLICATION_TOKEN=os.getenv('ASTRA_DB_APPLICATION_TOKEN')
 ASTRA_DB_API_ENDPOINT=os.getenv('ASTRA_DB_API_ENDPOINT')
 ASTRA_COLLECTION=os.getenv('ASTRA_COLLECTION')
+# "astra" queries the Astra collection; "numpy" (exact) or "ivf" (approximate) search VECTOR_FILE in-process
+VECTOR_BACKEND=os.getenv('VECTOR_BACKEND', 'astra')
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
 model_id = "text-embedding-ada-002"
+RESULT_FIELDS = ["type", "brand", "model", "price", "description"]
 
 @task(name="Establish Astra DB Connection and get Collection")
 def create_connection():
     #Establish Connectivity and get the collection
-    collection = AstraDBCollection(
-        collection_name=ASTRA_COLLECTION, token=ASTRA_DB_APPLICATION_TOKEN, api_endpoint=ASTRA_DB_API_ENDPOINT
-    )
+    if VECTOR_BACKEND != 'astra':
+        from vector_backends import create_backend
+        return create_backend(VECTOR_BACKEND)
+    from http_clients import astra_collection
+    collection = astra_collection(ASTRA_COLLECTION, ASTRA_DB_APPLICATION_TOKEN, ASTRA_DB_API_ENDPOINT)
     return collection
 
+def start_prewarm():
+    # Open pooled Astra and OpenAI connections in the background while the question is typed
+    def prewarm():
+        from http_clients import prewarm_clients
+        prewarm_clients(ASTRA_DB_API_ENDPOINT if VECTOR_BACKEND == 'astra' else None)
+    threading.Thread(target=prewarm, daemon=True).start()
+
 @task(name="Embed Input Query")
 def embed_query(customer_input):
     # Create embedding based on same model
-    embedding = openai.embeddings.create(input=customer_input, model=model_id).data[0].embedding
+    embedding = embed_text(customer_input, model=model_id, cache=get_default_cache())
     return embedding
 
 @task(name="Build top k simple query")
@@ -46,6 +60,7 @@ def build_simple_query(customer_input, k):
     params = {}
     params['embedding'] = embed_query(customer_input)
     params['k'] = k
+    params['text'] = customer_input
     return params
 
 @task(name="Build top k hybrid query")
@@ -54,25 +69,71 @@ def build_hybrid_query(customer_input, filter, k):
     params['embedding'] = embed_query(customer_input)
     params['k'] = k
     params['filter'] = filter
+    params['text'] = customer_input
     return params
 
 @task(name="Perform ANN search on Astra DB")
 def query_astra_db(collection, params):
+    # Over-fetch candidates together with their vectors and re-rank them locally: exact cosine,
+    # price and brand constraints, MMR against near-duplicates (see reranking.py). Still one request.
+    # Returns the results as a list of dicts, best first.
+    from reranking import VECTOR_FIELD, candidate_limit, overfetch, rerank
+    k = int(params['k'])
+    constraints = params.get('constraints')
+    reranked = overfetch() > 1 or has_constraints(constraints)
+    fields = RESULT_FIELDS + [VECTOR_FIELD] if reranked else RESULT_FIELDS
     if 'filter' in params:
         results = collection.vector_find(
             vector=params['embedding'],
-            limit=params['k'],
-            filter={"type": params['filter']},
-            fields=["type", "brand", "model", "price", "description"],
+            limit=candidate_limit(k) if reranked else k,
+            filter=type_filter(split_types(params['filter'])),
+            fields=fields,
         )
     else:
         results = collection.vector_find(
             vector=params['embedding'],
-            limit=params['k'],
-            fields=["type", "brand", "model", "price", "description"],
+            limit=candidate_limit(k) if reranked else k,
+            fields=fields,
         )
-    bikes_results = pd.DataFrame(results)
-    return bikes_results
+    if reranked:
+        results = rerank(results, params['embedding'], k, constraints).records()
+    return fuse_lexical_results(collection, params, results)
+
+@task(name="Fuse lexical and vector results")
+def fuse_lexical_results(collection, params, results):
+    # Bikes named in the question are found by the BM25 index and merged into the vector results by rank.
+    # Hits the vector search missed are read from the collection, so every result has its _id and $similarity.
+    weight = lexical_weight()
+    if weight <= 0 or not params.get('text'):
+        return results
+    lexical = get_lexical_index().search(params['text'], int(params['k']), type_filter(split_types(params.get('filter'))), RESULT_FIELDS, named=True)
+    lexical = resolve_documents(collection, lexical, RESULT_FIELDS, params['embedding'], known=results)
+    if params.get('constraints'):
+        lexical = [document for document in lexical if satisfies(document, params['constraints'])]
+    return reciprocal_rank_fusion(results, lexical, int(params['k']), weight)
+
+@task(name="Look up exact bike names")
+def find_exact_names(customer_input, filter, k, constraints=None):
+    # A question that is only a brand or model name is answered from the lexical index,
+    # without an embedding or a vector search
+    if lexical_weight() <= 0:
+        return None
+    results = get_lexical_index().exact_matches(customer_input, int(k), type_filter(split_types(filter)), RESULT_FIELDS)
+    if results is not None and constraints:
+        results = [document for document in results if satisfies(document, constraints)]
+    return results
+
+@task(name="Check type filter")
+def check_type_filter(filter):
+    # Map the typed bike types onto the stored ones before anything is embedded; None when no bike can match
+    normalized, unknown = normalize_type_filter(filter)
+    if unknown:
+        print("No bike type matches: " + ', '.join(unknown))
+    if normalized is None:
+        print("Known bike types: " + ', '.join(get_facet_catalog().values()))
+    elif normalized != filter:
+        print("Searching bike types: " + normalized)
+    return normalized
 
 @task(name="Ask user for Query Mode")
 def ask_user_query_mode(option1, option2):
@@ -97,13 +158,130 @@ def execute_demo():
     k = input("Please Enter the number of results to show: ")
     query_mode = ask_user_query_mode("simple", "hybrid")
 
+    filter = None
     if(query_mode == "hybrid"):
         filter = input("Please enter the type of Bike you're looking for (e.g. Kids Bike, eBikes, mountain bike, commuter bike, etc): ")
-        params = build_hybrid_query(query, filter, k)
+        if filter:
+            filter = check_type_filter(filter)
+            if filter is None:
+                return
+
+    exact = find_exact_names(query, filter, k)
+    if exact is not None:
+        print_results(exact)
+        return
+    if filter:
+        params = build_hybrid_query(query, filter, int(k))
     else:
-        params = build_simple_query(query, k)
+        params = build_simple_query(query, int(k))
+
+    print_results(query_astra_db(collection, params))
+
+def print_results(results):
+    # The results as a table; pandas is only loaded once there is something to print
+    import pandas as pd
+    print(pd.DataFrame(results))
+
+def read_query_file(path, default_k):
+    # Queries from a .jsonl file ({"query": ..., "type": ..., "k": ...}), a .csv file with the
+    # same columns, or a plain text file with one query per line. type and k are optional, and so are
+    # min_price, max_price and brand (comma-separated), which constrain the re-ranked results.
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl'):
+            rows = (json.loads(line) for line in f if line.strip())
+        elif path.endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = ({'query': line.strip()} for line in f if line.strip())
+        for row in rows:
+            query = {'query': row['query'], 'type': row.get('type') or None, 'k': int(row.get('k') or default_k)}
+            for column in ('min_price', 'max_price', 'brand'):
+                if row.get(column) not in (None, ''):
+                    query[column] = row[column] if column == 'brand' else float(row[column])
+            yield query
 
-    bikes_results = query_astra_db(collection, params)
-    print(bikes_results)
+def query_constraints(query):
+    # Price range and brands of a batch query, or None
+    if not any(column in query for column in ('min_price', 'max_price', 'brand')):
+        return None
+    return constraints_from({'price_min': query.get('min_price'), 'price_max': query.get('max_price'), 'brands': query.get('brand')})
 
-execute_demo()
\ No newline at end of file
+class ResultWriter:
+    # Streams results to JSONL (one line per query) or CSV (one line per result)
+    fields = ["type", "brand", "model", "price", "description"]
+
+    def __init__(self, path):
+        self.f = open(path, 'w', newline='')
+        self.csv = csv.writer(self.f) if path.endswith('.csv') else None
+        if self.csv:
+            self.csv.writerow(['query_index', 'query', 'filter', 'rank', '_id', '$similarity'] + self.fields)
+
+    def write(self, index, query, results):
+        if self.csv:
+            for rank, result in enumerate(results, 1):
+                self.csv.writerow([index, query['query'], query['type'] or '', rank, result.get('_id'), result.get('$similarity')]
+                                  + [result.get(field) for field in self.fields])
+        else:
+            self.f.write(json.dumps({'query_index': index, **query, 'results': results}) + '\n')
+
+    def close(self):
+        self.f.close()
+
+@workflow(name="Execute Bike Recommendation Batch")
+def execute_batch(query_file, output_file, default_k, concurrency, batch_size):
+    # Embed queries in batches, run the searches on a bounded thread pool and stream results to output_file
+    collection = create_connection()
+    recorder = LatencyRecorder()
+    writer = ResultWriter(output_file)
+
+    def search(query, filter, embedding, exact):
+        if exact is not None:
+            return exact
+        params = {'embedding': embedding, 'k': query['k'], 'text': query['query'], 'constraints': query_constraints(query)}
+        if filter:
+            params['filter'] = filter
+        with recorder.timed('search'):
+            return query_astra_db(collection, params)
+
+    queries = read_query_file(query_file, default_k)
+    index = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            chunk = list(islice(queries, batch_size))
+            if not chunk:
+                break
+            # Type filters are mapped onto the stored types; a query whose filter matches no bike gets no
+            # results, and one that names a bike exactly is answered from the lexical index. Neither is embedded.
+            filters = [normalize_type_filter(query['type'])[0] if query['type'] else None for query in chunk]
+            exact = [[] if query['type'] and filter is None else find_exact_names(query['query'], filter, query['k'], query_constraints(query))
+                     for query, filter in zip(chunk, filters)]
+            to_embed = [query['query'] for query, hit in zip(chunk, exact) if hit is None]
+            with recorder.timed('embed', items=len(to_embed)):
+                embedded = iter(embed_texts(to_embed, model=model_id, cache=get_default_cache(), lane='background') if to_embed else [])
+            embeddings = [next(embedded) if hit is None else None for hit in exact]
+            # map keeps input order while up to `concurrency` searches are in flight
+            for query, results in zip(chunk, executor.map(search, chunk, filters, embeddings, exact)):
+                with recorder.timed('write'):
+                    writer.write(index, query, results)
+                index += 1
+    writer.close()
+
+    print(f"Processed {index} queries, results written to {output_file}")
+    print(recorder.format_summary())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bike recommendation query demo")
+    parser.add_argument('--batch', metavar='QUERY_FILE', help="Run every query in a .jsonl, .csv or .txt file instead of asking interactively")
+    parser.add_argument('--output', default='results.jsonl', help="Where batch results go (.jsonl or .csv)")
+    parser.add_argument('--k', type=int, default=int(os.getenv('LIMIT_TOP_K') or 5), help="Results per query when the file gives no k")
+    parser.add_argument('--concurrency', type=int, default=8, help="Max searches in flight")
+    parser.add_argument('--batch-size', type=int, default=100, help="Queries embedded per request")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    start_prewarm()
+    if args.batch:
+        execute_batch(args.batch, args.output, args.k, args.concurrency, args.batch_size)
+    else:
+        execute_demo()
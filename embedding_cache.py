@@ -0,0 +1,136 @@
+import hashlib, os, sqlite3, threading, time
+from array import array
+
+from metrics import REGISTRY
+
+# On-disk embedding cache shared by the loader and the query scripts.
+# Vectors are stored as float32 blobs in SQLite, keyed by model id plus a hash of the exact input text.
+# When the store grows over max_bytes, the least recently used vectors are evicted.
+
+DEFAULT_CACHE_PATH = ".embedding_cache.sqlite3"
+# Least recently used entries deleted per round of eviction
+EVICT_BATCH = 256
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # The connection is shared by worker threads (e.g. Streamlit sessions), guarded by self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        # Covers both the LRU order and SUM(size), which then never reads the vector blobs
+        self.conn.execute("DROP INDEX IF EXISTS embeddings_last_access")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access_size ON embeddings (last_access, size)")
+        # Changes when another connection commits to the file; the total is re-read when it does
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.total_bytes = self._stored_bytes()
+
+    def get_many(self, model, texts):
+        # Returns a list aligned with texts holding the cached vector or None
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                for key, blob in rows:
+                    found[key] = blob
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return [array('f', found[key]).tolist() if key in found else None for key in keys]
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array('f', vector).tobytes()
+            rows.append((cache_key(model, text), model, blob, len(blob), now))
+        # `with self.conn` commits, or rolls back if anything fails. BEGIN IMMEDIATE takes the write lock
+        # up front, so other processes sharing the file cannot change the total while it is checked.
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != self.data_version:
+                    # Another process (e.g. a sharded ingest worker) wrote to the cache since the last look
+                    self.total_bytes = self._stored_bytes()
+                # Re-read the total on the next put if this transaction does not commit
+                self.data_version = None
+                for row in rows:
+                    previous = self.conn.execute("SELECT size FROM embeddings WHERE key = ?", (row[0],)).fetchone()
+                    self.total_bytes += row[3] - (previous[0] if previous else 0)
+                    self.conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", row)
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+            self.data_version = version
+
+    def put(self, model, text, vector):
+        self.put_many(model, [text], [vector])
+
+    def _stored_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _evict(self):
+        # Drop least recently used entries until the store is back under 90% of max_bytes.
+        # Runs inside put_many's transaction; the total is re-read first, since it is what gets evicted down to.
+        target = self.max_bytes * 0.9
+        self.total_bytes = self._stored_bytes()
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM embeddings ORDER BY last_access LIMIT ?", (EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                self.conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.total_bytes -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    # Process-wide cache configured from the environment.
+    # Set EMBED_CACHE_PATH to an empty value to turn caching off.
+    global _default_cache
+    path = os.getenv('EMBED_CACHE_PATH', DEFAULT_CACHE_PATH)
+    if not path:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache.path != path:
+            max_bytes = int(float(os.getenv('EMBED_CACHE_MAX_MB', '512')) * 1024 * 1024)
+            _default_cache = EmbeddingCache(path, max_bytes)
+            REGISTRY.register_collector('embedding_cache', _default_cache.stats)
+    return _default_cache
@@ -0,0 +1,153 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+from request_scheduler import get_scheduler
+
+# openai and tiktoken are imported on first use, so importing this module stays cheap
+
+#declare constant
+model_id = "text-embedding-ada-002"
+
+# Maximum number of tokens a single embeddings request may carry for the model
+MODEL_MAX_INPUT_TOKENS = {
+    "text-embedding-ada-002": 8191,
+    "text-embedding-3-small": 8191,
+    "text-embedding-3-large": 8191,
+}
+
+# Vector length produced by each model, so collections can be created without calling the API
+MODEL_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+# Defaults can be overridden in the .env file. They are read when a call is made,
+# so the values are picked up even if this module is imported before load_dotenv().
+def default_batch_size():
+    return int(os.getenv('EMBED_BATCH_SIZE', '100'))
+
+def default_concurrency():
+    return int(os.getenv('EMBED_CONCURRENCY', '4'))
+
+def default_max_batch_tokens(model=model_id):
+    return int(os.getenv('EMBED_MAX_BATCH_TOKENS', str(MODEL_MAX_INPUT_TOKENS.get(model, 8191))))
+
+def default_client():
+    # Shared OpenAI client on the process-wide connection pool (see http_clients.py)
+    from http_clients import get_openai_client
+    return get_openai_client()
+
+_probed_dimensions = {}
+
+def embedding_dimension(model=model_id, client=None):
+    # Known models come from MODEL_DIMENSIONS; any other model is probed once per process
+    if model in MODEL_DIMENSIONS:
+        return MODEL_DIMENSIONS[model]
+    if model not in _probed_dimensions:
+        _probed_dimensions[model] = len(embed_batch(["dimension probe"], client, model)[0])
+    return _probed_dimensions[model]
+
+_encodings = {}
+
+def get_encoding(model):
+    # None when tiktoken is not installed
+    if model not in _encodings:
+        try:
+            import tiktoken
+        except ImportError:
+            _encodings[model] = None
+        else:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # A model tiktoken does not know
+                _encodings[model] = None
+    return _encodings[model]
+
+def count_tokens(text, model=model_id):
+    # Use the model tokenizer when tiktoken is available
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Otherwise over-estimate (about 3 bytes per token) so batches stay under the limit
+    return len(text.encode('utf-8')) // 3 + 1
+
+def build_token_batches(texts, batch_size=None, max_batch_tokens=None, model=model_id):
+    # Group consecutive texts into batches of at most batch_size items and max_batch_tokens tokens.
+    # Each batch is a list of positions into texts, so the caller can put vectors back in order.
+    batch_size = batch_size or default_batch_size()
+    max_batch_tokens = max_batch_tokens or default_max_batch_tokens(model)
+    batches = []
+    current = []
+    current_tokens = 0
+    for position, text in enumerate(texts):
+        tokens = count_tokens(text, model)
+        if tokens > max_batch_tokens:
+            raise ValueError(f"Text at position {position} has {tokens} tokens, over the {max_batch_tokens} token limit")
+        if current and (len(current) >= batch_size or current_tokens + tokens > max_batch_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(position)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def embed_batch(texts, client=None, model=model_id, lane='interactive'):
+    # One embeddings request for the whole batch; the API may return items out of order.
+    # The request waits for the model's rate limits in the given lane of the request scheduler.
+    client = client or default_client()
+    tokens = sum(count_tokens(text, model) for text in texts)
+    response = get_scheduler(model).call(lambda: client.embeddings.create(input=texts, model=model), tokens, lane)
+    if getattr(response, 'usage', None) is not None:
+        REGISTRY.counter('openai_embedding_tokens').inc(response.usage.total_tokens)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def embed_texts(texts, client=None, model=model_id, batch_size=None, max_batch_tokens=None, concurrency=None, cache=None,
+                lane='interactive'):
+    # Embed texts in token-aware batches, with up to `concurrency` requests in flight.
+    # The returned vectors are in the same order as texts.
+    # When an EmbeddingCache is given, only texts missing from it are sent to the API.
+    texts = list(texts)
+    concurrency = concurrency or default_concurrency()
+
+    if cache is not None:
+        vectors = cache.get_many(model, texts)
+    else:
+        vectors = [None] * len(texts)
+    missing = [position for position, vector in enumerate(vectors) if vector is None]
+    if not missing:
+        return vectors
+
+    missing_texts = [texts[position] for position in missing]
+    batches = build_token_batches(missing_texts, batch_size, max_batch_tokens, model)
+
+    def run(batch):
+        return embed_batch([missing_texts[position] for position in batch], client, model, lane)
+
+    new_vectors = [None] * len(missing_texts)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # executor.map yields results in submission order
+        for batch, batch_vectors in zip(batches, executor.map(run, batches)):
+            for position, embedding in zip(batch, batch_vectors):
+                new_vectors[position] = embedding
+
+    if cache is not None:
+        cache.put_many(model, missing_texts, new_vectors)
+    for position, embedding in zip(missing, new_vectors):
+        vectors[position] = embedding
+    return vectors
+
+def embed_text(text, client=None, model=model_id, cache=None):
+    # Single text shortcut used by the query path
+    if cache is not None:
+        embedding = cache.get(model, text)
+        if embedding is not None:
+            return embedding
+    embedding = embed_batch([text], client, model)[0]
+    if cache is not None:
+        cache.put(model, text, embedding)
+    return embedding
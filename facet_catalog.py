@@ -0,0 +1,142 @@
+import difflib, json, os, re, threading
+
+from filters import split_types
+
+# Catalog of the distinct values of the filterable fields (the bike `type`) and the number of bikes
+# holding each. The query scripts check a type filter against it before anything is embedded:
+# free text such as "kids bike" or "ebikes" is mapped onto the stored values ("Kids bikes",
+# "eBikes", "Electric Bikes"), several matching values become an $in filter, and a filter that no
+# bike can match is rejected without paying for an embedding and a vector search.
+#
+# The loader writes the catalog at ingest and updates its counts as a sync inserts, changes and
+# deletes bikes. Running apps reload it when the file changes.
+
+DEFAULT_CATALOG_FILE = '.facet_catalog.json'
+DEFAULT_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bikes.json')
+FACET_FIELDS = ('type',)
+
+# Words that mean the same thing in a type name
+SYNONYMS = {'ebike': 'electric bike', 'e': 'electric', 'child': 'kid', 'children': 'kid',
+            'bicycle': 'bike', 'cycle': 'bike'}
+
+def singular(token):
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+def normalize_value(text):
+    # "Kids' Mountain Bikes" -> "kid mountain bike", "eBikes" -> "electric bike"
+    tokens = []
+    for token in re.findall(r'[a-z0-9]+', str(text).lower().replace("'", '')):
+        tokens.extend(SYNONYMS.get(singular(token), singular(token)).split())
+    return ' '.join(tokens)
+
+class FacetCatalog:
+    def __init__(self, counts=None, path=None):
+        # counts: {field: {value: number of documents}}
+        self.counts = {field: dict(values) for field, values in (counts or {}).items()}
+        self.path = path
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_documents(cls, documents, path=None, fields=FACET_FIELDS):
+        catalog = cls({field: {} for field in fields}, path)
+        for document in documents:
+            catalog.add(document)
+        return catalog
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)['counts'], path)
+
+    def add(self, document, delta=1):
+        # Count (or with delta=-1, uncount) the facet values of one document
+        with self.lock:
+            for field, values in self.counts.items():
+                value = document.get(field)
+                if value is None:
+                    continue
+                values[value] = values.get(value, 0) + delta
+                if values[value] <= 0:
+                    del values[value]
+
+    def remove(self, document):
+        self.add(document, -1)
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            data = json.dumps({'counts': self.counts}, indent=2, sort_keys=True)
+        # Written to a temporary file and renamed, so readers never see half a catalog
+        with open(path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def values(self, field='type'):
+        return sorted(self.counts.get(field, {}))
+
+    def resolve_term(self, term, field='type'):
+        # Stored values one filter term stands for, best kind of match first: every value with the
+        # same normalized name ("ebikes" -> "eBikes", "Electric Bikes"), every value containing the
+        # term's words ("kids" -> all kids types), or the closest spelling ("mountian bikes")
+        keys = {}
+        for value in self.values(field):
+            keys.setdefault(normalize_value(value), []).append(value)
+        key = normalize_value(term)
+        if not key:
+            return []
+        if key in keys:
+            return keys[key]
+        words = set(key.split())
+        contained = [value for value_key, group in keys.items() if words <= set(value_key.split()) for value in group]
+        if contained:
+            return contained
+        return [value for close in difflib.get_close_matches(key, list(keys), n=1, cutoff=0.8) for value in keys[close]]
+
+    def resolve(self, terms, field='type'):
+        # (matching stored values, terms that matched nothing)
+        matched, unknown = [], []
+        for term in terms:
+            values = self.resolve_term(term, field)
+            if not values:
+                unknown.append(term)
+            matched.extend(value for value in values if value not in matched)
+        return matched, unknown
+
+_default_catalog = None
+_default_catalog_lock = threading.Lock()
+
+def catalog_file():
+    return os.getenv('FACET_CATALOG_FILE', DEFAULT_CATALOG_FILE)
+
+def get_facet_catalog():
+    # Process-wide catalog from FACET_CATALOG_FILE, reloaded when the loader rewrites it.
+    # Before the first ingest it is built from the local catalog data file; None if neither exists.
+    global _default_catalog
+    path = catalog_file()
+    try:
+        version = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        version = (DEFAULT_DATA_FILE, None)
+    with _default_catalog_lock:
+        if _default_catalog is None or _default_catalog[0] != version:
+            if version[1] is not None:
+                catalog = FacetCatalog.load(path)
+            elif os.path.exists(DEFAULT_DATA_FILE):
+                with open(DEFAULT_DATA_FILE) as f:
+                    catalog = FacetCatalog.from_documents(json.load(f))
+            else:
+                catalog = None
+            _default_catalog = (version, catalog)
+        return _default_catalog[1]
+
+def normalize_type_filter(filter):
+    # Rewrite a free-text type filter ("kids bike, ebikes") to the stored values it matches, joined by ", ".
+    # Returns (filter, terms that matched nothing); the filter is None when no bike can match it.
+    terms = split_types(filter)
+    catalog = get_facet_catalog()
+    if not terms or catalog is None:
+        return filter, []
+    matched, unknown = catalog.resolve(terms)
+    return (', '.join(matched) if matched else None), unknown
@@ -0,0 +1,62 @@
+# Metadata filters in the Data API form used by the queries:
+# {"field": value}, {"field": {"$eq": value}} or {"field": {"$in": [value, ...]}}.
+# Shared by the local search backends and the lexical index, which apply them in-process.
+
+def matches(value, condition):
+    if isinstance(condition, dict):
+        if '$in' in condition:
+            return value in condition['$in']
+        if '$eq' in condition:
+            return value == condition['$eq']
+        raise ValueError(f"Unsupported filter operator: {condition}")
+    return value == condition
+
+def document_matches(document, filter):
+    return all(matches(document.get(field), condition) for field, condition in (filter or {}).items())
+
+def split_types(filter):
+    # "Kids bikes, eBikes" -> ["Kids bikes", "eBikes"]
+    if not filter:
+        return []
+    return [value.strip() for value in filter.split(',') if value.strip()]
+
+def type_filter(types):
+    # Filter for zero, one or several bike types
+    if not types:
+        return None
+    if len(types) == 1:
+        return {'type': types[0]}
+    return {'type': {'$in': types}}
+
+# Price range and brand constraints of a query, checked on the results rather than sent to the search
+
+def constraints_from(params):
+    # The optional price range and brands of a query
+    brands = params.get('brands') or []
+    if isinstance(brands, str):
+        brands = [brand.strip() for brand in brands.split(',') if brand.strip()]
+    return {'price_min': params.get('price_min'), 'price_max': params.get('price_max'),
+            'brands': [brand.lower() for brand in brands]}
+
+def has_constraints(constraints):
+    return bool(constraints) and (constraints['price_min'] is not None or constraints['price_max'] is not None
+                                  or bool(constraints['brands']))
+
+def constraints_key(constraints):
+    # A stable string for keying caches by the constraints; '' when there are none
+    if not has_constraints(constraints):
+        return ''
+    return f"price={constraints['price_min']}..{constraints['price_max']};brands={','.join(sorted(constraints['brands']))}"
+
+def satisfies(document, constraints):
+    # Whether one result document meets the price range and brands
+    if not has_constraints(constraints):
+        return True
+    price = document.get('price')
+    if constraints['price_min'] is not None and (price is None or price < constraints['price_min']):
+        return False
+    if constraints['price_max'] is not None and (price is None or price > constraints['price_max']):
+        return False
+    if constraints['brands'] and str(document.get('brand', '')).lower() not in constraints['brands']:
+        return False
+    return True
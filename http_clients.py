@@ -0,0 +1,283 @@
+import asyncio, os, threading, time
+
+import httpx
+
+from metrics import REGISTRY
+
+# Shared, pooled HTTP clients for Astra and OpenAI.
+# One keep-alive connection pool per service is shared by every Streamlit session and worker thread
+# of the process, so a query reuses warm connections instead of paying a TCP and TLS handshake.
+# The transports report pool metrics (connections in use, idle, waiting; time spent waiting for a
+# connection and opening new ones) to the metrics registry.
+#
+#   HTTP_POOL_SIZE=20          max connections per service
+#   HTTP_KEEPALIVE_EXPIRY=30   seconds an idle connection is kept; stay below the server/load balancer idle timeout
+#   HTTP2=false                multiplex requests over HTTP/2 (needs the h2 package)
+#   HTTP_PREWARM=2             connections opened per service at startup (0 to skip)
+
+def pool_settings():
+    size = int(os.getenv('HTTP_POOL_SIZE', '20'))
+    return {
+        'limits': httpx.Limits(max_connections=size, max_keepalive_connections=size,
+                               keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))),
+        'http2': os.getenv('HTTP2', 'false').lower() in ('1', 'true', 'yes'),
+    }
+
+class PoolStats:
+    # Counters and timings shared by the sync and async transports of one service
+    def __init__(self, name, max_connections):
+        self.name = name
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.retried = 0
+        self.wait = REGISTRY.histogram(f"{name} pool wait")
+        self.connect = REGISTRY.histogram(f"{name} connect")
+
+    def start(self, request):
+        # Install an httpcore trace callback on the request. The first event tells whether the request
+        # had to open a connection and when it was handed one; the connect events time new connections.
+        with self.lock:
+            self.requests += 1
+        state = {'start': time.perf_counter(), 'new': None, 'connect_start': None,
+                 'tls': request.url.scheme == 'https'}
+
+        def on_event(name, info):
+            now = time.perf_counter()
+            if state['new'] is None and (name.endswith('connect_tcp.started') or name.endswith('send_request_headers.started')):
+                state['new'] = name.endswith('connect_tcp.started')
+                self.wait.observe(now - state['start'])
+                with self.lock:
+                    if state['new']:
+                        self.new_connections += 1
+                    else:
+                        self.reused_connections += 1
+            if name.endswith('connect_tcp.started'):
+                state['connect_start'] = now
+            elif name.endswith('start_tls.complete') or (name.endswith('connect_tcp.complete') and not state['tls']):
+                # A plain connection is ready after the TCP connect, a TLS one after the handshake
+                if state['connect_start'] is not None:
+                    self.connect.observe(now - state['connect_start'])
+                    state['connect_start'] = None
+
+        request.extensions['trace'] = on_event
+        return state
+
+def pool_snapshot(pool):
+    # Connection counts from the httpcore pool behind a transport
+    connections = list(getattr(pool, 'connections', []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    in_use = sum(1 for connection in connections if not connection.is_idle() and not connection.is_closed())
+    waiting = sum(1 for status in getattr(pool, '_requests', []) if getattr(status, 'connection', None) is None)
+    return {'connections': len(connections), 'in_use': in_use, 'idle': idle, 'waiting': waiting}
+
+def is_stale_connection_error(error, state):
+    # A kept-alive connection closed by the server just as it was reused. Nothing was processed,
+    # so the request can be sent again on a new connection.
+    return isinstance(error, httpx.RemoteProtocolError) and state['new'] is False
+
+class PooledTransport(httpx.HTTPTransport):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request):
+        state = self.stats.start(request)
+        try:
+            return super().handle_request(request)
+        except httpx.RemoteProtocolError as error:
+            if not is_stale_connection_error(error, state):
+                raise
+            with self.stats.lock:
+                self.stats.retried += 1
+            self.stats.start(request)
+            return super().handle_request(request)
+
+    def snapshot(self):
+        return pool_snapshot(self._pool)
+
+class AsyncPooledTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def trace(self, request):
+        state = self.stats.start(request)
+        on_event = request.extensions['trace']
+
+        # The async pool awaits its trace callback
+        async def on_event_async(name, info):
+            on_event(name, info)
+        request.extensions['trace'] = on_event_async
+        return state
+
+    async def handle_async_request(self, request):
+        state = self.trace(request)
+        try:
+            return await super().handle_async_request(request)
+        except httpx.RemoteProtocolError as error:
+            if not is_stale_connection_error(error, state):
+                raise
+            with self.stats.lock:
+                self.stats.retried += 1
+            self.trace(request)
+            return await super().handle_async_request(request)
+
+    def snapshot(self):
+        return pool_snapshot(self._pool)
+
+def transport_options(settings):
+    options = {'limits': settings['limits'], 'http2': settings['http2']}
+    if settings['http2']:
+        try:
+            import h2
+        except ImportError:
+            print("HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+            options['http2'] = False
+    return options
+
+_stats = {}
+_transports = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_pool_stats(name, settings):
+    if name not in _stats:
+        _stats[name] = PoolStats(name, settings['limits'].max_connections)
+    return _stats[name]
+
+def register_pool(name):
+    # One collector per service, summing the sync and async pools
+    def collect():
+        stats = _stats[name]
+        values = {'connections': 0, 'in_use': 0, 'idle': 0, 'waiting': 0}
+        for (service, _), transport in list(_transports.items()):
+            if service == name:
+                for key, value in transport.snapshot().items():
+                    values[key] += value
+        values.update(max_connections=stats.max_connections, requests=stats.requests,
+                      new_connections=stats.new_connections, reused_connections=stats.reused_connections,
+                      retried=stats.retried)
+        return values
+    REGISTRY.register_collector(f"http_pool_{name}", collect)
+
+def get_http_client(name):
+    # Process-wide pooled client for a service ("astra", "openai"). A closed client is replaced.
+    with _clients_lock:
+        client = _clients.get((name, 'sync'))
+        if client is None or client.is_closed:
+            settings = pool_settings()
+            transport = PooledTransport(get_pool_stats(name, settings), **transport_options(settings))
+            _transports[(name, 'sync')] = transport
+            client = _clients[(name, 'sync')] = httpx.Client(transport=transport)
+            register_pool(name)
+        return client
+
+def get_async_http_client(name):
+    # Async pooled client; only use it on the client loop (run_on_client_loop), which owns its connections
+    with _clients_lock:
+        client = _clients.get((name, 'async'))
+        if client is None or client.is_closed:
+            settings = pool_settings()
+            transport = AsyncPooledTransport(get_pool_stats(name, settings), **transport_options(settings))
+            _transports[(name, 'async')] = transport
+            client = _clients[(name, 'async')] = httpx.AsyncClient(transport=transport)
+            register_pool(name)
+        return client
+
+_openai_clients = {}
+
+def get_openai_client():
+    # openai.OpenAI on the shared pool; rebuilt if its HTTP client was replaced
+    import openai
+    http_client = get_http_client('openai')
+    with _clients_lock:
+        cached = _openai_clients.get('sync')
+        if cached is None or cached[0] is not http_client:
+            # Retries are left to the request scheduler (request_scheduler.py)
+            cached = _openai_clients['sync'] = (http_client, openai.OpenAI(http_client=http_client, max_retries=0))
+        return cached[1]
+
+def get_async_openai_client():
+    # openai.AsyncOpenAI on the shared async pool; only use it on the client loop
+    import openai
+    http_client = get_async_http_client('openai')
+    with _clients_lock:
+        cached = _openai_clients.get('async')
+        if cached is None or cached[0] is not http_client:
+            cached = _openai_clients['async'] = (http_client, openai.AsyncOpenAI(http_client=http_client, max_retries=0))
+        return cached[1]
+
+def use_pooled_client(astra_object):
+    # astrapy keeps one httpx client per class; give this AstraDB/AstraDBCollection the shared pool
+    astra_object.client = get_http_client('astra')
+    if getattr(astra_object, 'astra_db', None) is not None:
+        astra_object.astra_db.client = astra_object.client
+    return astra_object
+
+def astra_collection(collection_name, token, api_endpoint):
+    from astrapy.db import AstraDBCollection
+    return use_pooled_client(AstraDBCollection(collection_name=collection_name, token=token, api_endpoint=api_endpoint))
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def client_loop():
+    # Event loop that lives as long as the process, in a daemon thread. Async clients stay bound to it,
+    # so their connections outlive the short asyncio.run() loops of individual queries.
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+def run_on_client_loop(coroutine):
+    # Awaitable from any event loop; the coroutine itself runs on the client loop
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, client_loop()))
+
+def prewarm(name, url, connections, use_async=False):
+    # Open `connections` pooled connections to url by sending concurrent HEAD requests.
+    # The status does not matter; only the kept-alive connections are.
+    if not url or connections <= 0:
+        return
+
+    if use_async:
+        async def warm():
+            client = get_async_http_client(name)
+            await asyncio.gather(*(client.head(url) for _ in range(connections)), return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(warm(), client_loop()).result()
+        return
+
+    client = get_http_client(name)
+    def head():
+        try:
+            client.head(url)
+        except httpx.HTTPError:
+            pass
+    threads = [threading.Thread(target=head) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+_prewarmed = set()
+
+def prewarm_clients(astra_endpoint=None, openai_async=False):
+    # Warm the pools in the background at startup; runs once per process per service
+    connections = int(os.getenv('HTTP_PREWARM', '2'))
+    targets = []
+    with _clients_lock:
+        if astra_endpoint and 'astra' not in _prewarmed:
+            _prewarmed.add('astra')
+            targets.append(('astra', astra_endpoint, False))
+        if 'openai' not in _prewarmed:
+            _prewarmed.add('openai')
+            targets.append(('openai', os.getenv('OPENAI_BASE_URL') or 'https://api.openai.com/v1', False))
+        if openai_async and 'openai async' not in _prewarmed:
+            _prewarmed.add('openai async')
+            targets.append(('openai', os.getenv('OPENAI_BASE_URL') or 'https://api.openai.com/v1', True))
+    for name, url, use_async in targets:
+        threading.Thread(target=prewarm, args=(name, url, connections, use_async), daemon=True).start()
@@ -0,0 +1,256 @@
+import hashlib, json, os
+from itertools import islice
+
+from embeddings import embed_texts
+from bike_summaries import ATTRIBUTES_FIELD, SUMMARY_FIELD, SUMMARY_TOKENS, add_compact_fields
+
+# Streaming ingestion: read -> embed -> write/insert, one bounded chunk at a time.
+# After each chunk is written and inserted, a checkpoint file records how far the run got,
+# so an interrupted run resumes from the last committed chunk instead of starting over.
+# Memory use depends on the chunk size, not on the size of the catalog.
+
+def iter_records(bikes, model, start=0):
+    # Read stage: key the records as the incremental sync does (brand:model _id and fingerprint, see
+    # iter_keyed_records), so a sync after a full load only touches what changed, and skip the ones
+    # already committed
+    for position, record in enumerate(iter_keyed_records(bikes, model)):
+        if position >= start:
+            yield record
+
+def iter_chunks(records, chunk_size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def summarize_chunks(chunks, summary_tokens=SUMMARY_TOKENS):
+    # Summary stage: attach the compact summary and attribute record used by the prompts
+    for chunk in chunks:
+        for record in chunk:
+            add_compact_fields(record, summary_tokens)
+        yield chunk
+
+def embed_chunks(chunks, model, cache=None, client=None):
+    # Embed stage: attach a 'vector' to every record in the chunk.
+    # Ingest runs in the background lane, so user queries are served first when rate limits are tight.
+    for chunk in chunks:
+        kwargs = {'model': model, 'cache': cache, 'lane': 'background'}
+        if client is not None:
+            kwargs['client'] = client
+        vectors = embed_texts([record['description'] for record in chunk], **kwargs)
+        for record, vector in zip(chunk, vectors):
+            record['vector'] = vector
+        yield chunk
+
+class Checkpoint:
+    # Small JSON file with the number of committed rows and the output file offset
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.chunks = 0
+        self.output_offset = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.rows = state['rows']
+            self.chunks = state['chunks']
+            self.output_offset = state['output_offset']
+
+    @property
+    def resuming(self):
+        return self.rows > 0
+
+    def commit(self, rows, output_offset):
+        self.rows += rows
+        self.chunks += 1
+        self.output_offset = output_offset
+        # Write to a temporary file and rename, so a crash never leaves a half-written checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows': self.rows, 'chunks': self.chunks, 'output_offset': self.output_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def reset(self):
+        self.rows = self.chunks = self.output_offset = 0
+        self.clear()
+
+class RecordWriter:
+    # Appends records to a JSONL file, or to a JSON array when the path ends in .json.
+    # The array is closed by finish(); until then the file is a valid prefix that can be resumed.
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.json_array = path.endswith('.json')
+        if offset and (not os.path.exists(path) or os.path.getsize(path) < offset):
+            raise ValueError(f"Cannot resume {path} at byte {offset}: the file is missing or shorter")
+        self.f = open(path, 'r+b' if offset else 'wb')
+        # Drop anything written after the last committed chunk
+        self.f.seek(offset)
+        self.f.truncate()
+        self.empty = offset == 0
+        if self.json_array and self.empty:
+            self.f.write(b'[')
+
+    def write_chunk(self, chunk):
+        lines = []
+        for record in chunk:
+            line = json.dumps(record, ensure_ascii=True)
+            if self.json_array:
+                lines.append(line if self.empty else ',' + line)
+            else:
+                lines.append(line + '\n')
+            self.empty = False
+        self.f.write(''.join(lines).encode('ascii'))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def finish(self):
+        if self.json_array:
+            self.f.write(b']')
+        self.close()
+
+    def close(self):
+        # Leaves the file a resumable prefix; safe to call after finish()
+        if not self.f.closed:
+            self.f.close()
+
+def checkpoint_matches_output(path, checkpoint):
+    # A checkpoint that points past the end of the output file (the file was deleted or replaced) cannot be resumed
+    return not checkpoint.output_offset or (os.path.exists(path) and os.path.getsize(path) >= checkpoint.output_offset)
+
+def open_record_writer(path, checkpoint):
+    # The writer for a run resuming from checkpoint; a checkpoint that does not match the output file
+    # is dropped and the run starts over
+    if not checkpoint_matches_output(path, checkpoint):
+        print(f"{path} is missing or shorter than its checkpoint; starting the load from the beginning")
+        checkpoint.reset()
+    return RecordWriter(path, checkpoint.output_offset)
+
+def insert_chunk(collection, chunk, batch_size=20):
+    # Insert stage: the Data API takes a limited number of documents per insertMany call.
+    # Documents that already exist (e.g. re-sent after a crash) are not treated as errors.
+    for start in range(0, len(chunk), batch_size):
+        documents = []
+        for record in chunk[start:start + batch_size]:
+            document = {key: value for key, value in record.items() if key != 'vector'}
+            document['$vector'] = record['vector']
+            documents.append(document)
+        res = collection.insert_many(documents, options={'ordered': False}, partial_failures_allowed=True)
+        errors = [error for error in res.get('errors', []) if error.get('errorCode') != 'DOCUMENT_ALREADY_EXISTS']
+        if errors:
+            raise ValueError(json.dumps(errors))
+
+def run_pipeline(bikes, model, output_path=None, collection=None, checkpoint_path=None,
+                 chunk_size=100, insert_batch_size=20, cache=None, client=None, progress=None, summary_tokens=SUMMARY_TOKENS):
+    # Stream bikes through embedding into the output file and/or the collection.
+    # Returns the number of rows committed by this run.
+    checkpoint = Checkpoint(checkpoint_path or (output_path or 'ingest') + '.checkpoint')
+    writer = open_record_writer(output_path, checkpoint) if output_path else None
+
+    rows = 0
+    try:
+        chunks = summarize_chunks(iter_chunks(iter_records(bikes, model, start=checkpoint.rows), chunk_size), summary_tokens)
+        for chunk in embed_chunks(chunks, model, cache, client):
+            offset = writer.write_chunk(chunk) if writer else 0
+            if collection is not None:
+                insert_chunk(collection, chunk, insert_batch_size)
+            checkpoint.commit(len(chunk), offset)
+            rows += len(chunk)
+            if progress:
+                progress(checkpoint.rows)
+        if writer:
+            writer.finish()
+    finally:
+        if writer:
+            writer.close()
+    # The run is complete, so the next run starts from scratch
+    checkpoint.clear()
+    return rows
+
+# Incremental sync: only new or changed bikes are embedded and upserted, and removed bikes are deleted.
+# Each stored document carries a fingerprint of the fields it was built from, so a change is detected
+# without re-embedding. Documents use a stable key derived from brand and model as their _id,
+# so adding or removing a bike does not shift the ids of the others. Full loads write the same keys.
+
+FINGERPRINT_FIELD = 'fingerprint'
+
+def record_fingerprint(bike, model):
+    # Hash of the embedding model and every source field, in a canonical form
+    canonical = json.dumps({'model_id': model, 'bike': bike}, sort_keys=True, ensure_ascii=True)
+    return hashlib.sha256(canonical.encode('ascii')).hexdigest()
+
+def iter_keyed_records(bikes, model):
+    # Give each bike a stable _id; repeated brand/model pairs are numbered in catalog order
+    seen = {}
+    for bike in bikes:
+        base = f"{bike['brand']}:{bike['model']}"
+        seen[base] = seen.get(base, 0) + 1
+        record = {'_id': base if seen[base] == 1 else f"{base}:{seen[base]}"}
+        record.update(bike)
+        record[FINGERPRINT_FIELD] = record_fingerprint(bike, model)
+        yield record
+
+def stored_documents(collection, fields=()):
+    # Page through the collection reading only _id, the fingerprint and the given fields
+    projection = {FINGERPRINT_FIELD: 1}
+    projection.update((field, 1) for field in fields)
+    return {document['_id']: document for document in collection.paginated_find(projection=projection)}
+
+def sync_collection(bikes, collection, model, chunk_size=100, insert_batch_size=20, cache=None, client=None, facets=None,
+                    summary_tokens=SUMMARY_TOKENS):
+    # Bring the collection in line with the catalog. Returns counts of inserted, updated, deleted, unchanged
+    # and summarized rows (unchanged documents stored before summaries existed, given their compact fields).
+    # A FacetCatalog passed as facets is updated with the values of the changed documents.
+    stored = stored_documents(collection, [SUMMARY_FIELD] + list(facets.counts if facets is not None else ()))
+    stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'summarized': 0}
+    seen = set()
+
+    def changed_records():
+        for record in iter_keyed_records(bikes, model):
+            seen.add(record['_id'])
+            if record['_id'] in stored and stored[record['_id']].get(FINGERPRINT_FIELD) == record[FINGERPRINT_FIELD]:
+                stats['unchanged'] += 1
+                if SUMMARY_FIELD not in stored[record['_id']]:
+                    # No need to embed again: only the compact fields are added
+                    add_compact_fields(record, summary_tokens)
+                    collection.update_one(filter={'_id': record['_id']}, update={'$set': {
+                        SUMMARY_FIELD: record[SUMMARY_FIELD], ATTRIBUTES_FIELD: record[ATTRIBUTES_FIELD]}})
+                    stats['summarized'] += 1
+            else:
+                yield record
+
+    chunks = summarize_chunks(iter_chunks(changed_records(), chunk_size), summary_tokens)
+    for chunk in embed_chunks(chunks, model, cache, client):
+        new_records = [record for record in chunk if record['_id'] not in stored]
+        if new_records:
+            insert_chunk(collection, new_records, insert_batch_size)
+            stats['inserted'] += len(new_records)
+            if facets is not None:
+                for record in new_records:
+                    facets.add(record)
+        for record in chunk:
+            if record['_id'] in stored:
+                document = {key: value for key, value in record.items() if key != 'vector'}
+                document['$vector'] = record['vector']
+                collection.find_one_and_replace(replacement=document, filter={'_id': record['_id']}, options={'upsert': True})
+                stats['updated'] += 1
+                if facets is not None:
+                    facets.remove(stored[record['_id']])
+                    facets.add(record)
+
+    removed = [key for key in stored if key not in seen]
+    for start in range(0, len(removed), insert_batch_size):
+        collection.delete_many({'_id': {'$in': removed[start:start + insert_batch_size]}})
+        if facets is not None:
+            for key in removed[start:start + insert_batch_size]:
+                facets.remove(stored[key])
+    stats['deleted'] = len(removed)
+    return stats
@@ -0,0 +1,204 @@
+import heapq, json, math, os, re, threading
+
+from filters import document_matches
+
+# In-process lexical search over the bike catalog, used next to the vector search.
+# A BM25 inverted index over description, brand and model finds bikes named in the question
+# ("Hillcraft", "Eva 291"), which embeddings often rank poorly. Its results are merged with the
+# ANN results by reciprocal-rank fusion. A question that is just a brand or model name is
+# answered from the index alone, without an embedding or a vector search.
+#
+# Only questions that name a bike take part in the fusion: the lexical hits must share a brand or
+# model word with the question. Words that describe a kind of bike (those of the type field, such as
+# "kids" or "mountain") and stopwords do not count, so "a light bike for my daughter" stays a
+# vector search.
+
+DEFAULT_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bikes.json')
+
+# Brand and model terms count more than description terms (a simple BM25F)
+FIELD_WEIGHTS = {'brand': 3.0, 'model': 3.0, 'description': 1.0}
+NAME_FIELDS = ('brand', 'model')
+
+# Not indexed and ignored in questions
+STOPWORDS = frozenset('''
+a about an and any are as at be best but by can could do does for from get good has have how i i'm im
+in into is it its looking me more most my need of on one or our should so some that the their them
+there these this to too under us very want was we what when where which who why will with would you your
+'''.split())
+
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+def terms(text):
+    # The searchable words of a text: tokens without stopwords
+    return [token for token in tokenize(text) if token not in STOPWORDS]
+
+def normalize_name(text):
+    return ' '.join(tokenize(text))
+
+def document_key(document):
+    # Bikes are identified by brand and model across Astra, the local backends and the catalog file
+    return (document.get('brand'), document.get('model'))
+
+class BM25Index:
+    def __init__(self, documents, field_weights=FIELD_WEIGHTS, k1=1.2, b=0.75):
+        self.documents = list(documents)
+        term_frequencies = []
+        lengths = []
+        for document in self.documents:
+            frequencies = {}
+            length = 0.0
+            for field, weight in field_weights.items():
+                for token in terms(str(document.get(field) or '')):
+                    frequencies[token] = frequencies.get(token, 0.0) + weight
+                    length += weight
+            term_frequencies.append(frequencies)
+            lengths.append(length)
+        average_length = sum(lengths) / len(lengths) if lengths else 1.0
+
+        document_counts = {}
+        for frequencies in term_frequencies:
+            for token in frequencies:
+                document_counts[token] = document_counts.get(token, 0) + 1
+
+        # Each posting holds the document's full BM25 contribution for the term,
+        # so a query only adds up precomputed numbers
+        count = len(self.documents)
+        self.postings = {}
+        for row, frequencies in enumerate(term_frequencies):
+            norm = k1 * (1 - b + b * lengths[row] / average_length)
+            for token, frequency in frequencies.items():
+                idf = math.log(1 + (count - document_counts[token] + 0.5) / (document_counts[token] + 0.5))
+                self.postings.setdefault(token, []).append((row, idf * frequency * (k1 + 1) / (frequency + norm)))
+
+        # Name words: brand and model words that are not numbers or words of the bike types
+        type_words = {token for document in self.documents for token in tokenize(str(document.get('type') or ''))}
+        self.name_rows = {}
+        for row, document in enumerate(self.documents):
+            for field in NAME_FIELDS:
+                for token in terms(str(document.get(field) or '')):
+                    if token not in type_words and not token.isdigit():
+                        self.name_rows.setdefault(token, set()).add(row)
+
+        # Exact names: model, brand, and brand followed by model
+        self.names = {}
+        for row, document in enumerate(self.documents):
+            brand, model = document.get('brand') or '', document.get('model') or ''
+            for name in {model, brand, f"{brand} {model}"}:
+                if normalize_name(name):
+                    self.names.setdefault(normalize_name(name), []).append(row)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_DATA_FILE, **kwargs):
+        with open(path) as f:
+            return cls(json.load(f), **kwargs)
+
+    def scores(self, query):
+        scores = {}
+        for token in set(terms(query)):
+            for row, weight in self.postings.get(token, ()):
+                scores[row] = scores.get(row, 0.0) + weight
+        return scores
+
+    def project(self, row, fields, score=None):
+        document = self.documents[row]
+        result = {field: document[field] for field in fields if field in document} if fields else dict(document)
+        if score is not None:
+            result['$lexical_score'] = score
+        return result
+
+    def named_rows(self, query):
+        # Rows whose brand or model shares a name word with the query
+        rows = set()
+        for token in set(terms(query)):
+            rows |= self.name_rows.get(token, set())
+        return rows
+
+    def search(self, query, limit, filter=None, fields=None, named=False):
+        # Best `limit` documents for the query, highest BM25 score first.
+        # named=True keeps only bikes the question names (see named_rows), for the fusion.
+        scores = self.scores(query)
+        if named:
+            rows = self.named_rows(query)
+            scores = {row: score for row, score in scores.items() if row in rows}
+        if filter:
+            scores = {row: score for row, score in scores.items() if document_matches(self.documents[row], filter)}
+        best = heapq.nlargest(int(limit), scores.items(), key=lambda item: item[1])
+        return [self.project(row, fields, score) for row, score in best]
+
+    def exact_matches(self, query, limit, filter=None, fields=None):
+        # Documents whose brand, model or "brand model" is exactly the question, or None
+        rows = self.names.get(normalize_name(query))
+        if not rows:
+            return None
+        rows = [row for row in rows if document_matches(self.documents[row], filter)]
+        if not rows:
+            return None
+        # A brand can name several bikes; rank them by how well the rest of their text matches
+        scores = self.scores(query)
+        rows = sorted(rows, key=lambda row: -scores.get(row, 0.0))[:int(limit)]
+        return [self.project(row, fields, scores.get(row, 0.0)) for row in rows]
+
+def resolve_documents(collection, documents, fields, embedding=None, known=()):
+    # The stored copies of lexical hits, looked up by model in one request: they carry the
+    # collection's _id and, given the query embedding, the $similarity a vector search would report.
+    # Hits among the `known` results (already from the collection) are kept as they are;
+    # hits the collection does not hold are left out.
+    known = {document_key(document) for document in known}
+    wanted = {document_key(document) for document in documents} - known
+    if not wanted:
+        return [document for document in documents if document_key(document) in known]
+    projection = {field: 1 for field in fields}
+    if embedding is not None:
+        projection['$vector'] = 1
+    stored = {}
+    for document in collection.paginated_find(filter={'model': {'$in': sorted({model for _, model in wanted})}}, projection=projection):
+        if document_key(document) in wanted:
+            stored.setdefault(document_key(document), document)
+    if embedding is not None and stored:
+        import numpy as np
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        for document in stored.values():
+            vector = document.pop('$vector', None)
+            if vector is None:
+                continue
+            vector = np.asarray(vector, dtype=np.float32)
+            # On Astra's (1 + cosine) / 2 scale
+            document['$similarity'] = float((1.0 + vector @ query / (np.linalg.norm(vector) or 1.0)) / 2.0)
+    return [document if document_key(document) in known
+            else dict(stored[document_key(document)], **{'$lexical_score': document.get('$lexical_score')})
+            for document in documents if document_key(document) in known or document_key(document) in stored]
+
+# A small constant keeps the fused order close to the ranks. With the usual 60, a lexical list of any
+# weight near 0.5 takes half of the top k; with 1 and the default weight, lexical-only hits get about
+# a quarter of it and a named bike the vector search also found moves up.
+RRF_K = 1
+
+def reciprocal_rank_fusion(vector_results, lexical_results, k, weight=0.3, rrf_k=RRF_K):
+    # Merge two ranked lists: each document scores weight / (rrf_k + rank) from the lexical list and
+    # (1 - weight) / (rrf_k + rank) from the vector list. The vector copy of a document is kept when
+    # both lists have it, since it carries the _id and $similarity.
+    fused = {}
+    for results, list_weight in ((vector_results, 1.0 - weight), (lexical_results, weight)):
+        for rank, document in enumerate(results, 1):
+            entry = fused.setdefault(document_key(document), [0.0, document])
+            entry[0] += list_weight / (rrf_k + rank)
+    ordered = sorted(fused.values(), key=lambda entry: -entry[0])[:int(k)]
+    return [dict(document, **{'$rrf_score': score}) for score, document in ordered]
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+def get_lexical_index():
+    # Process-wide index over LEXICAL_DATA_FILE (data/bikes.json by default), built on first use
+    global _default_index
+    path = os.getenv('LEXICAL_DATA_FILE') or DEFAULT_DATA_FILE
+    with _default_index_lock:
+        if _default_index is None or _default_index[0] != path:
+            _default_index = (path, BM25Index.from_file(path))
+        return _default_index[1]
+
+def lexical_weight():
+    # Weight of the lexical list in the fusion; 0 turns the lexical side off
+    return float(os.getenv('LEXICAL_WEIGHT', '0.3'))
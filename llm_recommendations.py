@@ -0,0 +1,99 @@
+import asyncio, re, threading, time
+from collections import OrderedDict
+
+from embeddings import count_tokens
+from request_scheduler import get_scheduler
+
+# Concurrent, streaming generation of the per-bike recommendations.
+# Prompts are sent in parallel (bounded by a semaphore) and tokens are handed to a callback
+# as they arrive, so the first explanation appears as soon as its first token is generated.
+# Completions are cached per (bike, normalized question). Requests go through the model's request
+# scheduler in the interactive lane, ahead of any background ingest.
+
+def normalize_query(text):
+    # Case, spacing and trailing punctuation do not change the question
+    return re.sub(r'\s+', ' ', text).strip().strip('?!. ').lower()
+
+class CompletionCache:
+    # Bounded LRU map of (bike key, normalized question) -> completion text
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bike_key, query):
+        key = (bike_key, normalize_query(query))
+        with self.lock:
+            text = self.entries.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def put(self, bike_key, query, text):
+        if self.max_entries <= 0:
+            return
+        key = (bike_key, normalize_query(query))
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+async def stream_completion(client, prompt, on_text, model, temperature=0.1, max_tokens=256):
+    # Stream one completion, calling on_text with the text received so far
+    text = ''
+    stream = await client.completions.create(
+        model=model, prompt=prompt, temperature=temperature, max_tokens=max_tokens, stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].text:
+            text += chunk.choices[0].text
+            on_text(text)
+    return text
+
+async def generate_recommendations(client, prompts, bike_keys, query, on_update, model,
+                                   cache=None, concurrency=5, temperature=0.1, max_tokens=256):
+    # Generate one completion per prompt, at most `concurrency` at a time.
+    # on_update(i, text, done) is called as text for prompt i arrives.
+    # Returns the texts in prompt order and the time to the first visible output in seconds.
+    start = time.perf_counter()
+    first_output = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def update(i, text, done):
+        if not first_output:
+            first_output.append(time.perf_counter() - start)
+        on_update(i, text, done)
+
+    async def run(i):
+        cached = cache.get(bike_keys[i], query) if cache is not None else None
+        if cached is not None:
+            update(i, cached, True)
+            return cached
+        async with semaphore:
+            # A retried completion starts over; on_update always gets the full text so far, so it simply restarts
+            text = await get_scheduler(model).call_async(
+                lambda: stream_completion(client, prompts[i], lambda partial: update(i, partial, False), model, temperature, max_tokens),
+                count_tokens(prompts[i], model) + max_tokens, 'interactive',
+            )
+        update(i, text, True)
+        if cache is not None:
+            cache.put(bike_keys[i], query, text)
+        return text
+
+    texts = await asyncio.gather(*(run(i) for i in range(len(prompts))))
+    return list(texts), (first_output[0] if first_output else None)
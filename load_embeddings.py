@@ -1,99 +1,221 @@
-from astrapy.db import AstraDB
+import os
 
-import openai, os, uuid, requests
-import pandas as pd
-
-from traceloop.sdk import Traceloop
-from traceloop.sdk.tracing import tracing as Tracer
-from traceloop.sdk.decorators import workflow, task, agent
+from telemetry import init_telemetry, workflow, task
 from dotenv import load_dotenv, find_dotenv
 
+from ingest_pipeline import Checkpoint, run_pipeline, sync_collection
+from embedding_cache import get_default_cache
+from embeddings import embedding_dimension
+from facet_catalog import FacetCatalog, catalog_file
+from data_sources import DataSource
+from sharded_ingest import run_sharded_pipeline, shards_resuming
+
+# astrapy, requests (remote data sources) and numpy (vector_store) are imported by the tasks that use them, to keep startup fast
+
 # Load the .env file
 if not load_dotenv(find_dotenv(),override=True):
     raise Exception("Couldn't load .env file")
 
 #Add Telemetry
-TRACELOOP_API_KEY=os.getenv('TRACELOOP_API_KEY')
-Traceloop.init(app_name="Bike Recommendation App", disable_batch=True)
-# Generate a UUID
-uuid_obj = str(uuid.uuid4())
-Tracer.set_correlation_id(uuid_obj)
+init_telemetry(app_name="Bike Recommendation App")
 
 #declare constant
 ASTRA_DB_APPLICATION_TOKEN=os.getenv('ASTRA_DB_APPLICATION_TOKEN')
 ASTRA_DB_API_ENDPOINT=os.getenv('ASTRA_DB_API_ENDPOINT')
 ASTRA_COLLECTION=os.getenv('ASTRA_COLLECTION')
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
 model_id = "text-embedding-ada-002"
-vector_len = len(openai.embeddings.create(input="This is to generate an embedding to count the dimension.", model=model_id).data[0].embedding)
+
+INGEST_OUTPUT_FILE = os.getenv('INGEST_OUTPUT_FILE', 'bikes_withVector.json')
+INGEST_CHECKPOINT_FILE = INGEST_OUTPUT_FILE + '.checkpoint'
+# Prefix of a sharded load's manifest, shard files and checkpoints, also when only the collection is loaded
+INGEST_SHARD_PREFIX = INGEST_OUTPUT_FILE
+# "full" truncates and reloads the collection, "sync" only applies the changes
+LOAD_MODE = os.getenv('LOAD_MODE', 'full')
+# Directory for a binary copy of the output file (memory-mapped vectors plus columnar metadata); empty to skip
+INGEST_VECTOR_STORE = os.getenv('INGEST_VECTOR_STORE', '')
+INGEST_VECTOR_DTYPE = os.getenv('INGEST_VECTOR_DTYPE', 'float32')
+# Directory for the precomputed nearest bikes of every bike, shown by the UI as "similar bikes"; empty to skip
+NEIGHBOR_TABLE = os.getenv('NEIGHBOR_TABLE', 'bike_neighbors')
+NEIGHBOR_COUNT = int(os.getenv('NEIGHBOR_COUNT', '10'))
+# Token bound of the per-bike summary stored for the recommendation prompts
+INGEST_SUMMARY_TOKENS = int(os.getenv('INGEST_SUMMARY_TOKENS', '40'))
+# Worker processes for a full load; with more than one, the catalog is split into shards loaded in parallel
+INGEST_SHARDS = int(os.getenv('INGEST_SHARDS', '1'))
+# Catalog files, globs or URLs to load, separated by commas; the repository's data/bikes.json by default
+DATA_SOURCE = os.getenv('DATA_SOURCE', '')
+# Distinct bike types with their counts, read by the query scripts to check type filters
+FACET_CATALOG_FILE = catalog_file()
 
 @task(name="Establish Astra DB Connection")
 def create_connection():
     #Establish Connectivity
-    astra_db = AstraDB(token=ASTRA_DB_APPLICATION_TOKEN, api_endpoint=ASTRA_DB_API_ENDPOINT)
+    from astrapy.db import AstraDB
+    from http_clients import use_pooled_client
+    astra_db = use_pooled_client(AstraDB(token=ASTRA_DB_APPLICATION_TOKEN, api_endpoint=ASTRA_DB_API_ENDPOINT))
     return astra_db
 
 @task(name="Refresh Collection")
 def refresh_collection(astra_db):
+    from http_clients import use_pooled_client
     # Check whether the collection exists
     collection_list = astra_db.get_collections()
     print("Existing Collections: " + str(collection_list))
 
-    if ASTRA_COLLECTION not in collection_list['status']['collections']:
+    resuming = Checkpoint(INGEST_CHECKPOINT_FILE).resuming or shards_resuming(INGEST_SHARD_PREFIX)
+    if ASTRA_COLLECTION in collection_list['status']['collections'] and resuming:
+        # Keep the rows committed by the interrupted run
+        collection = use_pooled_client(astra_db.collection(ASTRA_COLLECTION))
+        print("Resuming load into Collection: " + ASTRA_COLLECTION)
+    elif ASTRA_COLLECTION not in collection_list['status']['collections']:
         # Create the collection
-        collection = astra_db.create_collection(ASTRA_COLLECTION, dimension=vector_len)
+        collection = use_pooled_client(astra_db.create_collection(ASTRA_COLLECTION, dimension=embedding_dimension(model_id)))
         print("Collection Created: " + ASTRA_COLLECTION)
     else:
         # Truncate the collection
-        collection = astra_db.truncate_collection(ASTRA_COLLECTION)
+        collection = use_pooled_client(astra_db.truncate_collection(ASTRA_COLLECTION))
         print("Collection Truncated: " + ASTRA_COLLECTION)
     return collection
 
 
-@task(name="Download Raw json data file from source")
+@task(name="Get or Create Collection")
+def get_or_create_collection(astra_db):
+    from http_clients import use_pooled_client
+    # Used by the incremental sync, which never truncates the collection
+    collection_list = astra_db.get_collections()
+    if ASTRA_COLLECTION not in collection_list['status']['collections']:
+        collection = use_pooled_client(astra_db.create_collection(ASTRA_COLLECTION, dimension=embedding_dimension(model_id)))
+        print("Collection Created: " + ASTRA_COLLECTION)
+    else:
+        collection = use_pooled_client(astra_db.collection(ASTRA_COLLECTION))
+    return collection
+
+@task(name="Open the bike catalog data source")
 def load_data_file():
-    #load data from sample json file
-    url = "https://raw.githubusercontent.com/ykimoto/HybridWithAstrapy/master/data/bikes.json"
-    header= {"content-type": "application/json"}
-    response = requests.get(url, headers=header)
-    bikes = response.json()
-    bikes = pd.DataFrame(bikes)
+    # The catalog as a stream of records from DATA_SOURCE: local files or globs (data/bikes.json by default),
+    # or URLs that are cached and only downloaded again when they change. Nothing is parsed until the
+    # pipeline reads the records, and each pass over them reads the files again.
+    bikes = DataSource(DATA_SOURCE)
+    print(f"Reading bikes from {', '.join(bikes.paths())}")
     return bikes
 
 @task(name="Create and load Embeddings")    
 def create_load_embeddings(bikes, collection):
+    # Stream the bikes through summarizing and embedding in chunks of INGEST_CHUNK_SIZE rows.
+    # Each chunk is appended to the output file and, when INGEST_TARGETS includes "collection",
+    # inserted with insert_many. A checkpoint file lets an interrupted run resume.
+    targets = [target.strip() for target in os.getenv('INGEST_TARGETS', 'file').split(',')]
 
-    _id = []
-    vector = []
-
-    for id in bikes.index:
-        _id.append(id)
-        description = bikes['description'][id].replace(',', '\,')
-        description = description.replace('"', '\"')
-
-        full_chunk = bikes['description'][id]
-        vector.append(openai.embeddings.create(input=full_chunk, model=model_id).data[0].embedding)
-
-    bikes['vector'] = vector
-    bikes['_id'] = _id
-    cols = bikes.columns.tolist()
-    cols = cols[-1:] + cols[:-1]
-    bikes = bikes[cols]
-
-    bikes_json = bikes.to_json(orient='records', force_ascii=True)
+    if INGEST_SHARDS > 1:
+        rows = load_shards(bikes, targets)
+    else:
+        rows = run_pipeline(
+            bikes,
+            model=model_id,
+            output_path=INGEST_OUTPUT_FILE if 'file' in targets else None,
+            collection=collection if 'collection' in targets else None,
+            checkpoint_path=INGEST_CHECKPOINT_FILE,
+            chunk_size=int(os.getenv('INGEST_CHUNK_SIZE', '100')),
+            insert_batch_size=int(os.getenv('INGEST_INSERT_BATCH_SIZE', '20')),
+            cache=get_default_cache(),
+            progress=lambda committed: print(f"Committed {committed} rows"),
+            summary_tokens=INGEST_SUMMARY_TOKENS,
+        )
+    print(f"Embedded and stored {rows} rows")
+
+    if INGEST_VECTOR_STORE and 'file' in targets:
+        export_binary_vectors()
+    if NEIGHBOR_TABLE and 'file' in targets:
+        compute_neighbors(collection if 'collection' in targets else None)
+    build_facet_catalog(bikes)
 
-    # Dec 29, 2023: This is failing at the moment.  Need to investigate.
-    #
-    # Load the data into the collection
-    # res = collection.insert_many(bikes_json)
-    # return res
-    
-    # Resorting to generate a json file to upload and ingest via the Astra UI
-    with open('bikes_withVector.json', 'w') as f:
-        f.write(bikes_json)
-    
     return("OK")
+
+@task(name="Load shards in parallel")
+def load_shards(bikes, targets):
+    # INGEST_SHARDS worker processes each load every INGEST_SHARDS-th chunk; their files are merged into INGEST_OUTPUT_FILE
+    stats = run_sharded_pipeline(
+        ','.join(bikes.paths()),
+        model=model_id,
+        shards=INGEST_SHARDS,
+        output_path=INGEST_OUTPUT_FILE if 'file' in targets else None,
+        collection=(ASTRA_COLLECTION, ASTRA_DB_APPLICATION_TOKEN, ASTRA_DB_API_ENDPOINT) if 'collection' in targets else None,
+        chunk_size=int(os.getenv('INGEST_CHUNK_SIZE', '100')),
+        insert_batch_size=int(os.getenv('INGEST_INSERT_BATCH_SIZE', '20')),
+        summary_tokens=INGEST_SUMMARY_TOKENS,
+        progress=lambda committed, rate: print(f"Committed {committed} rows ({rate:.0f} rows/s)"),
+        prefix=INGEST_SHARD_PREFIX,
+    )
+    for shard in stats['shards']:
+        print(f"Shard {shard['shard']}: {shard['rows']} rows in {shard['seconds']:.1f}s ({shard['rows_per_second']:.0f} rows/s)")
+    print(f"{INGEST_SHARDS} shards: {stats['rows']} rows in {stats['seconds']:.1f}s ({stats['rows_per_second']:.0f} rows/s)")
+    return stats['rows']
+
+@task(name="Export binary vector store")
+def export_binary_vectors():
+    # Convert the finished output file into the compact format read by the local search backends
+    from vector_store import export_vector_store, iter_vector_file
+    meta = export_vector_store(iter_vector_file(INGEST_OUTPUT_FILE), INGEST_VECTOR_STORE, INGEST_VECTOR_DTYPE, model_id)
+    print(f"Wrote {meta['count']} {meta['dtype']} vectors to {INGEST_VECTOR_STORE}")
+
+@task(name="Compute nearest neighbors")
+def compute_neighbors(collection):
+    # Offline top-N similar bikes, overall and per type, from the finished output (the binary store when there is one).
+    # Written as a local table and, when loading a collection, as neighbors/type_neighbors fields on its documents.
+    from neighbor_table import build_neighbor_table, store_neighbor_fields
+    ids, tables = build_neighbor_table(INGEST_VECTOR_STORE or INGEST_OUTPUT_FILE, NEIGHBOR_TABLE, NEIGHBOR_COUNT)
+    print(f"Wrote {NEIGHBOR_COUNT} neighbors per bike for {len(ids)} bikes to {NEIGHBOR_TABLE}")
+    if collection is not None:
+        store_neighbor_fields(collection, ids, tables)
+
+@task(name="Build facet catalog")
+def build_facet_catalog(bikes):
+    catalog = FacetCatalog.from_documents(bikes, FACET_CATALOG_FILE)
+    catalog.save()
+    print(f"Wrote {len(catalog.values())} bike types to {FACET_CATALOG_FILE}")
+
+@task(name="Sync changed Embeddings")
+def sync_embeddings(bikes, collection):
+    # Only embed and upsert bikes whose fingerprint changed, and delete bikes no longer in the catalog.
+    # The facet catalog is updated with the changes; without one yet, it is built from the whole catalog.
+    facets = FacetCatalog.load(FACET_CATALOG_FILE) if os.path.exists(FACET_CATALOG_FILE) else None
+    stats = sync_collection(
+        bikes,
+        collection,
+        model=model_id,
+        chunk_size=int(os.getenv('INGEST_CHUNK_SIZE', '100')),
+        insert_batch_size=int(os.getenv('INGEST_INSERT_BATCH_SIZE', '20')),
+        cache=get_default_cache(),
+        facets=facets,
+        summary_tokens=INGEST_SUMMARY_TOKENS,
+    )
+    if facets is not None:
+        facets.save()
+    else:
+        build_facet_catalog(bikes)
+    if NEIGHBOR_COUNT > 0 and (stats['inserted'] or stats['updated'] or stats['deleted'] or not neighbors_match(collection)):
+        refresh_neighbors(collection)
+    print("Sync complete: " + str(stats))
+    return stats
+
+def neighbors_match(collection):
+    # Whether the local neighbor table is keyed by the _ids the collection holds (older loads used row numbers)
+    if not NEIGHBOR_TABLE:
+        return True
+    if not os.path.exists(os.path.join(NEIGHBOR_TABLE, 'meta.json')):
+        return False
+    from neighbor_table import NeighborTable
+    document = (collection.find_one(projection={'_id': 1}) or {}).get('data', {}).get('document') or {}
+    return document.get('_id') in NeighborTable(NEIGHBOR_TABLE).rows
+
+@task(name="Refresh nearest neighbors")
+def refresh_neighbors(collection):
+    # Inserted documents have no neighbor fields and replaced documents lose theirs,
+    # so the neighbors are recomputed from the collection's own vectors and _ids
+    from neighbor_table import refresh_collection_neighbors
+    count, updated = refresh_collection_neighbors(collection, NEIGHBOR_TABLE, NEIGHBOR_COUNT)
+    print(f"Recomputed {NEIGHBOR_COUNT} neighbors per bike for {count} bikes"
+          + (f" in {NEIGHBOR_TABLE}" if NEIGHBOR_TABLE else '') + f"; updated {updated} documents")
     
     
 
@@ -102,7 +224,14 @@ def create_load_embeddings(bikes, collection):
 def run_loading_data():
     #Create Connection
     astra_db = create_connection()
-    
+
+    if LOAD_MODE == 'sync':
+        #Update the Bike Catalog Collection in place
+        collection = get_or_create_collection(astra_db)
+        bikes = load_data_file()
+        res = sync_embeddings(bikes, collection)
+        return
+
     #Create or Truncate the Bike Catalog Collection
     collection = refresh_collection(astra_db)
 
@@ -111,4 +240,5 @@ def run_loading_data():
     #call embedding function and load data
     res = create_load_embeddings(bikes, collection)
 
-run_loading_data()
\ No newline at end of file
+if __name__ == "__main__":
+    run_loading_data()
\ No newline at end of file
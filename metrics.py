@@ -0,0 +1,203 @@
+import bisect, json, math, threading, time
+from collections import deque
+from contextlib import contextmanager
+
+# Per-stage latency recording with percentile summaries.
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.items = {}
+        self.started = time.perf_counter()
+
+    def record(self, stage, seconds, items=1):
+        # items is the number of units (queries, rows) the sample covered, for throughput
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            self.items[stage] = self.items.get(stage, 0) + items
+
+    @contextmanager
+    def timed(self, stage, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, items)
+
+    def summary(self):
+        # Stage -> count, items, total seconds, throughput and p50/p95/p99 latency in milliseconds
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            stages = {stage: sorted(samples) for stage, samples in self.samples.items()}
+            items = dict(self.items)
+        result = {}
+        for stage, samples in stages.items():
+            result[stage] = {
+                'count': len(samples),
+                'items': items[stage],
+                'seconds': sum(samples),
+                'items_per_second': items[stage] / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p95_ms': percentile(samples, 0.95) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+            }
+        return result
+
+    def format_summary(self):
+        lines = [f"{'stage':<12} {'count':>7} {'items':>7} {'items/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+        for stage, stats in self.summary().items():
+            lines.append(
+                f"{stage:<12} {stats['count']:>7} {stats['items']:>7} {stats['items_per_second']:>9.1f}"
+                f" {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}"
+            )
+        return '\n'.join(lines)
+
+# Process-wide metrics for the running apps: latency histograms per stage, counters (e.g. tokens)
+# and collectors that report cache statistics. They can be dumped to a file or scraped over HTTP
+# without an OpenTelemetry collector.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    # observe() only appends to a deque (atomic, no lock) so it stays cheap on the hot path;
+    # pending values are folded into the buckets in batches and whenever a snapshot is taken
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= 4096:
+            self._fold()
+
+    def _fold(self):
+        with self.lock:
+            while True:
+                try:
+                    value = self.pending.popleft()
+                except IndexError:
+                    break
+                self.counts[bisect.bisect_left(self.buckets, value)] += 1
+                self.count += 1
+                self.total += value
+
+    def snapshot(self):
+        self._fold()
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.total
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(list(self.buckets) + [float('inf')], counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {'count': count, 'sum': total, 'buckets': cumulative}
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = {}
+
+    def histogram(self, name):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            return self.histograms[name]
+
+    def counter(self, name):
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Counter()
+            return self.counters[name]
+
+    def register_collector(self, name, collect):
+        # collect() returns a dict of numbers, read each time metrics are dumped
+        with self.lock:
+            self.collectors[name] = collect
+
+    def dump(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            collectors = dict(self.collectors)
+        return {
+            'latency_seconds': {name: histogram.snapshot() for name, histogram in histograms.items()},
+            'counters': {name: counter.value for name, counter in counters.items()},
+            'collectors': {name: collect() for name, collect in collectors.items()},
+        }
+
+    def prometheus_text(self):
+        # Prometheus text exposition format
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"')
+        data = self.dump()
+        lines = ['# TYPE stage_latency_seconds histogram']
+        for stage, snapshot in data['latency_seconds'].items():
+            for bound, count in snapshot['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'stage_latency_seconds_bucket{{stage="{label(stage)}",le="{le}"}} {count}')
+            lines.append(f'stage_latency_seconds_sum{{stage="{label(stage)}"}} {snapshot["sum"]}')
+            lines.append(f'stage_latency_seconds_count{{stage="{label(stage)}"}} {snapshot["count"]}')
+        for name, value in data['counters'].items():
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        for name, values in data['collectors'].items():
+            for key, value in values.items():
+                lines.append(f'{name}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+def metrics_handler():
+    # http.server is only imported when the endpoint is enabled; it is slow to import
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith('/metrics.json'):
+                body, content_type = json.dumps(REGISTRY.dump()).encode('utf-8'), 'application/json'
+            elif self.path.startswith('/metrics'):
+                body, content_type = REGISTRY.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return MetricsHandler
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # Serve /metrics (Prometheus text) and /metrics.json from a background thread
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), metrics_handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
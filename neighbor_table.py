@@ -0,0 +1,246 @@
+import argparse, json, os, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from vector_backends import NumpyBackend
+from vector_store import VECTOR_KEYS, export_vector_store, is_vector_store, iter_vector_file
+
+# Precomputed "more like this": the top-N most similar bikes of every bike, over the whole catalog
+# and within its own type. It is computed offline by the loader, so the UI can show similar bikes
+# for any result without an embedding or a vector search.
+#
+# The similarity matrix is never held whole. It is computed one tile of
+# NEIGHBOR_BLOCK_ROWS x NEIGHBOR_BLOCK_COLUMNS at a time, and only the running top N of each row is
+# kept, so memory depends on the tile size and N, not on the size of the catalog. The tiles are read
+# from a memory-mapped vector store (see vector_store.py); a JSON/JSONL export or the documents of a
+# collection are first streamed into a temporary one, holding only the _id, type and vector.
+#
+# A neighbor table is a directory:
+#
+#   meta.json    count, n and the _id of every row
+#   all.idx      int32 count x n row numbers of the nearest bikes, best first, -1 when there are fewer
+#   all.sim      float16 count x n cosine similarities
+#   type.idx     the same within the bike's type
+#   type.sim
+
+FORMAT_VERSION = 1
+NEIGHBOR_BLOCK_ROWS = 1024
+NEIGHBOR_BLOCK_COLUMNS = 2048
+# Fields set on each collection document
+NEIGHBOR_FIELDS = {'all': 'neighbors', 'type': 'type_neighbors'}
+# Documents whose neighbor fields are written per round of concurrent updates
+NEIGHBOR_WRITE_BATCH = 1000
+
+def merge_top(best_rows, best_scores, rows, scores, n):
+    # Keep the n highest scores per row of two candidate sets
+    rows = np.concatenate([best_rows, rows], axis=1)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    if scores.shape[1] > n:
+        keep = np.argpartition(scores, -n, axis=1)[:, -n:]
+        rows = np.take_along_axis(rows, keep, axis=1)
+        scores = np.take_along_axis(scores, keep, axis=1)
+    return rows, scores
+
+def above_threshold(scores, thresholds):
+    # Columns of each row that score above the row's threshold, packed to the left and padded with -inf.
+    # Once a row has n neighbors, only the few columns that beat its worst one are merged.
+    above = scores > thresholds[:, None]
+    counts = above.sum(axis=1)
+    width = int(counts.max()) if len(counts) else 0
+    rows, columns = np.nonzero(above)
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    packed_columns = np.zeros((len(scores), width), dtype=np.int64)
+    packed_scores = np.full((len(scores), width), -np.inf, dtype=np.float32)
+    packed_columns[rows, slots] = columns
+    packed_scores[rows, slots] = scores[rows, columns]
+    return packed_columns, packed_scores
+
+def top_neighbors(unit_rows, candidates, n, block_rows=NEIGHBOR_BLOCK_ROWS, block_columns=NEIGHBOR_BLOCK_COLUMNS):
+    # Top n neighbors of every row in candidates (sorted row numbers) among the same candidates.
+    # unit_rows(rows) returns the normalised float32 vectors of the given rows.
+    count = len(candidates)
+    n = min(n, max(count - 1, 0))
+    indices = np.full((count, n), -1, dtype=np.int32)
+    similarities = np.zeros((count, n), dtype=np.float32)
+    if n == 0:
+        return indices, similarities
+    for start in range(0, count, block_rows):
+        queries = unit_rows(candidates[start:start + block_rows])
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for column in range(0, count, block_columns):
+            column_rows = candidates[column:column + block_columns]
+            scores = queries @ unit_rows(column_rows).T
+            # A bike is not its own neighbor
+            own = np.arange(start, start + len(queries))
+            inside = (own >= column) & (own < column + len(column_rows))
+            scores[np.flatnonzero(inside), own[inside] - column] = -np.inf
+            if best_scores.shape[1] < n:
+                tile_rows = np.broadcast_to(column_rows, scores.shape)
+            else:
+                columns, scores = above_threshold(scores, best_scores.min(axis=1))
+                tile_rows = column_rows[columns]
+            best_rows, best_scores = merge_top(best_rows, best_scores, tile_rows, scores, n)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        indices[start:start + len(queries)] = np.take_along_axis(best_rows, order, axis=1)
+        similarities[start:start + len(queries)] = np.take_along_axis(best_scores, order, axis=1)
+    return indices, similarities
+
+def compute_neighbor_table(backend, n, **kwargs):
+    # {'all': (indices, similarities), 'type': (...)} for every row of a NumpyBackend
+    count = len(backend.documents)
+    tables = {'all': top_neighbors(backend.unit_rows, np.arange(count), n, **kwargs)}
+    indices = np.full((count, min(n, max(count - 1, 0))), -1, dtype=np.int32)
+    similarities = np.zeros(indices.shape, dtype=np.float32)
+    types = np.array([str(value) for value in backend.field_values('type')])
+    for value in np.unique(types):
+        rows = np.flatnonzero(types == value)
+        group_indices, group_similarities = top_neighbors(backend.unit_rows, rows, n, **kwargs)
+        width = group_indices.shape[1]
+        indices[rows, :width] = group_indices
+        similarities[rows, :width] = group_similarities
+    tables['type'] = (indices, similarities)
+    return tables
+
+def write_neighbor_table(path, ids, tables):
+    os.makedirs(path, exist_ok=True)
+    for name, (indices, similarities) in tables.items():
+        indices.astype(np.int32).tofile(os.path.join(path, f'{name}.idx'))
+        similarities.astype(np.float16).tofile(os.path.join(path, f'{name}.sim'))
+    meta = {'format': FORMAT_VERSION, 'count': len(ids), 'n': tables['all'][0].shape[1], 'ids': ids}
+    # meta.json is written last, so a half-written table cannot be opened
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+def neighbor_records(records, stored=None):
+    # The _id, type and vector of every record that has a vector. With a dict as stored, the
+    # neighbor fields each record already has are collected into it, keyed by _id.
+    for record in records:
+        key = next((key for key in VECTOR_KEYS if record.get(key) is not None), None)
+        if key is None:
+            continue
+        if stored is not None:
+            stored[record['_id']] = {field: record[field] for field in NEIGHBOR_FIELDS.values() if field in record}
+        yield {'_id': record['_id'], 'type': record.get('type'), 'vector': record[key]}
+
+def compute_store_neighbors(store_path, n, **kwargs):
+    # (ids, tables) for a vector store, read tile by tile through its memory map
+    backend = NumpyBackend.from_file(store_path)
+    return list(backend.field_values('_id')), compute_neighbor_table(backend, n, **kwargs)
+
+def compute_record_neighbors(records, n, scratch_dir=None, **kwargs):
+    # (ids, tables) for neighbor_records(), streamed into a temporary float32 vector store first
+    with tempfile.TemporaryDirectory(prefix='.neighbor-vectors-', dir=scratch_dir) as store_path:
+        export_vector_store(records, store_path)
+        return compute_store_neighbors(store_path, n, **kwargs)
+
+def scratch_dir(table_path):
+    # The temporary vector store goes next to the table, on the same disk
+    return os.path.dirname(os.path.abspath(table_path)) if table_path else None
+
+def build_neighbor_table(vector_path, table_path, n=10, **kwargs):
+    # Compute and write the table for a JSON/JSONL export or a vector store; returns (ids, tables)
+    if os.path.isdir(vector_path) and is_vector_store(vector_path):
+        ids, tables = compute_store_neighbors(vector_path, n, **kwargs)
+    else:
+        ids, tables = compute_record_neighbors(neighbor_records(iter_vector_file(vector_path)), n, scratch_dir(table_path), **kwargs)
+    write_neighbor_table(table_path, ids, tables)
+    return ids, tables
+
+def store_neighbor_fields(collection, ids, tables, concurrency=None, stored=None):
+    # Set the neighbors and type_neighbors fields (lists of _id) on every collection document.
+    # With the neighbor fields as stored ({_id: document}), only documents whose lists changed are updated.
+    # The Data API has no bulk update of per-document values, so the updates go through the pooled
+    # client, at most one per pooled connection at a time, NEIGHBOR_WRITE_BATCH documents per round.
+    # Returns the number of documents updated.
+    from http_clients import pool_settings, use_pooled_client
+    collection = use_pooled_client(collection)
+    concurrency = concurrency or pool_settings()['limits'].max_connections
+
+    def update(row):
+        fields = {NEIGHBOR_FIELDS[name]: [ids[i] for i in indices[row].tolist() if i >= 0]
+                  for name, (indices, _) in tables.items()}
+        current = (stored or {}).get(ids[row])
+        if current is not None and all(current.get(field) == value for field, value in fields.items()):
+            return 0
+        collection.update_one(filter={'_id': ids[row]}, update={'$set': fields})
+        return 1
+    updated = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(ids), NEIGHBOR_WRITE_BATCH):
+            updated += sum(executor.map(update, range(start, min(len(ids), start + NEIGHBOR_WRITE_BATCH))))
+    return updated
+
+def refresh_collection_neighbors(collection, table_path, n=10, **kwargs):
+    # Recompute the neighbors from the vectors the collection holds, keyed by its own _ids: after an
+    # incremental sync the local export no longer matches it. Rewrites the local table (when table_path
+    # is set) and the neighbor fields that changed, including those of inserted and replaced documents.
+    # Returns (number of bikes, documents updated).
+    projection = {'$vector': 1, 'type': 1}
+    projection.update((field, 1) for field in NEIGHBOR_FIELDS.values())
+    stored = {}
+    documents = neighbor_records(collection.paginated_find(projection=projection), stored)
+    ids, tables = compute_record_neighbors(documents, n, scratch_dir(table_path), **kwargs)
+    if table_path:
+        write_neighbor_table(table_path, ids, tables)
+    updated = store_neighbor_fields(collection, ids, tables, stored=stored)
+    return len(ids), updated
+
+class NeighborTable:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported neighbor table format: {meta['format']}")
+        self.path = path
+        self.ids = meta['ids']
+        self.n = meta['n']
+        self.rows = {_id: row for row, _id in enumerate(self.ids)}
+        shape = (len(self.ids), self.n)
+        self.tables = {}
+        for name in NEIGHBOR_FIELDS:
+            if self.n and self.ids:
+                indices = np.memmap(os.path.join(path, f'{name}.idx'), dtype=np.int32, mode='r', shape=shape)
+                similarities = np.memmap(os.path.join(path, f'{name}.sim'), dtype=np.float16, mode='r', shape=shape)
+            else:
+                indices, similarities = np.zeros(shape, dtype=np.int32), np.zeros(shape, dtype=np.float16)
+            self.tables[name] = (indices, similarities)
+
+    def neighbors(self, _id, same_type=False, limit=None):
+        # [(_id, similarity)] of the bikes most similar to _id, best first; [] for an unknown _id
+        row = self.rows.get(_id)
+        if row is None:
+            return []
+        indices, similarities = self.tables['type' if same_type else 'all']
+        return [(self.ids[i], float(similarity))
+                for i, similarity in zip(indices[row].tolist()[:limit], similarities[row].tolist()[:limit]) if i >= 0]
+
+_default_table = None
+_default_table_lock = threading.Lock()
+
+def get_neighbor_table():
+    # Process-wide table from NEIGHBOR_TABLE, reopened when the loader rewrites it; None if there is none
+    global _default_table
+    path = os.getenv('NEIGHBOR_TABLE', 'bike_neighbors')
+    try:
+        version = (path, os.stat(os.path.join(path, 'meta.json')).st_mtime_ns)
+    except OSError:
+        return None
+    with _default_table_lock:
+        if _default_table is None or _default_table[0] != version:
+            _default_table = (version, NeighborTable(path))
+        return _default_table[1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the nearest bikes of every bike")
+    parser.add_argument('input', help="bikes_withVector.json, a .jsonl export or a vector store directory")
+    parser.add_argument('output', help="Directory to write the neighbor table to")
+    parser.add_argument('--n', type=int, default=10, help="Neighbors kept per bike")
+    args = parser.parse_args()
+    ids, tables = build_neighbor_table(args.input, args.output, args.n)
+    print(f"Wrote {tables['all'][0].shape[1]} neighbors for {len(ids)} bikes to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import math, os
+
+from embeddings import count_tokens
+from bike_summaries import ATTRIBUTES_FIELD, SUMMARY_FIELD, extract_attributes, format_attributes, summarize
+
+# Bike context for the recommendation prompts, filled up to a token budget.
+# Every bike has three forms, cheapest first:
+#
+#   attributes    "Velorim Jigger: Kids bikes, $270, 12 inch, single speed, coaster brake"
+#   summary       the attributes line plus the summary stored at ingest
+#   description   the full description, as the prompts used before
+#
+# All bikes start at their attributes line in rank order. The spare budget then upgrades them to
+# their summary, and after that to their description, best-ranked bikes first. Prompt size therefore
+# no longer grows with the length of the descriptions, and k only adds a short line per bike.
+#
+#   PROMPT_CONTEXT_TOKENS=600    tokens of bike context per answer, over all bikes
+
+FORMS = ('attributes', 'summary', 'description')
+
+def default_budget():
+    return int(os.getenv('PROMPT_CONTEXT_TOKENS', '600'))
+
+def present(value):
+    # Rows from a DataFrame use NaN for a field some documents do not have
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+def bike_forms(bike):
+    # The three forms of one bike (a dict or a pandas row). Documents stored before summaries existed,
+    # and rows read from elsewhere, get their compact fields computed here.
+    attributes = bike.get(ATTRIBUTES_FIELD)
+    if not isinstance(attributes, dict):
+        attributes = extract_attributes(bike)
+    summary = bike.get(SUMMARY_FIELD)
+    if not present(summary):
+        summary = summarize(bike)
+    line = format_attributes(bike, attributes)
+    description = bike.get('description')
+    description = description.strip() if present(description) else ''
+    return [line, f"{line}. {summary}" if summary else line, f"{line}. {description}" if description else line]
+
+def build_bike_contexts(bikes, budget=None, model=None, keep_all=False):
+    # One context text per bike, in the order given (best first), together using at most `budget` tokens.
+    # Bikes whose attributes line no longer fits get None, unless keep_all keeps them at that line.
+    # Returns (texts, forms used, tokens).
+    budget = default_budget() if budget is None else budget
+    kwargs = {'model': model} if model else {}
+    forms = [bike_forms(bike) for bike in bikes]
+    costs = [[count_tokens(text, **kwargs) for text in texts] for texts in forms]
+    levels = [None] * len(forms)
+    used = 0
+    for i, cost in enumerate(costs):
+        if used + cost[0] <= budget or keep_all:
+            levels[i] = 0
+            used += cost[0]
+    for level in range(1, len(FORMS)):
+        for i, cost in enumerate(costs):
+            if levels[i] != level - 1:
+                continue
+            extra = cost[level] - cost[levels[i]]
+            if used + extra <= budget:
+                levels[i] = level
+                used += extra
+    texts = [forms[i][level] if level is not None else None for i, level in enumerate(levels)]
+    return texts, [FORMS[level] if level is not None else None for level in levels], used
@@ -0,0 +1,74 @@
+import asyncio, queue, threading
+
+# Stage-overlapped query pipeline for the Streamlit apps.
+# Independent stages run at the same time so a query costs its critical path, not the sum of its stages:
+#   - the database connection warm-up runs alongside the query embedding
+#   - with several bike types and no $in filter (CQL), one search per type runs concurrently and the results are merged by score
+#   - LLM generation runs in the background while the results table is rendered
+
+async def connect_and_embed(connect, embed, customer_input):
+    # Both calls block on the network, so run them in worker threads at the same time
+    return await asyncio.gather(asyncio.to_thread(connect), asyncio.to_thread(embed, customer_input))
+
+def in_script_thread(fn):
+    # Wrap fn for a worker thread of the pipeline: the thread gets the calling script's Streamlit
+    # context attached, so fn may write Streamlit elements (status messages) from there.
+    # Only the connection and embedding stages do; generation events go through BackgroundRun.drain().
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    ctx = get_script_run_ctx()
+    def run(*args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return run
+
+def similarity_score(record):
+    return record.get('$similarity', 0.0)
+
+def merge_by_score(result_lists, k, score=similarity_score, key='_id'):
+    # Merge per-type result lists into the k best records, dropping duplicates.
+    # key names the field identifying a record, or is a tuple of fields (a CQL primary key).
+    merged = {}
+    for results in result_lists:
+        for record in results:
+            if isinstance(key, tuple):
+                record_key = tuple(record[field] for field in key)
+            else:
+                record_key = record.get(key, id(record))
+            if record_key not in merged or score(record) > score(merged[record_key]):
+                merged[record_key] = record
+    return sorted(merged.values(), key=score, reverse=True)[:int(k)]
+
+class BackgroundRun:
+    # Runs coroutine_factory(emit) on its own event loop in a worker thread.
+    # Events passed to emit() are queued, so the calling thread can render them with drain()
+    # (Streamlit elements must be written from the script thread).
+    def __init__(self, coroutine_factory):
+        self.events = queue.Queue()
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(coroutine_factory,), daemon=True)
+        self.thread.start()
+
+    def emit(self, *event):
+        self.events.put(event)
+
+    def _run(self, coroutine_factory):
+        try:
+            self.result = asyncio.run(coroutine_factory(self.emit))
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.events.put(None)
+
+    def drain(self, handler=None):
+        # Handle events until the coroutine finishes, then return its result
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            if handler is not None:
+                handler(*event)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
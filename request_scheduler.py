@@ -0,0 +1,255 @@
+import os, random, re, threading, time
+from collections import deque
+
+from metrics import REGISTRY
+
+# Shared scheduler for OpenAI requests, one per model and process.
+# Every embeddings and completions call waits for its turn here, so bulk ingest and concurrent UI
+# sessions stay inside the account's rate limits together instead of failing on the first 429.
+#
+#   - token buckets for requests per minute and tokens per minute (the prompt plus max_tokens)
+#   - adaptive concurrency: the number of requests in flight is halved on a 429 or 5xx and grows
+#     again by about one per round of successful requests (AIMD)
+#   - retries with full-jitter exponential backoff, honouring Retry-After
+#   - priority lanes: a waiting "interactive" request (a user query) always goes before a
+#     "background" one (ingest, batch queries)
+#
+# Queue depth per lane, requests in flight, the concurrency limit and the time spent waiting are
+# reported to the metrics registry.
+#
+#   OPENAI_RPM=3000              requests per minute per model
+#   OPENAI_TPM=1000000           tokens per minute per model
+#   OPENAI_MAX_CONCURRENCY=16    upper bound for the adaptive concurrency limit
+#   OPENAI_MAX_RETRIES=6         attempts after the first one for a throttled or failed request
+#   OPENAI_SCHEDULER=on          off sends requests straight to the API, with no limits or retries
+
+LANES = ('interactive', 'background')
+
+class TokenBucket:
+    # Refills continuously at rate_per_minute / 60 per second, up to capacity. Not locked;
+    # the scheduler only uses it while holding its own lock.
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Seconds until amount is available (0 if it is now). A request larger than the bucket
+        # waits for a full bucket, so it is not blocked forever.
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class Ticket:
+    def __init__(self, lane, tokens):
+        self.lane = lane
+        self.tokens = tokens
+        self.queued = time.monotonic()
+        self.started = None
+
+def retry_after(error):
+    # Seconds the server asked us to wait, from Retry-After / retry-after-ms, or None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+def classify(error):
+    # "throttled" for a 429, "error" for a 5xx, a timeout or a dropped connection, None when a retry cannot help
+    status = getattr(error, 'status_code', None)
+    if status == 429:
+        # An exhausted quota is not a rate limit; waiting does not bring it back
+        return None if getattr(error, 'code', None) == 'insufficient_quota' else 'throttled'
+    if status is not None:
+        return 'error' if status >= 500 else None
+    import httpx, openai
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return 'error'
+    return None
+
+class RequestScheduler:
+    def __init__(self, name, requests_per_minute=3000, tokens_per_minute=1000000, max_concurrency=16,
+                 min_concurrency=1, max_retries=6, base_delay=0.5, max_delay=30.0):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.queues = {lane: deque() for lane in LANES}
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.counts = {'requests': 0, 'throttled': 0, 'errors': 0, 'retries': 0, 'failed': 0}
+        self.wait = {lane: REGISTRY.histogram(f"openai {name} {lane} queue wait") for lane in LANES}
+
+    def next_ticket(self):
+        # Head of the highest-priority lane that has a waiter
+        for lane in LANES:
+            if self.queues[lane]:
+                return self.queues[lane][0]
+        return None
+
+    def acquire(self, tokens=1, lane='interactive'):
+        # Block until the request may be sent; returns the ticket to pass to release()
+        ticket = Ticket(lane, tokens)
+        with self.condition:
+            self.queues[lane].append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self.next_ticket() is ticket and self.in_flight < int(self.limit):
+                        wait = max(self.paused_until - now,
+                                   self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                        if wait <= 0:
+                            break
+                    self.condition.wait(wait)
+            except BaseException:
+                self.queues[lane].remove(ticket)
+                self.condition.notify_all()
+                raise
+            self.queues[lane].popleft()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            self.counts['requests'] += 1
+            ticket.started = now
+            # The next waiter may be able to go too
+            self.condition.notify_all()
+        self.wait[lane].observe(ticket.started - ticket.queued)
+        return ticket
+
+    def release(self, ticket, outcome='ok', delay=None):
+        # outcome: "ok", "throttled" or "error". delay is the server's Retry-After.
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == 'ok':
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            elif outcome in ('throttled', 'error'):
+                self.counts['throttled' if outcome == 'throttled' else 'errors'] += 1
+                # Requests that were already in flight when the limit was cut report the same overload
+                if ticket.started >= self.last_decrease:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.last_decrease = now
+                if outcome == 'throttled' and delay:
+                    self.paused_until = max(self.paused_until, now + delay)
+            self.condition.notify_all()
+
+    def backoff(self, attempt, error):
+        # Full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    def call(self, fn, tokens=1, lane='interactive'):
+        # Run fn() under the limits, retrying throttled and failed requests
+        attempt = 0
+        while True:
+            ticket = self.acquire(tokens, lane)
+            try:
+                result = fn()
+            except Exception as error:
+                outcome = classify(error)
+                self.release(ticket, outcome or 'failed', retry_after(error))
+                if outcome is None or attempt >= self.max_retries:
+                    with self.condition:
+                        self.counts['failed'] += 1
+                    raise
+                with self.condition:
+                    self.counts['retries'] += 1
+                time.sleep(self.backoff(attempt, error))
+                attempt += 1
+                continue
+            self.release(ticket)
+            return result
+
+    async def acquire_async(self, tokens=1, lane='interactive'):
+        # Waits in a worker thread, so the event loop keeps running. If the waiting coroutine is
+        # cancelled, the slot it is eventually given is handed back.
+        import asyncio
+        future = asyncio.get_running_loop().run_in_executor(None, self.acquire, tokens, lane)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.exception() is None and self.release(done.result(), 'cancelled'))
+            raise
+
+    async def call_async(self, coroutine_factory, tokens=1, lane='interactive'):
+        # Async form of call(); coroutine_factory() starts a new attempt.
+        # asyncio is imported here: the scripts that only embed start faster without it.
+        import asyncio
+        attempt = 0
+        while True:
+            ticket = await self.acquire_async(tokens, lane)
+            try:
+                result = await coroutine_factory()
+            except asyncio.CancelledError:
+                self.release(ticket, 'cancelled')
+                raise
+            except Exception as error:
+                outcome = classify(error)
+                self.release(ticket, outcome or 'failed', retry_after(error))
+                if outcome is None or attempt >= self.max_retries:
+                    with self.condition:
+                        self.counts['failed'] += 1
+                    raise
+                with self.condition:
+                    self.counts['retries'] += 1
+                await asyncio.sleep(self.backoff(attempt, error))
+                attempt += 1
+                continue
+            self.release(ticket)
+            return result
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts, in_flight=self.in_flight, concurrency_limit=round(self.limit, 2),
+                        **{f'queued_{lane}': len(queue) for lane, queue in self.queues.items()})
+
+class Unscheduled:
+    # OPENAI_SCHEDULER=off: requests go straight to the API
+    def call(self, fn, tokens=1, lane='interactive'):
+        return fn()
+
+    async def call_async(self, coroutine_factory, tokens=1, lane='interactive'):
+        return await coroutine_factory()
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(model):
+    # Process-wide scheduler for a model; OpenAI's limits apply per model
+    if os.getenv('OPENAI_SCHEDULER', 'on').lower() in ('0', 'off', 'false', 'no'):
+        return Unscheduled()
+    with _schedulers_lock:
+        if model not in _schedulers:
+            scheduler = _schedulers[model] = RequestScheduler(
+                model,
+                requests_per_minute=float(os.getenv('OPENAI_RPM', '3000')),
+                tokens_per_minute=float(os.getenv('OPENAI_TPM', '1000000')),
+                max_concurrency=int(os.getenv('OPENAI_MAX_CONCURRENCY', '16')),
+                max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '6')),
+            )
+            REGISTRY.register_collector("openai_scheduler_" + re.sub(r'\W', '_', model), scheduler.stats)
+        return _schedulers[model]
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+
+from filters import has_constraints
+
+# Exact re-ranking of over-fetched vector search results.
+# The ANN search asks for RERANK_OVERFETCH times k candidates, with their vectors, in the same round
+# trip. The candidates are re-scored with exact float32 cosine similarity, narrowed to the price range
+# and brands asked for (filters.py), and the final k are picked by maximal marginal relevance (MMR): each pick
+# trades its similarity to the question against its similarity to the bikes already picked, so
+# near-duplicate models do not crowd out the rest. A candidate at least RERANK_DUPLICATE_THRESHOLD
+# similar to a picked bike is only used when nothing else is left.
+#
+# Results travel as a ResultSet, parallel columns plus NumPy arrays, rather than a DataFrame per query.
+#
+#   RERANK_OVERFETCH=1               candidates fetched per result (1 turns re-ranking off)
+#   RERANK_MMR_LAMBDA=0.7            1 ranks by similarity only, lower values favour variety
+#   RERANK_DUPLICATE_THRESHOLD=0.98  cosine similarity above which two bikes count as duplicates
+
+VECTOR_FIELD = '$vector'
+SIMILARITY_FIELD = '$similarity'
+# The Data API returns at most this many documents for a vector sort
+MAX_CANDIDATES = 1000
+
+def overfetch():
+    return max(1, int(os.getenv('RERANK_OVERFETCH', '1')))
+
+def mmr_lambda():
+    return float(os.getenv('RERANK_MMR_LAMBDA', '0.7'))
+
+def duplicate_threshold():
+    return float(os.getenv('RERANK_DUPLICATE_THRESHOLD', '0.98'))
+
+def candidate_limit(k):
+    # How many results to ask the vector search for; k itself when re-ranking is off
+    return min(MAX_CANDIDATES, int(k) * overfetch())
+
+class ResultSet:
+    # Search results as columns: a list per field, float32 similarities and (optionally) a float32
+    # matrix of unit vectors. take() selects rows without building a dict per row;
+    # records() builds the dicts once, for display and output.
+    __slots__ = ('columns', 'scores', 'vectors')
+
+    def __init__(self, columns, scores, vectors=None):
+        self.columns = columns
+        self.scores = scores
+        self.vectors = vectors
+
+    @classmethod
+    def from_documents(cls, documents):
+        fields = list(dict.fromkeys(field for document in documents for field in document
+                                    if field not in (VECTOR_FIELD, SIMILARITY_FIELD)))
+        columns = {field: [document.get(field) for document in documents] for field in fields}
+        scores = np.array([document.get(SIMILARITY_FIELD, np.nan) for document in documents], dtype=np.float32)
+        vectors = None
+        if documents and all(VECTOR_FIELD in document for document in documents):
+            vectors = np.array([document[VECTOR_FIELD] for document in documents], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            vectors /= norms
+        return cls(columns, scores, vectors)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        indices = rows.tolist()
+        return ResultSet({field: [values[i] for i in indices] for field, values in self.columns.items()},
+                         self.scores[rows], None if self.vectors is None else self.vectors[rows])
+
+    def records(self):
+        # One dict per result, best first; $similarity on Astra's (1 + cosine) / 2 scale, no vectors
+        fields = list(self.columns)
+        records = [dict(zip(fields, values)) for values in zip(*self.columns.values())] if fields else [{} for _ in self.scores]
+        for record, score in zip(records, self.scores.tolist()):
+            if score == score:
+                record[SIMILARITY_FIELD] = score
+        return records
+
+def constraint_mask(results, constraints):
+    count = len(results)
+    if not has_constraints(constraints):
+        return np.ones(count, dtype=bool)
+    mask = np.ones(count, dtype=bool)
+    if constraints['price_min'] is not None or constraints['price_max'] is not None:
+        prices = np.array([np.nan if price is None else price for price in results.columns.get('price', [None] * count)], dtype=np.float64)
+        # A missing price fails any price bound (NaN compares False)
+        if constraints['price_min'] is not None:
+            mask &= prices >= constraints['price_min']
+        if constraints['price_max'] is not None:
+            mask &= prices <= constraints['price_max']
+    if constraints['brands']:
+        wanted = set(constraints['brands'])
+        mask &= np.array([str(brand).lower() in wanted for brand in results.columns.get('brand', [''] * count)], dtype=bool)
+    return mask
+
+def mmr_select(relevance, similarities, k, weight, threshold):
+    # Indices of up to k candidates picked by MMR. relevance: (n,) similarities to the query;
+    # similarities: (n, n) between candidates. Near-duplicates of a pick are left for last.
+    count = len(relevance)
+    chosen = []
+    closest = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    while len(chosen) < min(k, count):
+        value = weight * relevance - (1.0 - weight) * np.where(np.isfinite(closest), closest, 0.0)
+        # Scores lie in [-1, 1], so a duplicate of a picked bike only comes back when nothing else is left
+        value[closest >= threshold] -= 4.0
+        value[~available] = -np.inf
+        pick = int(np.argmax(value))
+        chosen.append(pick)
+        available[pick] = False
+        np.maximum(closest, similarities[pick], out=closest)
+    return chosen
+
+def rerank(documents, query, k, constraints=None, weight=None, threshold=None):
+    # The final k of over-fetched vector search documents as a ResultSet. Documents without vectors
+    # keep the search order (only the constraints apply).
+    results = documents if isinstance(documents, ResultSet) else ResultSet.from_documents(documents)
+    candidates = np.flatnonzero(constraint_mask(results, constraints))
+    if results.vectors is None or len(candidates) == 0:
+        return results.take(candidates[:int(k)])
+    weight = mmr_lambda() if weight is None else weight
+    threshold = duplicate_threshold() if threshold is None else threshold
+    query = np.asarray(query, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+    vectors = results.vectors[candidates]
+    relevance = vectors @ query
+    if weight >= 1.0 and threshold >= 1.0:
+        order = np.argsort(-relevance, kind='stable')[:int(k)]
+    else:
+        order = mmr_select(relevance, vectors @ vectors.T, int(k), weight, threshold)
+    picked = results.take(candidates[order])
+    picked.scores = ((1.0 + relevance[order]) / 2.0).astype(np.float32)
+    return picked
@@ -0,0 +1,87 @@
+import threading, time
+from collections import OrderedDict
+
+import numpy as np
+
+# Semantic result cache for near-duplicate questions.
+# Entries are looked up by query embedding: a cached result is served when the cosine similarity
+# between the new query and a cached query is at least `threshold`, for the same filter and k.
+# Entries expire after `ttl` seconds and the least recently used ones are evicted past `max_entries`.
+
+class SemanticCache:
+    def __init__(self, threshold=0.97, max_entries=1000, ttl=3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # entry id -> (partition, created, value), in LRU order
+        self.partitions = {}           # (filter, k) -> {'ids': [...], 'matrix': float32 array}
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def partition_key(filter, k):
+        return (str(filter or ''), str(k))
+
+    def lookup(self, embedding, filter=None, k=None):
+        # Returns the cached value of the most similar query, or None
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        key = self.partition_key(filter, k)
+        with self.lock:
+            partition = self.partitions.get(key)
+            if partition is not None and partition['ids']:
+                scores = partition['matrix'] @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry_id = partition['ids'][best]
+                    _, created, value = self.entries[entry_id]
+                    if time.time() - created <= self.ttl:
+                        self.entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return value
+                    self._remove(entry_id)
+                    self.expirations += 1
+            self.misses += 1
+            return None
+
+    def store(self, embedding, value, filter=None, k=None):
+        if self.max_entries <= 0:
+            return
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        key = self.partition_key(filter, k)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (key, time.time(), value)
+            partition = self.partitions.setdefault(key, {'ids': [], 'matrix': np.empty((0, len(query)), dtype=np.float32)})
+            partition['ids'].append(entry_id)
+            partition['matrix'] = np.vstack([partition['matrix'], query[None, :]])
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        key, _, _ = self.entries.pop(entry_id)
+        partition = self.partitions[key]
+        position = partition['ids'].index(entry_id)
+        del partition['ids'][position]
+        partition['matrix'] = np.delete(partition['matrix'], position, axis=0)
+        if not partition['ids']:
+            del self.partitions[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
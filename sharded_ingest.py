@@ -0,0 +1,256 @@
+import json, os, queue, threading, time
+
+from ingest_pipeline import Checkpoint, checkpoint_matches_output, embed_chunks, insert_chunk, iter_chunks, iter_records, open_record_writer, summarize_chunks
+from bike_summaries import SUMMARY_TOKENS
+
+# Sharded full load: the catalog is split across a pool of worker processes, so summarizing,
+# embedding, encoding and writing records use every core instead of one.
+#
+# The coordinator parses the data source once and deals its chunks of consecutive records round
+# robin: chunk i goes to shard i % shards, through a small queue per shard. Each worker summarizes
+# and embeds its chunks and writes them to its own JSONL file and/or inserts them into the
+# collection, with its own checkpoint. Records get the same brand:model _id and fingerprint as in an unsharded load.
+#
+# The coordinator also prints the combined progress and throughput, and at the end merges the shard
+# files into the output file in catalog order (the same file an unsharded run writes) and removes the
+# shard checkpoints. An interrupted run resumes every shard from its checkpoint; a manifest makes sure
+# it is resumed with the same number of shards and chunk size.
+#
+# The OpenAI requests and tokens per minute (OPENAI_RPM, OPENAI_TPM) are divided between the workers,
+# whose schedulers do not see each other.
+
+# Chunks waiting per shard; bounds the coordinator's memory when a worker falls behind
+QUEUE_CHUNKS = 2
+
+# The manifest, shard files and shard checkpoints of a run are named after one prefix. The caller passes
+# the same prefix to shards_resuming() and run_sharded_pipeline(), whether or not the run writes a file.
+
+def shard_path(prefix, shard, shards):
+    return f"{prefix}.shard-{shard}-of-{shards}.jsonl"
+
+def manifest_path(prefix):
+    return f"{prefix}.shards.json"
+
+def shards_resuming(prefix):
+    # True while a sharded run under prefix has committed rows that are not merged yet
+    return os.path.exists(manifest_path(prefix))
+
+def deal_chunks(bikes, model, shards, chunk_size, starts=None):
+    # (shard, chunk) in catalog order, after the first starts[shard] rows each shard already committed
+    skipped = [0] * shards
+    starts = starts or [0] * shards
+    for number, chunk in enumerate(iter_chunks(iter_records(bikes, model), chunk_size)):
+        shard = number % shards
+        if skipped[shard] < starts[shard]:
+            keep = chunk[starts[shard] - skipped[shard]:]
+            skipped[shard] += len(chunk) - len(keep)
+            if not keep:
+                continue
+            chunk = keep
+        yield shard, chunk
+
+def put_while(target, item, alive):
+    # Put with backpressure, giving up when the consumer is gone
+    while alive():
+        try:
+            target.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+_progress = None
+_chunk_queues = None
+
+def init_worker(progress, chunk_queues):
+    global _progress, _chunk_queues
+    _progress = progress
+    _chunk_queues = chunk_queues
+
+def iter_queue(source):
+    while True:
+        chunk = source.get()
+        if chunk is None:
+            return
+        yield chunk
+
+def ingest_shard(shard, config):
+    # Worker process: embed the chunks the coordinator sends into the shard's file and/or the collection.
+    # Returns its stats.
+    shards = config['shards']
+    for name, default in (('OPENAI_RPM', '3000'), ('OPENAI_TPM', '1000000')):
+        os.environ[name] = str(float(os.getenv(name, default)) / shards)
+    from embedding_cache import get_default_cache
+    collection = None
+    if config.get('collection'):
+        from http_clients import astra_collection
+        collection = astra_collection(*config['collection'])
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    path = shard_path(config['prefix'], shard, shards)
+    checkpoint = Checkpoint(path + '.checkpoint')
+    writer = open_record_writer(path, checkpoint) if config['output_path'] else None
+    rows = 0
+    try:
+        chunks = summarize_chunks(iter_queue(_chunk_queues[shard]), config['summary_tokens'])
+        for chunk in embed_chunks(chunks, config['model'], get_default_cache()):
+            offset = writer.write_chunk(chunk) if writer else 0
+            if collection is not None:
+                insert_chunk(collection, chunk, config['insert_batch_size'])
+            checkpoint.commit(len(chunk), offset)
+            rows += len(chunk)
+            if _progress is not None:
+                _progress.put((shard, checkpoint.rows, rows))
+        if writer:
+            writer.finish()
+    except Exception as error:
+        # Some client exceptions cannot be unpickled in the coordinator, which would break the whole pool
+        raise RuntimeError(f"Shard {shard} failed after {checkpoint.rows} rows: {type(error).__name__}: {error}") from None
+    finally:
+        if writer:
+            writer.close()
+    seconds = time.perf_counter() - start
+    return {'shard': shard, 'rows': rows, 'committed': checkpoint.rows, 'seconds': round(seconds, 3),
+            'cpu_seconds': round(time.process_time() - cpu_start, 3), 'rows_per_second': round(rows / seconds, 1) if seconds else 0.0}
+
+def merge_shard_outputs(paths, output_path, chunk_size):
+    # Interleave the shard files back into catalog order without decoding the records: shard i holds
+    # chunks i, i + shards, ..., so taking chunk_size lines from each shard in turn restores the order.
+    # The output is a JSON array for a .json path and JSONL otherwise, as RecordWriter writes it.
+    def lines(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\n')
+                if line:
+                    yield line
+
+    json_array = output_path.endswith('.json')
+    readers = [lines(path) for path in paths]
+    written = 0
+    short = False
+    with open(output_path + '.tmp', 'wb') as out:
+        if json_array:
+            out.write(b'[')
+        while readers:
+            for reader in list(readers):
+                count = 0
+                for line in reader:
+                    if short:
+                        # Only the last chunk of the catalog may be short; anything after it is out of order
+                        raise ValueError("The shard files do not line up; delete them and their checkpoints and load again")
+                    out.write((line if written == 0 else b',' + line) if json_array else line + b'\n')
+                    written += 1
+                    count += 1
+                    if count == chunk_size:
+                        break
+                if count < chunk_size:
+                    short = short or count > 0
+                    readers.remove(reader)
+        if json_array:
+            out.write(b']')
+    os.replace(output_path + '.tmp', output_path)
+    return written
+
+def run_sharded_pipeline(source, model, shards, output_path=None, collection=None, chunk_size=100,
+                         insert_batch_size=20, summary_tokens=SUMMARY_TOKENS, progress=None, prefix=None):
+    # Coordinator. source is a DATA_SOURCE string, parsed here once; collection the
+    # (name, token, api_endpoint) the workers insert into; prefix names the run's manifest and shard
+    # files (output_path, or 'ingest', by default). progress(committed rows, rows/s of this run) is
+    # called as the workers commit chunks. Returns the combined and per-shard stats.
+    prefix = prefix or output_path or 'ingest'
+    manifest = {'shards': shards, 'chunk_size': chunk_size, 'output_path': output_path}
+    if os.path.exists(manifest_path(prefix)):
+        with open(manifest_path(prefix)) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError(f"An interrupted sharded run used {previous['shards']} shards of {previous['chunk_size']} row chunks"
+                             f" into {previous['output_path'] or 'the collection only'}; resume it with the same settings"
+                             f" or delete {manifest_path(prefix)} and the shard files")
+    else:
+        with open(manifest_path(prefix), 'w') as f:
+            json.dump(manifest, f)
+
+    # Where each shard resumes; a checkpoint whose shard file is gone or shorter starts that shard over
+    starts = []
+    for shard in range(shards):
+        checkpoint = Checkpoint(shard_path(prefix, shard, shards) + '.checkpoint')
+        if output_path and not checkpoint_matches_output(shard_path(prefix, shard, shards), checkpoint):
+            checkpoint.reset()
+        starts.append(checkpoint.rows)
+
+    config = {'model': model, 'shards': shards, 'prefix': prefix, 'output_path': output_path, 'collection': collection,
+              'chunk_size': chunk_size, 'insert_batch_size': insert_batch_size, 'summary_tokens': summary_tokens}
+    # multiprocessing is imported here, so the loader does not pay for it unless it shards
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    # spawn, not fork: the coordinator already runs threads (telemetry, connection pools)
+    context = multiprocessing.get_context('spawn')
+    messages = context.Queue()
+    chunk_queues = [context.Queue(QUEUE_CHUNKS) for _ in range(shards)]
+    committed = {}
+    start = time.perf_counter()
+
+    def report():
+        # Combine the workers' progress messages until the coordinator sends None
+        run_rows = {}
+        while True:
+            message = messages.get()
+            if message is None:
+                return
+            shard, shard_committed, shard_rows = message
+            committed[shard] = shard_committed
+            run_rows[shard] = shard_rows
+            if progress:
+                progress(sum(committed.values()), sum(run_rows.values()) / (time.perf_counter() - start))
+
+    reporter = threading.Thread(target=report, daemon=True)
+    reporter.start()
+    results, errors = [], []
+    try:
+        with ProcessPoolExecutor(max_workers=shards, mp_context=context, initializer=init_worker,
+                                 initargs=(messages, chunk_queues)) as executor:
+            futures = [executor.submit(ingest_shard, shard, config) for shard in range(shards)]
+
+            def feed():
+                # Parse the source once and deal its chunks; a shard whose worker failed gets no more
+                try:
+                    from data_sources import DataSource
+                    for shard, chunk in deal_chunks(DataSource(source), model, shards, chunk_size, starts):
+                        put_while(chunk_queues[shard], chunk, lambda: not futures[shard].done())
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    for shard in range(shards):
+                        put_while(chunk_queues[shard], None, lambda: not futures[shard].done())
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    # The other shards keep going; everything they commit is kept for the resume
+                    errors.append(error)
+            feeder.join()
+    finally:
+        messages.put(None)
+        reporter.join()
+    if errors:
+        raise errors[0]
+
+    paths = [shard_path(prefix, shard, shards) for shard in range(shards)]
+    if output_path:
+        merge_shard_outputs(paths, output_path, chunk_size)
+    # The run is complete, so the next run starts from scratch
+    for path in paths:
+        for leftover in (path, path + '.checkpoint'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    os.remove(manifest_path(prefix))
+
+    seconds = time.perf_counter() - start
+    rows = sum(result['rows'] for result in results)
+    return {'rows': rows, 'committed': sum(result['committed'] for result in results), 'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds, 1) if seconds else 0.0,
+            'shards': sorted(results, key=lambda result: result['shard'])}
@@ -0,0 +1,88 @@
+import atexit, functools, json, os, threading, uuid
+from time import perf_counter
+
+from metrics import REGISTRY, start_metrics_server
+
+# Telemetry setup shared by the entry points.
+#
+# TELEMETRY_MODE selects how much work the @task/@workflow steps do on the hot path:
+#   debug       Traceloop spans exported synchronously, one by one (the original behaviour)
+#   production  Traceloop spans exported in batches from a background thread, head-sampled
+#               by TELEMETRY_SAMPLE_RATIO, plus the in-process metrics
+#   metrics     no tracing, only the in-process metrics (per-stage latency histograms, counters)
+#   off         no-op: the decorators return the functions unchanged
+#
+# In-process metrics can be scraped from http://127.0.0.1:$METRICS_PORT/metrics when METRICS_PORT is set,
+# and are written to METRICS_DUMP_FILE at exit when that is set.
+
+TRACING_MODES = ('debug', 'production')
+
+_initialized = False
+_init_lock = threading.Lock()
+
+def telemetry_mode():
+    return os.getenv('TELEMETRY_MODE', 'debug')
+
+def init_telemetry(app_name):
+    # Safe to call on every Streamlit rerun; only the first call does anything
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        _initialized = True
+        mode = telemetry_mode()
+
+        if mode in TRACING_MODES:
+            from traceloop.sdk import Traceloop
+            from traceloop.sdk.tracing import tracing as Tracer
+            if mode == 'production':
+                # The OpenTelemetry SDK reads the sampler and batch processor settings from the environment
+                os.environ.setdefault('OTEL_TRACES_SAMPLER', 'parentbased_traceidratio')
+                os.environ.setdefault('OTEL_TRACES_SAMPLER_ARG', os.getenv('TELEMETRY_SAMPLE_RATIO', '0.1'))
+                os.environ.setdefault('OTEL_BSP_SCHEDULE_DELAY', '5000')
+                os.environ.setdefault('OTEL_BSP_MAX_EXPORT_BATCH_SIZE', '512')
+                Traceloop.init(app_name=app_name, disable_batch=False)
+            else:
+                Traceloop.init(app_name=app_name, disable_batch=True)
+            Tracer.set_correlation_id(str(uuid.uuid4()))
+
+        if mode != 'off':
+            port = os.getenv('METRICS_PORT')
+            if port:
+                start_metrics_server(int(port))
+            dump_file = os.getenv('METRICS_DUMP_FILE')
+            if dump_file:
+                atexit.register(dump_metrics, dump_file)
+
+def dump_metrics(path):
+    with open(path, 'w') as f:
+        json.dump(REGISTRY.dump(), f, indent=2)
+
+def _decorate(kind, name):
+    def decorator(fn):
+        mode = telemetry_mode()
+        if mode == 'off':
+            return fn
+        # The Traceloop decorator is looked up on the first call, so decorating the module-level
+        # functions of an entry point does not import it
+        traced = [] if mode in TRACING_MODES else [fn]
+        histogram = REGISTRY.histogram(name or fn.__name__)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if not traced:
+                from traceloop.sdk import decorators
+                traced.append(getattr(decorators, kind)(name=name)(fn))
+            start = perf_counter()
+            try:
+                return traced[0](*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return timed
+    return decorator
+
+def task(name=None):
+    return _decorate('task', name)
+
+def workflow(name=None):
+    return _decorate('workflow', name)
@@ -0,0 +1,43 @@
+import json, os, re
+
+import pytest
+
+from bike_summaries import NEGATION, extract_attributes, format_attributes, split_sentences
+
+# The attribute line is the one form of every bike that always reaches the prompts, so what it says
+# is checked against the catalog in data/bikes.json.
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'bikes.json')
+
+with open(DATA_FILE) as f:
+    CATALOG = json.load(f)
+
+def bike(model):
+    return next(bike for bike in CATALOG if bike['model'] == model)
+
+def test_negated_sentence_is_not_a_fact():
+    # "Don't ride the trail on a hardtail! It is so much more fun on the full suspension Hillcraft!"
+    assert extract_attributes(bike('Hillcraft'))['suspension'] == 'full suspension'
+
+def test_fork_material_is_not_the_frame():
+    # Alloy frame, carbon fork
+    attributes = extract_attributes(bike('XBN 3.0 Alloy'))
+    assert attributes['frame'] == 'alloy'
+    assert 'alloy frame' in format_attributes(bike('XBN 3.0 Alloy'), attributes)
+
+def test_contradicting_wheel_sizes_are_left_out():
+    # Mentions both 27.5" and 24" bikes; its own size is not given in inches
+    assert 'wheel_size' not in extract_attributes(bike('Hillcraft'))
+
+@pytest.mark.parametrize('entry', CATALOG, ids=lambda entry: entry['model'])
+def test_every_attribute_is_stated_in_a_positive_sentence(entry):
+    sentences = [sentence.lower().replace('aluminium', 'aluminum').replace('fibre', 'fiber')
+                 for sentence in split_sentences(entry['description']) if not NEGATION.search(sentence)]
+    for name, value in extract_attributes(entry).items():
+        if name in ('type', 'price'):
+            continue
+        words = re.escape(value.replace(' inch', '')).replace(r'\ ', r'[\s-]+')
+        matching = [sentence for sentence in sentences if re.search(words, sentence)]
+        assert matching, (name, value)
+        if name == 'frame':
+            assert any('frame' in sentence for sentence in matching), value
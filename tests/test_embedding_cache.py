@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from embedding_cache import EmbeddingCache, cache_key
+
+# The SQLite embedding cache: LRU eviction, a total shared by every process using the file,
+# and writes that roll back as a whole.
+
+MODEL = 'text-embedding-ada-002'
+# One vector of 16 float32 values is 64 bytes
+VECTOR = [0.5] * 16
+
+def stored_bytes(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite3'), max_bytes=64 * 10)
+    cache.put_many(MODEL, [f'bike {i}' for i in range(10)], [VECTOR] * 10)
+    assert cache.get(MODEL, 'bike 0') == VECTOR
+    cache.put(MODEL, 'bike 10', VECTOR)
+    # Back under 90% of max_bytes, oldest first; bike 0 was read, so bike 1 went instead
+    assert cache.stats()['bytes'] == stored_bytes(cache.path) == 64 * 9
+    assert cache.get(MODEL, 'bike 0') == VECTOR
+    assert cache.get(MODEL, 'bike 1') is None
+    assert cache.get(MODEL, 'bike 10') == VECTOR
+
+def test_processes_sharing_the_file_evict_by_the_combined_size(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    first = EmbeddingCache(path, max_bytes=64 * 10)
+    second = EmbeddingCache(path, max_bytes=64 * 10)
+    first.put_many(MODEL, [f'first {i}' for i in range(6)], [VECTOR] * 6)
+    second.put_many(MODEL, [f'second {i}' for i in range(6)], [VECTOR] * 6)
+    # Neither cache wrote more than max_bytes itself, but together they did
+    assert stored_bytes(path) <= 64 * 9
+    assert second.stats()['bytes'] == stored_bytes(path)
+    first.put(MODEL, 'first 6', VECTOR)
+    assert first.stats()['bytes'] == stored_bytes(path)
+
+def test_a_failed_write_is_rolled_back(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite3'))
+    cache.put(MODEL, 'bike 0', VECTOR)
+    # The second insert fails after the first one went through
+    cache.conn.execute(f"CREATE TEMP TRIGGER fail BEFORE INSERT ON embeddings WHEN NEW.key = '{cache_key(MODEL, 'bike 2')}'"
+                       " BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    with pytest.raises(sqlite3.IntegrityError):
+        cache.put_many(MODEL, ['bike 1', 'bike 2'], [VECTOR, VECTOR])
+    cache.conn.execute("DROP TRIGGER fail")
+    assert not cache.conn.in_transaction
+    assert cache.get_many(MODEL, ['bike 0', 'bike 1']) == [VECTOR, None]
+    cache.put(MODEL, 'bike 1', VECTOR)
+    assert cache.stats()['bytes'] == stored_bytes(cache.path) == 64 * 2
@@ -0,0 +1,48 @@
+import json, os
+
+import openai
+import pytest
+
+from benchmarks.mock_services import MockCollection, start_mock_server
+from http_clients import astra_collection
+from ingest_pipeline import FINGERPRINT_FIELD, iter_keyed_records, run_pipeline, sync_collection
+
+# Full loads and incremental syncs against the mock OpenAI and Astra endpoints.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = 'text-embedding-ada-002'
+
+@pytest.fixture
+def mock():
+    server, base_url = start_mock_server(dimension=8)
+    server.collections['bikes'] = MockCollection()
+    client = openai.OpenAI(base_url=base_url, api_key='mock', max_retries=0)
+    collection = astra_collection('bikes', 'mock', server.astra_endpoint)
+    yield server, client, collection
+    server.shutdown()
+
+@pytest.fixture
+def bikes():
+    with open(os.path.join(ROOT, 'data', 'bikes.json')) as f:
+        return json.load(f)[:20]
+
+def test_full_load_writes_the_keys_and_fingerprints_sync_uses(mock, bikes, tmp_path):
+    server, client, collection = mock
+    output = str(tmp_path / 'bikes_withVector.json')
+    run_pipeline(bikes, MODEL, output_path=output, collection=collection, chunk_size=6, client=client)
+    keyed = list(iter_keyed_records(bikes, MODEL))
+    with open(output) as f:
+        written = json.load(f)
+    assert [record['_id'] for record in written] == [record['_id'] for record in keyed]
+    assert [record[FINGERPRINT_FIELD] for record in written] == [record[FINGERPRINT_FIELD] for record in keyed]
+
+    # Nothing changed, so the sync leaves every document alone
+    stats = sync_collection(bikes, collection, MODEL, client=client)
+    assert stats['unchanged'] == len(bikes)
+    assert stats['inserted'] == stats['updated'] == stats['deleted'] == 0
+    assert len(server.collections['bikes'].documents) == len(bikes)
+
+    # One changed bike is the only one embedded again
+    bikes[3] = dict(bikes[3], price=bikes[3]['price'] + 1)
+    stats = sync_collection(bikes, collection, MODEL, client=client)
+    assert stats['updated'] == 1 and stats['unchanged'] == len(bikes) - 1
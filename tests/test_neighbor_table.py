@@ -0,0 +1,49 @@
+import json, os
+
+import numpy as np
+import openai
+import pytest
+
+from benchmarks.mock_services import MockCollection, start_mock_server
+from http_clients import astra_collection
+from ingest_pipeline import run_pipeline
+from neighbor_table import NeighborTable, build_neighbor_table, refresh_collection_neighbors
+
+# The neighbor table, built from an export and from a collection on the mock Astra endpoint.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = 'text-embedding-ada-002'
+
+@pytest.fixture
+def loaded(tmp_path):
+    server, base_url = start_mock_server(dimension=8)
+    server.collections['bikes'] = MockCollection()
+    client = openai.OpenAI(base_url=base_url, api_key='mock', max_retries=0)
+    collection = astra_collection('bikes', 'mock', server.astra_endpoint)
+    with open(os.path.join(ROOT, 'data', 'bikes.json')) as f:
+        bikes = json.load(f)[:30]
+    output = str(tmp_path / 'bikes_withVector.json')
+    run_pipeline(bikes, MODEL, output_path=output, collection=collection, chunk_size=10, client=client)
+    yield server, collection, output
+    server.shutdown()
+
+def test_export_and_collection_give_the_same_table(loaded, tmp_path):
+    server, collection, output = loaded
+    ids, tables = build_neighbor_table(output, str(tmp_path / 'from_export'), n=5, block_rows=7, block_columns=11)
+    count, updated = refresh_collection_neighbors(collection, str(tmp_path / 'from_collection'), n=5)
+    assert count == updated == len(ids)
+    export_table = NeighborTable(str(tmp_path / 'from_export'))
+    collection_table = NeighborTable(str(tmp_path / 'from_collection'))
+    for _id in ids:
+        assert [i for i, _ in collection_table.neighbors(_id)] == [i for i, _ in export_table.neighbors(_id)]
+        document = server.collections['bikes'].documents[_id]
+        assert document['neighbors'] == [i for i, _ in export_table.neighbors(_id)]
+        assert document['type_neighbors'] == [i for i, _ in export_table.neighbors(_id, same_type=True)]
+    assert np.array_equal(tables['all'][0], np.asarray(export_table.tables['all'][0]))
+    # The temporary vector stores are gone
+    assert sorted(os.listdir(tmp_path)) == ['bikes_withVector.json', 'from_collection', 'from_export']
+
+def test_refresh_only_writes_changed_neighbors(loaded, tmp_path):
+    server, collection, _ = loaded
+    refresh_collection_neighbors(collection, str(tmp_path / 'table'), n=5)
+    assert refresh_collection_neighbors(collection, str(tmp_path / 'table'), n=5)[1] == 0
@@ -0,0 +1,107 @@
+import random, threading, time
+
+import openai
+import pytest
+
+from request_scheduler import RequestScheduler
+from benchmarks.mock_services import start_mock_server
+
+# The OpenAI request scheduler against the mock server, which answers with OpenAI's rate-limit
+# responses: 429s with retry-after-ms from its token bucket (rate_limit), random 429s
+# (throttle_rate) and the 429 of an exhausted quota.
+
+@pytest.fixture
+def mock():
+    servers = []
+
+    def start(**kwargs):
+        server, base_url = start_mock_server(dimension=8, **kwargs)
+        servers.append(server)
+        # The client's own retries are off, so every retry seen here is the scheduler's
+        return server, openai.OpenAI(base_url=base_url, api_key='mock', max_retries=0)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+def scheduler(**kwargs):
+    options = dict(requests_per_minute=600000, tokens_per_minute=10 ** 9, max_retries=20, base_delay=0.005, max_delay=0.02)
+    options.update(kwargs)
+    return RequestScheduler('test', **options)
+
+def embed(client):
+    return lambda: client.embeddings.create(input=['a bike'], model='text-embedding-ada-002')
+
+def test_throttled_requests_are_retried_until_they_succeed(mock):
+    random.seed(1)
+    server, client = mock(throttle_rate=0.5)
+    requests = scheduler()
+    for _ in range(20):
+        assert len(requests.call(embed(client)).data) == 1
+    assert server.throttled_count > 0
+    assert requests.counts['throttled'] == requests.counts['retries'] == server.throttled_count
+    assert requests.counts['failed'] == 0
+
+def test_retry_after_is_honoured(mock):
+    # Two requests per second; the 429 says when the next one is allowed, so each throttled
+    # request gets through on its first retry even though the scheduler's own backoff is ~0
+    server, client = mock(rate_limit=2)
+    requests = scheduler()
+    start = time.monotonic()
+    for _ in range(6):
+        requests.call(embed(client))
+    assert server.throttled_count <= 4
+    assert requests.counts['retries'] == server.throttled_count
+    assert time.monotonic() - start >= 1.5
+
+def test_exhausted_quota_fails_without_retrying(mock):
+    server, client = mock(quota_exhausted=True)
+    requests = scheduler()
+    with pytest.raises(openai.RateLimitError):
+        requests.call(embed(client))
+    assert server.request_count == 1
+    assert requests.counts['retries'] == 0
+    assert requests.counts['failed'] == 1
+
+def test_concurrency_limit_halves_on_429_and_recovers(mock):
+    server, client = mock()
+    requests = scheduler(max_concurrency=16, max_retries=0)
+    server.throttle_rate = 1.0
+    with pytest.raises(openai.RateLimitError):
+        requests.call(embed(client))
+    assert requests.stats()['concurrency_limit'] == 8
+    server.throttle_rate = 0.0
+    for _ in range(40):
+        requests.call(embed(client))
+    assert 8 < requests.stats()['concurrency_limit'] < 16
+    for _ in range(100):
+        requests.call(embed(client))
+    assert requests.stats()['concurrency_limit'] == 16
+
+def test_interactive_requests_go_before_queued_background_ones(mock):
+    server, client = mock()
+    requests = scheduler(max_concurrency=1)
+    order = []
+
+    def run(lane):
+        requests.call(lambda: order.append(lane) or embed(client)(), lane=lane)
+
+    def wait_for(lane, count):
+        deadline = time.monotonic() + 5
+        while requests.stats()[f'queued_{lane}'] < count:
+            assert time.monotonic() < deadline
+            time.sleep(0.005)
+
+    # The one slot is taken, so everything below queues
+    held = requests.acquire()
+    threads = [threading.Thread(target=run, args=('background',)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_for('background', 3)
+    threads.append(threading.Thread(target=run, args=('interactive',)))
+    threads[-1].start()
+    wait_for('interactive', 1)
+    requests.release(held)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['interactive', 'background', 'background', 'background']
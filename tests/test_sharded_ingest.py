@@ -0,0 +1,72 @@
+import json, os, shutil, subprocess, sys
+
+import pytest
+
+from benchmarks.mock_services import MockHandler, start_mock_server
+
+# The sharded full load, run through load_embeddings.py against the mock OpenAI and Astra endpoints.
+# load_embeddings.py reads its settings from a .env next to it, so it is run from a copy in a
+# temporary directory with a stub .env, never the developer's own.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIKES = 24
+
+class InterruptingHandler(MockHandler):
+    # Fails every insertMany once server.inserts_left documents have been inserted (None for no limit)
+    def handle_astra(self, parts, body):
+        server = self.server
+        if 'insertMany' in body and server.inserts_left is not None:
+            with server.lock:
+                count = len(body['insertMany']['documents'])
+                allowed = server.inserts_left >= count
+                if allowed:
+                    server.inserts_left -= count
+            if not allowed:
+                self.send_json(500, {'errors': [{'message': "Connection reset"}]})
+                return
+        super().handle_astra(parts, body)
+
+@pytest.fixture
+def loader(tmp_path):
+    server, base_url = start_mock_server(handler=InterruptingHandler, dimension=8)
+    server.inserts_left = None
+    with open(os.path.join(ROOT, 'data', 'bikes.json')) as f:
+        bikes = json.load(f)[:BIKES]
+    with open(tmp_path / 'bikes.json', 'w') as f:
+        json.dump(bikes, f)
+    shutil.copy(os.path.join(ROOT, 'load_embeddings.py'), tmp_path)
+    settings = {
+        'ASTRA_DB_APPLICATION_TOKEN': 'mock', 'ASTRA_DB_API_ENDPOINT': server.astra_endpoint, 'ASTRA_COLLECTION': 'bikes',
+        'OPENAI_API_KEY': 'mock', 'OPENAI_BASE_URL': base_url, 'TELEMETRY_MODE': 'off', 'EMBED_CACHE_PATH': '',
+        'DATA_SOURCE': str(tmp_path / 'bikes.json'), 'INGEST_OUTPUT_FILE': str(tmp_path / 'bikes_withVector.json'),
+        'FACET_CATALOG_FILE': str(tmp_path / 'facets.json'), 'NEIGHBOR_TABLE': '',
+        'INGEST_TARGETS': 'collection', 'INGEST_SHARDS': '2', 'INGEST_CHUNK_SIZE': '3', 'INGEST_INSERT_BATCH_SIZE': '3',
+    }
+    with open(tmp_path / '.env', 'w') as f:
+        f.writelines(f"{name}={value}\n" for name, value in settings.items())
+
+    def run():
+        environment = dict(os.environ, PYTHONPATH=ROOT)
+        return subprocess.run([sys.executable, str(tmp_path / 'load_embeddings.py')], cwd=tmp_path, env=environment,
+                              capture_output=True, text=True, timeout=120)
+
+    yield server, run, bikes
+    server.shutdown()
+
+def test_interrupted_collection_only_load_resumes_into_the_same_collection(loader, tmp_path):
+    server, run, bikes = loader
+    server.inserts_left = BIKES // 2
+    assert run().returncode != 0
+    assert os.path.exists(tmp_path / 'bikes_withVector.json.shards.json')
+    committed = len(server.collections['bikes'].documents)
+    assert 0 < committed < BIKES
+
+    server.inserts_left = None
+    result = run()
+    assert result.returncode == 0, result.stderr
+    assert "Resuming load into Collection: bikes" in result.stdout
+    documents = server.collections['bikes'].documents.values()
+    assert sorted(document['model'] for document in documents) == sorted(bike['model'] for bike in bikes)
+    assert not os.path.exists(tmp_path / 'bikes_withVector.json.shards.json')
+    # Only the collection was loaded
+    assert not os.path.exists(tmp_path / 'bikes_withVector.json')
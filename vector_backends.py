@@ -0,0 +1,226 @@
+import json, os
+
+import numpy as np
+
+from filters import matches
+from vector_store import is_vector_store, open_vector_store
+
+# In-process vector search backends.
+# They expose the same vector_find() call as astrapy's AstraDBCollection, so query_astra_db
+# works unchanged against Astra, an exact NumPy search, or an approximate IVF index.
+# The local backends serve as a low-latency replica and as an offline stand-in for Astra.
+# They load either a JSON/JSONL export or a binary vector store (see vector_store.py), which is
+# searched in place through numpy.memmap.
+
+VECTOR_KEYS = ('$vector', 'vector', 'embedding')
+
+# Rows converted to float32 at a time when scoring a float16/int8 matrix
+SCORE_BLOCK_ROWS = 8192
+
+def load_vector_file(path):
+    # Read documents and their vectors from a JSON array or JSONL export of the catalog.
+    # Returns the documents without vectors and a float32 matrix with one row per document.
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = json.load(f)
+    documents = []
+    vectors = []
+    for record in records:
+        key = next(key for key in VECTOR_KEYS if key in record)
+        vectors.append(record[key])
+        documents.append({field: value for field, value in record.items() if field not in VECTOR_KEYS})
+    return documents, np.asarray(vectors, dtype=np.float32)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def load_vectors(path):
+    # (documents, matrix, row_scale) from a vector store directory or a JSON/JSONL export.
+    # A vector store keeps its memory-mapped matrix; row_scale turns its dot products into cosines.
+    if os.path.isdir(path) and is_vector_store(path):
+        store = open_vector_store(path)
+        return store.documents, store.vectors, store.row_scale()
+    documents, matrix = load_vector_file(path)
+    return documents, matrix, None
+
+class NumpyBackend:
+    # Exact cosine search over a float32 matrix, or over a memory-mapped float32/float16/int8 matrix
+    # with per-row scale factors
+    def __init__(self, documents, matrix, row_scale=None):
+        self.documents = documents
+        if row_scale is None:
+            self.matrix = normalize_rows(np.asarray(matrix, dtype=np.float32))
+        else:
+            self.matrix = matrix
+        self.row_scale = row_scale
+        self._filter_rows = {}
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(*load_vectors(path))
+
+    def unit_rows(self, rows):
+        # Normalised float32 copy of the selected rows
+        block = np.asarray(self.matrix[rows], dtype=np.float32)
+        if self.row_scale is None:
+            return block
+        return block * self.row_scale[rows][:, None]
+
+    def score_rows(self, query, candidates=None):
+        # Cosine similarity of a unit query with every candidate row (all rows when None).
+        # A float16/int8 memmap is converted block by block, never copied whole.
+        count = len(self.matrix) if candidates is None else len(candidates)
+        if self.row_scale is None and candidates is None:
+            return self.matrix @ query
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, SCORE_BLOCK_ROWS):
+            rows = slice(start, min(count, start + SCORE_BLOCK_ROWS)) if candidates is None else candidates[start:start + SCORE_BLOCK_ROWS]
+            scores[start:start + SCORE_BLOCK_ROWS] = np.asarray(self.matrix[rows], dtype=np.float32) @ query
+        if self.row_scale is not None:
+            scores *= self.row_scale if candidates is None else self.row_scale[candidates]
+        return scores
+
+    def field_values(self, field):
+        # Documents from a vector store are decoded one column at a time
+        if hasattr(self.documents, 'column'):
+            return self.documents.column(field)
+        return [document.get(field) for document in self.documents]
+
+    def filter_rows(self, filter):
+        # Row indices matching a {"field": value} / {"field": {"$in": [...]}} filter, memoised per filter
+        if not filter:
+            return None
+        cache_key = json.dumps(filter, sort_keys=True)
+        rows = self._filter_rows.get(cache_key)
+        if rows is None:
+            rows = np.flatnonzero(self.filter_mask(filter)).astype(np.int64)
+            self._filter_rows[cache_key] = rows
+        return rows
+
+    def filter_mask(self, filter):
+        mask = np.ones(len(self.documents), dtype=bool)
+        for field, condition in (filter or {}).items():
+            mask &= np.array([matches(value, condition) for value in self.field_values(field)], dtype=bool)
+        return mask
+
+    def paginated_find(self, filter=None, projection=None):
+        # Documents matching a filter, without a vector sort, as astrapy's paginated_find (e.g. lookups by _id).
+        # Not memoised like filter_rows, since every lookup has different ids.
+        fields = [field for field, include in (projection or {}).items() if include]
+        for row in np.flatnonzero(self.filter_mask(filter)).tolist():
+            yield self.project(row, fields, None)
+
+    def project(self, row, fields, similarity):
+        document = self.documents[row]
+        if fields:
+            result = {'_id': document.get('_id')}
+            result.update({field: document[field] for field in fields if field in document})
+            if '$vector' in fields:
+                # As Astra returns it when the projection asks for it, for re-ranking
+                result['$vector'] = self.unit_rows([row])[0]
+        else:
+            result = dict(document)
+        if similarity is not None:
+            # Same scale as Astra's cosine $similarity
+            result['$similarity'] = float((1.0 + similarity) / 2.0)
+        return result
+
+    def top_rows(self, query, candidates, limit):
+        # Best `limit` rows among candidates (all rows when None), highest similarity first
+        scores = self.score_rows(query, candidates)
+        if limit < len(scores):
+            best = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        rows = best if candidates is None else candidates[best]
+        return rows, scores[best]
+
+    def vector_find(self, vector, *, limit, filter=None, fields=None, include_similarity=True):
+        limit = int(limit)
+        if not limit:
+            raise ValueError("Must pass a limit")
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        candidates = self.filter_rows(filter)
+        if candidates is not None and len(candidates) == 0:
+            return []
+        rows, scores = self.top_rows(query, candidates, limit)
+        return [
+            self.project(row, fields, score if include_similarity else None)
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+class IVFBackend(NumpyBackend):
+    # Approximate search: vectors are clustered with k-means and only the nprobe closest
+    # clusters are scanned. Suited to catalogs too large for a full scan per query.
+    def __init__(self, documents, matrix, row_scale=None, nlist=None, nprobe=8, iterations=10, seed=0):
+        super().__init__(documents, matrix, row_scale)
+        count = len(self.documents)
+        self.nlist = max(1, min(count, nlist or int(np.sqrt(count))))
+        self.nprobe = nprobe
+        self.centroids, assignments = self.train(iterations, seed)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(self.nlist + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.nlist)]
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(*load_vectors(path), **kwargs)
+
+    def train(self, iterations, seed):
+        # Spherical k-means on the normalised rows. With a memory-mapped store the rows are
+        # converted to float32 for training only; the copy is released once the lists are built.
+        matrix = self.matrix if self.row_scale is None else self.unit_rows(slice(None))
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(matrix), self.nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for i in range(self.nlist):
+                members = matrix[assignments == i]
+                if len(members):
+                    centroids[i] = members.sum(axis=0)
+            centroids = normalize_rows(centroids)
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        return centroids, assignments
+
+    def vector_find(self, vector, *, limit, filter=None, fields=None, include_similarity=True):
+        limit = int(limit)
+        if not limit:
+            raise ValueError("Must pass a limit")
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        allowed = self.filter_rows(filter)
+        if allowed is not None and len(allowed) == 0:
+            return []
+
+        # Probe the closest clusters, widening the search until enough rows pass the filter
+        probe_order = np.argsort(-(self.centroids @ query))
+        nprobe = min(self.nprobe, self.nlist)
+        while True:
+            candidates = np.concatenate([self.lists[i] for i in probe_order[:nprobe]])
+            if allowed is not None:
+                candidates = np.intersect1d(candidates, allowed, assume_unique=True)
+            if len(candidates) >= limit or nprobe >= self.nlist:
+                break
+            nprobe = min(self.nlist, nprobe * 2)
+
+        rows, scores = self.top_rows(query, candidates, limit)
+        return [
+            self.project(row, fields, score if include_similarity else None)
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+def create_backend(kind, path=None, **kwargs):
+    # Build a local backend by name: "numpy" for exact search, "ivf" for the approximate index.
+    # path is a JSON/JSONL export or a vector store directory.
+    path = path or os.getenv('VECTOR_FILE', 'bikes_withVector.json')
+    if kind == 'numpy':
+        return NumpyBackend.from_file(path)
+    if kind == 'ivf':
+        return IVFBackend.from_file(path, **kwargs)
+    raise ValueError(f"Unknown vector backend: {kind}")
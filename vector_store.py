@@ -0,0 +1,250 @@
+import argparse, json, os
+
+import numpy as np
+
+from data_sources import iter_file_records
+
+# Compact binary export of the embedded catalog.
+# A vector store is a directory holding the vectors as a raw matrix that numpy.memmap opens without
+# parsing or copying, and the other fields as one set of files per column:
+#
+#   meta.json           count, dimension, dtype, embedding model and the column list
+#   vectors.bin         count x dimension matrix in float32, float16 or int8
+#   norms.bin           float32 L2 norm of each original vector
+#   scales.bin          float32 per-row scale of the int8 matrix (original ~= int8 * scale)
+#   column_<i>.present  uint8, 1 where the row has a value
+#   column_<i>.offsets  int64 start of each row's value in .data, plus the end (text and json columns)
+#   column_<i>.data     UTF-8 bytes of all values, back to back (text and json columns)
+#   column_<i>.values   float64 values (number columns)
+#
+# Several processes opening the same store share its pages through the OS page cache.
+
+FORMAT_VERSION = 1
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+VECTOR_KEYS = ('$vector', 'vector', 'embedding')
+
+def column_kind(values):
+    # Pick the narrowest storage that keeps every value: text, number or JSON
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, str) for value in present):
+        return 'text'
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return 'number'
+    return 'json'
+
+def quantize_int8(vectors):
+    # Symmetric per-row quantization: each row is scaled so its largest component maps to 127
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+class VectorStoreWriter:
+    # Streams vectors to disk chunk by chunk. The metadata columns are much smaller than the vectors
+    # and are kept in memory until finish(), when their storage kind is known.
+    def __init__(self, path, dtype='float32', model=None):
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self.model = model
+        self.count = 0
+        self.dimension = None
+        self.columns = {}
+        self.vectors = open(os.path.join(path, 'vectors.bin'), 'wb')
+        self.norms = open(os.path.join(path, 'norms.bin'), 'wb')
+        self.scales = open(os.path.join(path, 'scales.bin'), 'wb') if dtype == 'int8' else None
+
+    def write_chunk(self, records):
+        if not records:
+            return
+        vectors = []
+        for record in records:
+            key = next(key for key in VECTOR_KEYS if key in record)
+            vectors.append(record[key])
+            for field, value in record.items():
+                if field in VECTOR_KEYS:
+                    continue
+                # A column first seen at this row is missing in all the rows before it
+                self.columns.setdefault(field, [None] * self.count).append(value)
+            self.count += 1
+            for values in self.columns.values():
+                if len(values) < self.count:
+                    values.append(None)
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = matrix.shape[1]
+        elif matrix.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {matrix.shape[1]} does not match {self.dimension}")
+        self.norms.write(np.linalg.norm(matrix, axis=1).astype(np.float32).tobytes())
+        if self.dtype == 'int8':
+            quantized, scales = quantize_int8(matrix)
+            self.vectors.write(quantized.tobytes())
+            self.scales.write(scales.tobytes())
+        else:
+            self.vectors.write(matrix.astype(self.dtype).tobytes())
+
+    def write_column(self, index, values):
+        prefix = os.path.join(self.path, f'column_{index}')
+        kind = column_kind(values)
+        np.array([value is not None for value in values], dtype=np.uint8).tofile(prefix + '.present')
+        if kind == 'number':
+            np.array([np.nan if value is None else value for value in values], dtype=np.float64).tofile(prefix + '.values')
+            integer = all(isinstance(value, int) for value in values if value is not None)
+            return {'kind': kind, 'integer': integer}
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        with open(prefix + '.data', 'wb') as f:
+            for row, value in enumerate(values):
+                if value is not None:
+                    f.write((value if kind == 'text' else json.dumps(value)).encode('utf-8'))
+                offsets[row + 1] = f.tell()
+        offsets.tofile(prefix + '.offsets')
+        return {'kind': kind}
+
+    def finish(self):
+        for f in (self.vectors, self.norms, self.scales):
+            if f is not None:
+                f.close()
+        columns = []
+        for index, (name, values) in enumerate(self.columns.items()):
+            columns.append(dict(name=name, **self.write_column(index, values)))
+        meta = {
+            'format': FORMAT_VERSION,
+            'count': self.count,
+            'dimension': self.dimension or 0,
+            'dtype': self.dtype,
+            'model': self.model,
+            'columns': columns,
+        }
+        # meta.json is written last, so a half-written store cannot be opened
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+def iter_vector_file(path):
+    # Records of a JSON array or JSONL catalog export, parsed one at a time
+    return iter_file_records(path)
+
+def export_vector_store(records, path, dtype='float32', model=None, chunk_size=1000):
+    # Write an iterable of records with vectors (as in bikes_withVector.json) to a vector store
+    writer = VectorStoreWriter(path, dtype, model)
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            writer.write_chunk(chunk)
+            chunk = []
+    writer.write_chunk(chunk)
+    return writer.finish()
+
+class Column:
+    # Read-only view of one metadata column; values are decoded when they are read
+    def __init__(self, path, index, spec, count):
+        prefix = os.path.join(path, f'column_{index}')
+        self.kind = spec['kind']
+        self.integer = spec.get('integer', False)
+        self.present = open_array(prefix + '.present', np.uint8, (count,))
+        if self.kind == 'number':
+            self.values = open_array(prefix + '.values', np.float64, (count,))
+        else:
+            self.offsets = open_array(prefix + '.offsets', np.int64, (count + 1,))
+            self.data = open_array(prefix + '.data', np.uint8, (int(self.offsets[-1]) if count else 0,))
+
+    def __getitem__(self, row):
+        if not self.present[row]:
+            return None
+        if self.kind == 'number':
+            value = float(self.values[row])
+            return int(value) if self.integer else value
+        text = self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+        return text if self.kind == 'text' else json.loads(text)
+
+    def to_list(self):
+        return [self[row] for row in range(len(self.present))]
+
+def open_array(path, dtype, shape):
+    # numpy.memmap cannot map an empty file
+    if not shape[0] or not os.path.getsize(path):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+class ColumnarDocuments:
+    # Sequence of documents backed by the store's columns. Documents are built on access,
+    # and filters read whole columns without decoding the other fields.
+    def __init__(self, columns, count):
+        self.columns = columns
+        self.count = count
+        self._decoded = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.count
+        document = {}
+        for name, column in self.columns.items():
+            value = column[row]
+            if value is not None:
+                document[name] = value
+        return document
+
+    def __iter__(self):
+        return (self[row] for row in range(self.count))
+
+    def column(self, name):
+        # All values of one field, decoded once
+        if name not in self._decoded:
+            column = self.columns.get(name)
+            self._decoded[name] = column.to_list() if column is not None else [None] * self.count
+        return self._decoded[name]
+
+class VectorStore:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported vector store format: {self.meta['format']}")
+        self.path = path
+        self.count = self.meta['count']
+        self.dimension = self.meta['dimension']
+        self.dtype = self.meta['dtype']
+        self.model = self.meta.get('model')
+        self.vectors = open_array(os.path.join(path, 'vectors.bin'), np.dtype(self.dtype), (self.count, self.dimension))
+        self.norms = open_array(os.path.join(path, 'norms.bin'), np.float32, (self.count,))
+        self.scales = open_array(os.path.join(path, 'scales.bin'), np.float32, (self.count,)) if self.dtype == 'int8' else None
+        columns = {spec['name']: Column(path, index, spec, self.count) for index, spec in enumerate(self.meta['columns'])}
+        self.documents = ColumnarDocuments(columns, self.count)
+
+    def row_scale(self):
+        # Factor turning a dot product with a stored row into a cosine similarity
+        norms = np.where(self.norms == 0, 1.0, self.norms).astype(np.float32)
+        if self.scales is not None:
+            return self.scales / norms
+        return 1.0 / norms
+
+    def vector(self, row):
+        # The row as float32, dequantized when the store is int8
+        vector = np.asarray(self.vectors[row], dtype=np.float32)
+        return vector * self.scales[row] if self.scales is not None else vector
+
+def open_vector_store(path):
+    return VectorStore(path)
+
+def is_vector_store(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSON/JSONL catalog export with vectors into a binary vector store")
+    parser.add_argument('input', help="bikes_withVector.json or a .jsonl export")
+    parser.add_argument('output', help="Directory to write the vector store to")
+    parser.add_argument('--dtype', default='float32', choices=VECTOR_DTYPES)
+    parser.add_argument('--model', help="Embedding model the vectors were made with, recorded in meta.json")
+    args = parser.parse_args()
+    meta = export_vector_store(iter_vector_file(args.input), args.output, args.dtype, args.model)
+    print(f"Wrote {meta['count']} x {meta['dimension']} {meta['dtype']} vectors to {args.output}")
+
+if __name__ == "__main__":
+    main()